@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the expert finder
+
+The end-to-end benchmark generates synthetic dumps (see synthetic_dump.py) at several scales and times each step
+of the README: the import into MySQL, building the index, classifying comments, building the prescoring tables
+and answering queries (serially, through the concurrent pipeline and as one batch). The results are written as a
+JSON report so that runs on different versions of the code can be compared.
+
+The benchmark needs a MySQL database that it may empty: every table in it is dropped before each scale is imported.
+Corpus and dump files are written to the work directory.
+
+The other benchmarks are microbenchmarks of one part of the code that run against an existing database.
+
+Call it by
+benchmark.py endtoend [--scales 1000,10000] [--database DBNAME] [--work DIRECTORY] [--queries N] [--report FILE]
+benchmark.py records [--database DBNAME] [--questions N] [--repeats N] [--report FILE]
+benchmark.py features [--database DBNAME | --synthetic] [--comments N] [--classify] [--repeats N] [--report FILE]
+benchmark.py streaming [--database DBNAME] [--iterators questions,answers,comments] [--selectRate N] [--report FILE]
+benchmark.py quantized [--corpus NAME | --synthetic N] [--queries FILE] [--k 10] [--precisions float16,int8] [--report FILE]
+benchmark.py scoring [--sizes 10000,100000,1000000] [--referenceLimit N] [--topN N] [--report FILE]
+
+Created on Oct 19, 2026
+
+@author: efeins
+'''
+import sys
+import os
+import time
+import json
+import platform
+import subprocess
+import argparse
+import logging
+
+from config import Config
+import util
+
+# tables created by the import, indexing and scoring steps
+benchmarkTables = ["users", "posts", "comments", "tags", "answer_tags", "qtoa", "badges", "votes", "post_history",
+    "question_prescoring", "answer_prescoring", "comment_prescoring", "classified_comments",
+    "classification_watermark"]
+
+def timeIt(function, *args, **kwargs):
+    """ return (seconds taken, result) of calling function """
+    t = time.time()
+    result = function(*args, **kwargs)
+    return (time.time() - t, result)
+
+def latencySummary(samples):
+    """ summarize a list of latencies in seconds """
+    if not samples:
+        return {"n" : 0}
+    ordered = sorted(samples)
+    def percentile(p):
+        return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+    return {
+        "n" : len(ordered),
+        "mean" : sum(ordered) / len(ordered),
+        "p50" : percentile(50),
+        "p90" : percentile(90),
+        "p99" : percentile(99),
+        "max" : ordered[-1]
+    }
+
+def environment():
+    """ describe where the benchmark was run, for comparing reports """
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "revision" : revision
+    }
+
+def writeReport(report, fileName):
+    with open(fileName, "wb") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print >>sys.stderr, "Report written to", fileName
+
+def resetTables(db):
+    """ drop all of the tables the benchmark creates """
+    c = db.cursor()
+    for table in benchmarkTables:
+        c.execute("DROP TABLE IF EXISTS %s" % table)
+        c.fetchall()
+    c.close()
+
+def removeCorpusFiles(corpusName):
+    directory = os.path.dirname(corpusName) or "."
+    prefix = os.path.basename(corpusName)
+    for fileName in os.listdir(directory):
+        if fileName.startswith(prefix + "."):
+            os.remove(os.path.join(directory, fileName))
+
+def replayQueries(queries, runQuery):
+    """ run each query through runQuery and return a latency summary """
+    latencies = []
+    for query in queries:
+        t = time.time()
+        runQuery(query)
+        latencies.append(time.time() - t)
+    return latencySummary(latencies)
+
+def queryLatencies(database, corpusName, queries, resultCutoff=0.5, cutoffPercentile=75):
+    """ time the queries serially, through the pipeline and as one batch """
+    import topic_classification
+    import scoring
+    import pipeline
+    topicModel = topic_classification.TopicModeling(corpusName)
+    connectionPool = util.ConnectionPool(database)
+    results = {}
+
+    def serial(query):
+        with connectionPool.connection() as db:
+            queryResults = topicModel.queryResults(db, query, resultCutoff)
+            if queryResults:
+                scoring.scoreUsers(db, query, queryResults, topicModel, cutoffPercentile=cutoffPercentile, resultCutoff=resultCutoff)
+    results["serial"] = replayQueries(queries, serial)
+
+    queryPipeline = pipeline.QueryPipeline(topicModel, connectionPool, resultCutoff=resultCutoff, cutoffPercentile=cutoffPercentile)
+    results["pipeline"] = replayQueries(queries, queryPipeline.run)
+    queryPipeline.close()
+
+    with connectionPool.connection() as db:
+        dt, batchResults = timeIt(scoring.findExpertsBatch, db, topicModel, queries, resultCutoff=resultCutoff, cutoffPercentile=cutoffPercentile)
+    results["batch"] = {"n" : len(queries), "total" : dt, "perQuery" : dt / len(queries) if queries else 0.0}
+    connectionPool.close()
+    return results
+
+def benchmarkScale(database, nQuestions, workDirectory, nQueries=100, seed=0):
+    """ generate, import, index, classify and query a synthetic dump of nQuestions questions """
+    import synthetic_dump
+    import sov2mysql
+    import topic_classification
+    import scoring
+    import comment_classification
+
+    dumpDirectory = os.path.join(workDirectory, "dump_%d" % nQuestions)
+    corpusName = os.path.join(workDirectory, "corpus_%d" % nQuestions)
+    timings = {}
+    dump = synthetic_dump.SyntheticDump(nQuestions, seed)
+    timings["generate"], dummy = timeIt(dump.write, dumpDirectory, nQueries)
+    with open(os.path.join(dumpDirectory, "queries.txt"), "rb") as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    db = util.makeDbConnection(database)
+    try:
+        resetTables(db)
+        removeCorpusFiles(corpusName)
+        sov2mysql.createDatabase(db, database)
+        timings["import"], dummy = timeIt(sov2mysql.importData, db, dumpDirectory)
+        # keep the number of topics in proportion for small dumps
+        postsPerTopic = max(1, min(Config.postsPerTopic, nQuestions // 50))
+        timings["index"], dummy = timeIt(topic_classification.buildIndex, corpusName, [], database, postsPerTopic)
+        timings["classifyComments"], dummy = timeIt(comment_classification.classifyCommentsParallel, database)
+        timings["prescoring"], dummy = timeIt(scoring.createPrescoringTables, db)
+    finally:
+        db.close()
+    return {
+        "questions" : nQuestions,
+        "posts" : dump.nPosts,
+        "users" : dump.nUsers,
+        "comments" : dump.nComments,
+        "timings" : timings,
+        "queries" : queryLatencies(database, corpusName, queries)
+    }
+
+def endToEnd(args):
+    if not os.path.isdir(args.work):
+        os.makedirs(args.work)
+    report = {"benchmark" : "endtoend", "environment" : environment(), "scales" : []}
+    for scale in [int(s) for s in args.scales.split(",")]:
+        print >>sys.stderr, "Benchmarking %d questions..." % scale
+        report["scales"].append(benchmarkScale(args.database, scale, args.work, args.queries, args.seed))
+        # write as we go, so that a failure at a large scale keeps the smaller results
+        writeReport(report, args.report)
+
+def bytesSent(db):
+    """ the number of bytes the server has sent on this connection """
+    c = db.cursor()
+    c.execute("SHOW SESSION STATUS LIKE 'Bytes_sent'")
+    n = int(c.fetchall()[0][1])
+    c.close()
+    return n
+
+def records(args):
+    """ compare full Post objects with column-projected records for fetching answers """
+    db = util.makeDbConnection(args.database)
+    try:
+        c = db.cursor()
+        c.execute("SELECT id FROM posts WHERE type_id=1 AND answer_count > 0 LIMIT %d" % args.questions)
+        questionIds = [int(row[0]) for row in c.fetchall()]
+        c.close()
+        report = {"benchmark" : "records", "environment" : environment(), "questions" : len(questionIds)}
+        for (name, columns) in [("Post", None), ("answerColumns", util.answerColumns)]:
+            nRows = 0
+            nBytes = 0
+            t = time.time()
+            for repeat in xrange(args.repeats):
+                before = bytesSent(db)
+                for start in xrange(0, len(questionIds), 1000):
+                    for answer in util.iterateAnswers(db, questionIds[start:(start + 1000)], columns=columns):
+                        nRows += 1
+                nBytes += bytesSent(db) - before
+            dt = time.time() - t
+            report[name] = {"rows" : nRows, "seconds" : dt, "rowsPerSecond" : nRows / dt if dt else None, "bytesPerRow" : float(nBytes) / nRows if nRows else None}
+            print >>sys.stderr, "%s: %d rows in %0.2fs (%0.0f rows/s), %0.0f bytes/row" % (
+                name, nRows, dt, report[name]["rowsPerSecond"] or 0, report[name]["bytesPerRow"] or 0)
+    finally:
+        db.close()
+    writeReport(report, args.report)
+
+def featuresBenchmark(args):
+    """ time comment feature extraction with the separate regexes and with the fused scanner, and check that they agree """
+    import comment_classification
+    if args.synthetic:
+        import synthetic_dump
+        dump = synthetic_dump.SyntheticDump(1, args.seed)
+        comments = []
+        for n in xrange(args.comments):
+            template = dump.rng.choice(synthetic_dump.commentTemplates)
+            comments.append(" ".join(dump.words.samples(dump.rng.randint(0, 30)) + [template % dump.words.sample() if "%s" in template else template]))
+    else:
+        db = util.makeDbConnection(args.database)
+        c = db.cursor()
+        c.execute("SELECT text FROM comments LIMIT %d" % args.comments)
+        comments = [row[0] for row in c.fetchall()]
+        c.close()
+        db.close()
+    report = {"benchmark" : "features", "environment" : environment(), "comments" : len(comments), "synthetic" : args.synthetic}
+    for (name, extract) in [("commentFeatures", comment_classification.commentFeatures), 
+        ("commentFeatureBits", comment_classification.commentFeatureBits),
+        ("fastCommentFeatures", comment_classification.fastCommentFeatures)]:
+        t = time.time()
+        for repeat in xrange(args.repeats):
+            for comment in comments:
+                extract(comment)
+        dt = time.time() - t
+        report[name] = {"seconds" : dt, "commentsPerSecond" : len(comments) * args.repeats / dt if dt else None}
+        print >>sys.stderr, "%s: %0.0f comments/s" % (name, report[name]["commentsPerSecond"] or 0)
+    report["mismatches"] = len(comment_classification.featureMismatches(comments))
+    print >>sys.stderr, "%d mismatches" % report["mismatches"]
+    if args.classify:
+        classifier = comment_classification.loadClassifier()
+        compiled = comment_classification.CompiledClassifier.fromClassifier(classifier)
+        t = time.time()
+        labels = [classifier.classify(comment_classification.commentFeatures(comment)) for comment in comments]
+        dt = time.time() - t
+        report["classify"] = {"seconds" : dt, "commentsPerSecond" : len(comments) / dt if dt else None}
+        t = time.time()
+        compiledLabels = compiled.classifyBits([comment_classification.commentFeatureBits(comment) for comment in comments])
+        dt = time.time() - t
+        report["compiledClassify"] = {"seconds" : dt, "commentsPerSecond" : len(comments) / dt if dt else None}
+        report["classifyMismatches"] = int(sum(label != compiledLabel for (label, compiledLabel) in zip(labels, compiledLabels)))
+        print >>sys.stderr, "classify: %0.0f comments/s, compiled: %0.0f comments/s, %d mismatches" % (
+            report["classify"]["commentsPerSecond"] or 0, report["compiledClassify"]["commentsPerSecond"] or 0, report["classifyMismatches"])
+    writeReport(report, args.report)
+
+def iterationRows(db, iterator, selectRate, stream):
+    """ the rows of one of the util iterators over the whole database """
+    if iterator == "questions":
+        return util.iterateQuestions(db, selectRate=selectRate, stream=stream)
+    elif iterator == "answers":
+        c = db.cursor()
+        c.execute("SELECT id FROM posts WHERE type_id=1 ORDER BY id")
+        questionIds = [int(row[0]) for row in c.fetchall()]
+        c.close()
+        return util.iterateAnswers(db, questionIds, selectRate=selectRate, stream=stream)
+    return util.iterateAllComments(db, selectRate=selectRate, stream=stream)
+
+def streamingRun(args):
+    """ iterate once, in this process, and print the rows, time and memory as JSON for streamingBenchmark """
+    import resource
+    db = util.makeDbConnection(args.database)
+    # ru_maxrss is in kilobytes on Linux
+    baselineRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    nRows = 0
+    t = time.time()
+    for row in iterationRows(db, args.iterator, args.selectRate, args.stream):
+        nRows += 1
+    dt = time.time() - t
+    db.close()
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print json.dumps({"rows" : nRows, "seconds" : dt, "rowsPerSecond" : nRows / dt if dt else None, 
+        "baselineRssKb" : baselineRss, "peakRssKb" : peakRss, "rssGrowthKb" : peakRss - baselineRss})
+
+def streamingBenchmark(args):
+    """ compare the buffered and streaming (server side cursor) modes of the util iterators. Each run is a separate
+    process, so that its peak memory use is its own """
+    report = {"benchmark" : "streaming", "environment" : environment(), "runs" : []}
+    for iterator in args.iterators.split(","):
+        for stream in (False, True):
+            command = [sys.executable, os.path.abspath(__file__), "streamrun", "--database", args.database, 
+                "--iterator", iterator, "--selectRate", str(args.selectRate)] + (["--stream"] if stream else [])
+            result = json.loads(subprocess.check_output(command))
+            result.update({"iterator" : iterator, "stream" : stream})
+            print >>sys.stderr, "%s (%s): %d rows, %0.0f rows/s, peak RSS %d kB (+%d kB)" % (iterator, 
+                "streaming" if stream else "buffered", result["rows"], result["rowsPerSecond"] or 0, result["peakRssKb"], result["rssGrowthKb"])
+            report["runs"].append(result)
+    writeReport(report, args.report)
+
+def quantizedBenchmark(args):
+    """ compare the reduced precision indexes with full precision: recall@k of the top documents, similarity error, 
+    per-query scan latency and memory """
+    import random
+    import numpy
+    import gensim
+    import topic_classification
+    rng = numpy.random.RandomState(args.seed)
+    if args.synthetic:
+        # LSI-like vectors: the variance falls off with the topic number
+        docVectors = (rng.standard_normal((args.synthetic, args.topics)) / numpy.sqrt(1.0 + numpy.arange(args.topics))).astype(numpy.float32)
+        docVectors /= numpy.sqrt((docVectors ** 2).sum(axis=1))[:, numpy.newaxis]
+        queryVectors = docVectors[rng.randint(0, len(docVectors), args.nQueries)] + 0.5 * rng.standard_normal((args.nQueries, args.topics)) / numpy.sqrt(args.topics)
+        queryLsis = [gensim.matutils.full2sparse(queryVector) for queryVector in queryVectors]
+        numTopics = args.topics
+        def fullScan(queryLsi):
+            queryVector = gensim.matutils.unitvec(gensim.matutils.sparse2full(queryLsi, numTopics)).astype(numpy.float32)
+            return numpy.dot(docVectors, queryVector)
+        lsiCorpus = [gensim.matutils.full2sparse(docVector) for docVector in docVectors]
+    else:
+        corpus = gensim.corpora.MmCorpus(args.corpus + ".mm")
+        tfidf = gensim.models.TfidfModel.load(args.corpus + ".tfidf")
+        lsi = gensim.models.LsiModel.load(args.corpus + ".lsi")
+        fullIndex = gensim.similarities.Similarity.load(args.corpus + ".index")
+        numTopics = lsi.num_topics
+        lsiCorpus = lsi[tfidf[corpus]]
+        if args.queries:
+            dictionary = gensim.corpora.Dictionary.load(args.corpus + ".dict")
+            with open(args.queries, "rb") as f:
+                queries = [line.strip() for line in f if line.strip()][:args.nQueries]
+            # projected like TopicModeling.projectQueries
+            queryLsis = [lsi[dictionary.doc2bow(topic_classification.tokenizeText(query, useStemmer=True))] for query in queries]
+        else:
+            # documents of the corpus as queries
+            sample = frozenset(random.Random(args.seed).sample(xrange(len(corpus)), min(args.nQueries, len(corpus))))
+            queryLsis = [document for (corpusDoc, document) in enumerate(lsiCorpus) if corpusDoc in sample]
+        def fullScan(queryLsi):
+            return numpy.asarray(fullIndex[queryLsi])
+    k = args.k
+
+    def topK(similarities):
+        return numpy.argsort(-similarities, kind="mergesort")[:k]
+
+    def timeScans(scan):
+        latencies = []
+        results = []
+        for queryLsi in queryLsis:
+            for repeat in xrange(args.repeats):
+                dt, similarities = timeIt(scan, queryLsi)
+                latencies.append(dt)
+            results.append(similarities)
+        return (latencySummary(latencies), results)
+
+    report = {"benchmark" : "quantized", "environment" : environment(), "k" : k, "queries" : len(queryLsis), 
+        "topics" : numTopics, "corpus" : None if args.synthetic else args.corpus}
+    report["full"] = {}
+    report["full"]["latency"], fullResults = timeScans(fullScan)
+    report["documents"] = len(fullResults[0]) if fullResults else 0
+    report["full"]["bytes"] = report["documents"] * numTopics * 4
+    print >>sys.stderr, "full precision: %d documents, p50 %0.2fms per query" % (report["documents"], report["full"]["latency"].get("p50", 0) * 1000)
+    for precision in args.precisions.split(","):
+        result = {}
+        result["buildSeconds"], index = timeIt(topic_classification.QuantizedIndex.fromCorpus, lsiCorpus, numTopics, precision)
+        result["bytes"] = index.vectors.nbytes + (index.scales.nbytes if index.scales is not None else 0)
+        result["latency"], results = timeScans(lambda queryLsi: index.similarities([queryLsi])[0])
+        result["recallAtK"] = float(numpy.mean([len(numpy.intersect1d(topK(full), topK(quantized))) / float(min(k, len(full)))
+            for (full, quantized) in zip(fullResults, results)])) if results else None
+        result["maxSimilarityError"] = float(max([numpy.abs(full - quantized).max() for (full, quantized) in zip(fullResults, results)] or [0.0]))
+        print >>sys.stderr, "%s: recall@%d %0.4f, max similarity error %0.4f, p50 %0.2fms per query, %0.1f%% of the memory" % (precision, k, 
+            result["recallAtK"] or 0, result["maxSimilarityError"], result["latency"].get("p50", 0) * 1000, 100.0 * result["bytes"] / max(report["full"]["bytes"], 1))
+        report[precision] = result
+    writeReport(report, args.report)
+
+def referenceRankUsers(userIds, relevance, scores, favorites, views, accepted, commentSentiment):
+    """ the original per-element and per-user loops of scoring.rankUsers, returning {user id : (score, percentile rank)} """
+    import numpy
+    import scoring
+    from scipy.stats import percentileofscore
+    scores = scores + commentSentiment * scoring.sentimentFactor
+    relevance = numpy.array(relevance)
+    pctScores = numpy.array([percentileofscore(scores, s, 'strict') for s in scores], numpy.double)/100.0
+    pctFavorites = numpy.array([percentileofscore(favorites, f, 'strict') for f in favorites], numpy.double)/100.0
+    pctViews = numpy.array([percentileofscore(views, v, 'strict') for v in views], numpy.double)/100.0
+    postScore = relevance * (1.0+pctScores) * (1.0+pctFavorites) * (1.0 + pctViews) * (1.0 + scoring.acceptedBonus * accepted)
+    userIds = numpy.array(userIds)
+    userSet = frozenset(userIds)
+    userScores = {user : postScore[userIds==user].sum() for user in userSet}
+    allUserScores = numpy.array(userScores.values(), dtype=numpy.double)
+    return {user : (score, percentileofscore(allUserScores, score)) for (user, score) in userScores.items()}
+
+def syntheticCandidates(nAnswers, rng):
+    """ random per-answer features, with users and scores skewed like the real data """
+    import numpy
+    nUsers = max(1, nAnswers // 5)
+    userIds = (rng.zipf(1.3, nAnswers) % nUsers) + 1
+    relevance = rng.uniform(0.5, 1.0, nAnswers)
+    scores = numpy.double(rng.poisson(2.0, nAnswers) - rng.poisson(0.5, nAnswers))
+    favorites = numpy.double(rng.poisson(1.0, nAnswers))
+    views = numpy.double(rng.pareto(1.2, nAnswers) * 50).round()
+    accepted = rng.binomial(1, 0.3, nAnswers)
+    commentSentiment = rng.poisson(0.5, nAnswers) - rng.poisson(0.3, nAnswers)
+    return (userIds, relevance, scores, favorites, views, accepted, commentSentiment)
+
+def scoringBenchmark(args):
+    """ time scoring.rankUsers on synthetic candidate answers, and compare it with the original loops """
+    import numpy
+    import scoring
+    rng = numpy.random.RandomState(args.seed)
+    report = {"benchmark" : "scoring", "environment" : environment(), "sizes" : []}
+    for nAnswers in [int(s) for s in args.sizes.split(",")]:
+        userIds, relevance, scores, favorites, views, accepted, commentSentiment = syntheticCandidates(nAnswers, rng)
+        postIds = [scoring.PostDetails(answerId=n) for n in xrange(nAnswers)]
+        dt, userScores = timeIt(scoring.rankUsers, userIds, relevance, postIds, scores, favorites, views, accepted, commentSentiment, {}, 0)
+        result = {"answers" : nAnswers, "users" : len(userScores), "seconds" : dt}
+        if nAnswers <= args.referenceLimit:
+            result["referenceSeconds"], reference = timeIt(referenceRankUsers, userIds, relevance, scores, favorites, views, accepted, commentSentiment)
+            result["maxRelativeScoreDifference"] = max([abs(u.score - reference[u.userId][0]) / abs(reference[u.userId][0]) 
+                for u in userScores if reference[u.userId][0]] or [0.0])
+            result["maxPercentileRankDifference"] = max([abs(u.percentileRank - reference[u.userId][1]) for u in userScores] or [0.0])
+        if args.topN:
+            result["topNSeconds"], topUsers = timeIt(scoring.rankUsers, userIds, relevance, postIds, scores, favorites, views, accepted, commentSentiment, {}, 0, args.topN)
+            result["topNMatchesFullRanking"] = [u.userId for u in topUsers] == [u.userId for u in userScores[:args.topN]]
+        print >>sys.stderr, result
+        report["sizes"].append(result)
+    writeReport(report, args.report)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the expert finder")
+    subparsers = parser.add_subparsers()
+
+    endToEndParser = subparsers.add_parser("endtoend", help="import, index, classify and query synthetic dumps")
+    endToEndParser.add_argument("--scales", default="1000,10000", help="comma separated numbers of questions")
+    endToEndParser.add_argument("--database", default=Config.mySQLdb + "_benchmark", help="database to use; its tables are dropped!")
+    endToEndParser.add_argument("--work", default="benchmark_work", help="directory for dumps and corpus files")
+    endToEndParser.add_argument("--queries", type=int, default=100, help="number of queries to time")
+    endToEndParser.add_argument("--seed", type=int, default=0)
+    endToEndParser.add_argument("--report", default="benchmark_endtoend.json")
+    endToEndParser.set_defaults(run=endToEnd)
+
+    recordsParser = subparsers.add_parser("records", help="compare Post objects with column-projected records")
+    recordsParser.add_argument("--database", default=Config.mySQLdb)
+    recordsParser.add_argument("--questions", type=int, default=10000, help="number of questions whose answers are fetched")
+    recordsParser.add_argument("--repeats", type=int, default=3)
+    recordsParser.add_argument("--report", default="benchmark_records.json")
+    recordsParser.set_defaults(run=records)
+
+    featuresParser = subparsers.add_parser("features", help="time comment feature extraction")
+    featuresParser.add_argument("--database", default=Config.mySQLdb)
+    featuresParser.add_argument("--synthetic", action="store_true", help="use synthetic comments instead of the database")
+    featuresParser.add_argument("--comments", type=int, default=100000, help="number of comments")
+    featuresParser.add_argument("--classify", action="store_true", help="also time the NLTK and compiled classifiers")
+    featuresParser.add_argument("--repeats", type=int, default=3)
+    featuresParser.add_argument("--seed", type=int, default=0)
+    featuresParser.add_argument("--report", default="benchmark_features.json")
+    featuresParser.set_defaults(run=featuresBenchmark)
+
+    scoringParser = subparsers.add_parser("scoring", help="time user scoring on synthetic candidate answers")
+    scoringParser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated numbers of candidate answers")
+    scoringParser.add_argument("--referenceLimit", type=int, default=20000, help="largest size to also run the original O(n^2) code on")
+    scoringParser.add_argument("--topN", type=int, default=50, help="also time ranking only the best N users (0 to skip)")
+    scoringParser.add_argument("--seed", type=int, default=0)
+    scoringParser.add_argument("--report", default="benchmark_scoring.json")
+    scoringParser.set_defaults(run=scoringBenchmark)
+
+    streamingParser = subparsers.add_parser("streaming", help="compare buffered and streaming database iterators")
+    streamingParser.add_argument("--database", default=Config.mySQLdb)
+    streamingParser.add_argument("--iterators", default="questions,answers,comments", help="comma separated iterators to time")
+    streamingParser.add_argument("--selectRate", type=int, default=5000, help="rows (or posts, for answers) per query")
+    streamingParser.add_argument("--report", default="benchmark_streaming.json")
+    streamingParser.set_defaults(run=streamingBenchmark)
+
+    # one iteration of the streaming benchmark, run in a child process
+    streamRunParser = subparsers.add_parser("streamrun")
+    streamRunParser.add_argument("--database", default=Config.mySQLdb)
+    streamRunParser.add_argument("--iterator", choices=["questions", "answers", "comments"], default="questions")
+    streamRunParser.add_argument("--selectRate", type=int, default=5000)
+    streamRunParser.add_argument("--stream", action="store_true")
+    streamRunParser.set_defaults(run=streamingRun)
+
+    quantizedParser = subparsers.add_parser("quantized", help="compare reduced precision similarity indexes with full precision")
+    quantizedParser.add_argument("--corpus", default=Config.corpusName, help="corpus whose index, LSI and TF-IDF files are used")
+    quantizedParser.add_argument("--synthetic", type=int, default=0, help="use this many random document vectors instead of a corpus")
+    quantizedParser.add_argument("--topics", type=int, default=200, help="number of topics of the synthetic vectors")
+    quantizedParser.add_argument("--queries", default=None, help="file of queries, one per line (default: corpus documents)")
+    quantizedParser.add_argument("--nQueries", type=int, default=100)
+    quantizedParser.add_argument("--k", type=int, default=10, help="number of top documents compared for recall")
+    quantizedParser.add_argument("--precisions", default="float16,int8")
+    quantizedParser.add_argument("--repeats", type=int, default=3)
+    quantizedParser.add_argument("--seed", type=int, default=0)
+    quantizedParser.add_argument("--report", default="benchmark_quantized.json")
+    quantizedParser.set_defaults(run=quantizedBenchmark)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+    main()
@@ -2,12 +2,22 @@
 # Source code for the trained classifier.
 # The supervised classification training was done using a separate client/server interface, resulting in this classification
 # setup.
+import sys
+import os
+import time
+import logging
+import collections
+import multiprocessing
 import nltk
 import random
 import re
+import cPickle as pickle
+import numpy
 
+from config import Config
 import util
 import topic_classification
+import scoring
 
 stopwords = topic_classification.punctuators + ["<", ">", "the", "i", "a", "to", "it", "is", "you", "of", "that", "this"]
 
@@ -43,6 +53,92 @@ def commentFeatures(comment):
     lcomment = comment.lower()
     return {featureName : bool(features[featureName].search(lcomment)) for featureName in features}
 
+# the features in the fixed order of the bits of commentFeatureBits
+featureOrder = sorted(features)
+
+# literal strings that trigger each feature: every match of a feature's regex contains at least one of its literals.
+# An exact literal means the feature is present whenever the literal is; otherwise, the regex is run to check.
+# Note that "\b" in the (non-raw) patterns above is a backspace character, not a word boundary, so it is here too.
+featureTriggers = {
+  "thank" : [("thanx", True), ("thank", True)],
+  "a lot" : [("\b", False)],
+  "thanks but" : [("thank", False)],
+  "anyway" : [("anyway", True)],
+  "agree" : [("agree", True)],
+  "almost" : [("almost", True)],
+  "disagree" : [("disagree", True), ("agree", False)],
+  "sorry" : [("sorry", True)],
+  "also" : [("also", True)],
+  "but" : [("but", True)],
+  "works" : [("work", True)],
+  "not" : [("doesn't", True), ("does\bnot", True), ("did", False), ("\b", False)],
+  "+" : [("\b", False)],
+  "-" : [("\b", False)],
+  "@" : [("@", False)],
+  "!" : [("!", True)],
+  "?" : [("?", True)],
+  "smart" : [("\b", False)],
+  "fixed" : [("\bfixed", True), ("solves", True), ("solved", True)],
+  "needed" : [("what i need", True), ("what i want", True), ("did the trick", True)],
+  "nice" : [("\b", False)],
+  "wrong" : [("wrong", True), ("incorrect", True), ("incomplete", True), ("useless", True), ("no use", True), ("unclear", True)],
+  "better" : [("better", True)],
+  "clarify" : [("clarify", True)]
+}
+
+def compileTriggers(triggers):
+    """ compile the feature triggers into one scanner for all of the literals, longest first, 
+    and a table of literal -> (bits of the features it sets, (feature bit, regex search) of the features it may set).
+    A literal also triggers everything that its prefixes trigger, because the scanner only reports the 
+    longest literal at each position """
+    literals = sorted(set(literal for featureName in triggers for (literal, exact) in triggers[featureName]), key=lambda l: (-len(l), l))
+    table = {}
+    for literal in literals:
+        exactBits = 0
+        checks = []
+        for (n, featureName) in enumerate(featureOrder):
+            for (trigger, exact) in triggers[featureName]:
+                if literal.startswith(trigger):
+                    if exact:
+                        exactBits |= 1 << n
+                    elif (1 << n, features[featureName].search) not in checks:
+                        checks.append((1 << n, features[featureName].search))
+        table[literal] = (exactBits, tuple(checks))
+    return (re.compile("|".join([re.escape(literal) for literal in literals])), table)
+
+triggerScanner, triggerTable = compileTriggers(featureTriggers)
+
+def commentFeatureBits(comment):
+    """ extract the features of a comment as a bit vector (bit n is featureOrder[n]) in one scan of the comment 
+    for all of the trigger literals. The result is the same as commentFeatures """
+    lcomment = comment.lower()
+    bits = 0
+    checks = ()
+    search = triggerScanner.search
+    match = search(lcomment)
+    while match is not None:
+        exactBits, literalChecks = triggerTable[match.group()]
+        bits |= exactBits
+        checks += literalChecks
+        # resume at the next position, so that overlapping literals are found too
+        match = search(lcomment, match.start() + 1)
+    for (bit, regexSearch) in checks:
+        if not bits & bit and regexSearch(lcomment):
+            bits |= bit
+    return bits
+
+def featureDict(bits):
+    """ convert a bit vector from commentFeatureBits into the dictionary returned by commentFeatures """
+    return {featureName : bool(bits & (1 << n)) for (n, featureName) in enumerate(featureOrder)}
+
+def fastCommentFeatures(comment):
+    """ commentFeatures, using the fused scanner """
+    return featureDict(commentFeatureBits(comment))
+
+def featureMismatches(comments):
+    """ return the comments for which commentFeatureBits and commentFeatures disagree """
+    return [comment for comment in comments if featureDict(commentFeatureBits(comment)) != commentFeatures(comment)]
+
 rFeatures = {
   "a" : re.compile("a\s"),
   "an" : re.compile("an\s"),
@@ -121,31 +217,366 @@ def trainedCommentClassifier(db):
     print nltk.classify.accuracy(classifier, testingSet)
     return (classifier, trainingSet, testingSet)
 
-def classifyComments(db, classifier, commentList=None):
-    c=db.cursor()
+def createClassifiedCommentsTable(db):
+    """ create classified_comments, with one row per comment, and the classification watermark. 
+    A classified_comments table from before comment_id was its key (which could hold a comment more than once) is 
+    deduplicated first. """
+    c = db.cursor()
+    if scoring.tableExists(db, "classified_comments"):
+        c.execute("""SHOW INDEX FROM classified_comments WHERE Column_name='comment_id' AND Non_unique=0""")
+        if not c.fetchall():
+            deduplicateClassifiedComments(db)
     c.execute("""CREATE TABLE IF NOT EXISTS classified_comments (
-        comment_id int,
-        classification int,
-        INDEX (comment_id)
+        comment_id int NOT NULL PRIMARY KEY,
+        classification int
+    ) ENGINE=MyISAM""")
+    c.fetchall()
+    # row 1: every comment with an id up to comment_id has been classified;
+    # row 2 (scoring.sumsOnlyRow), if present: comment_prescoring was written without storing the class of each comment
+    c.execute("""CREATE TABLE IF NOT EXISTS classification_watermark (
+        id tinyint NOT NULL PRIMARY KEY,
+        comment_id int
     ) ENGINE=MyISAM""")
     c.fetchall()
-    commentClasses = [(comment.id, classifier.classify(commentFeatures(comment.body)))
-          for comment in util.iterateAllComments(db, commentList=commentList)]
+    c.close()
+
+def deduplicateClassifiedComments(db):
+    """ rebuild classified_comments with comment_id as its primary key, keeping one row per comment, 
+    and rebuild comment_prescoring, whose sums counted the duplicates """
+    c = db.cursor()
+    c.execute("""DROP TABLE IF EXISTS classified_comments_shadow""")
+    c.execute("""CREATE TABLE classified_comments_shadow (
+        comment_id int NOT NULL PRIMARY KEY,
+        classification int
+    ) ENGINE=MyISAM""")
+    nRows = c.execute("""INSERT IGNORE INTO classified_comments_shadow (comment_id, classification)
+        SELECT comment_id, classification FROM classified_comments WHERE comment_id IS NOT NULL""")
+    c.execute("""RENAME TABLE classified_comments TO classified_comments_old, classified_comments_shadow TO classified_comments""")
+    c.execute("""DROP TABLE classified_comments_old""")
+    c.close()
+    logging.info("deduplicated classified_comments to %d rows" % nRows)
+    if scoring.tableExists(db, scoring.commentPrescoringTable.name):
+        scoring.refreshPrescoringTables(db, [scoring.commentPrescoringTable])
+
+def writeClassifications(c, commentClasses):
+    """ write a batch of (comment id, class) pairs, replacing the classes of comments that were already classified """
     c.executemany("""
     INSERT INTO classified_comments (
       comment_id, classification
-    ) VALUES (%s, %s)""",
+    ) VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE classification=VALUES(classification)""",
       commentClasses)
     c.fetchall()
+
+def getWatermark(db):
+    """ return the comment id up to which every comment has been classified, or None """
+    c = db.cursor()
+    c.execute("""SELECT comment_id FROM classification_watermark WHERE id=1""")
+    rows = c.fetchall()
     c.close()
+    return int(rows[0][0]) if rows and rows[0][0] is not None else None
 
-def main():
-    f = file("comment.classifier", "rb")
+def setWatermark(db, commentId):
+    c = db.cursor()
+    c.execute("""
+    INSERT INTO classification_watermark (id, comment_id) VALUES (1, %s)
+    ON DUPLICATE KEY UPDATE comment_id=VALUES(comment_id)""", (commentId,))
+    c.close()
+
+def clearWatermark(db):
+    c = db.cursor()
+    c.execute("""DELETE FROM classification_watermark WHERE id=1""")
+    c.close()
+
+def classifyComments(db, classifier, commentList=None, batchSize=1000):
+    """ classify all of the comments (or the ones with ids in commentList) in this process, 
+    writing the classes batchSize at a time """
+    createClassifiedCommentsTable(db)
+    c = db.cursor()
+    comments = []
+    for comment in util.iterateAllComments(db, commentList=commentList):
+        comments.append((comment.id, comment.body))
+        if len(comments) >= batchSize:
+            writeClassifications(c, classifyBatch(classifier, comments))
+            comments = []
+    if comments:
+        writeClassifications(c, classifyBatch(classifier, comments))
+    c.close()
+
+def commentPosts(db, commentIds, chunkSize=1000):
+    """ return the ids of the posts of the given comments """
+    c = db.cursor()
+    postIds = set()
+    commentIds = sorted(set(int(commentId) for commentId in commentIds))
+    for start in xrange(0, len(commentIds), chunkSize):
+        c.execute("""SELECT DISTINCT post_id FROM comments WHERE id IN (%s)""" % 
+            ",".join([str(commentId) for commentId in commentIds[start:start + chunkSize]]))
+        postIds.update(int(postId) for (postId,) in c.fetchall())
+    c.close()
+    return postIds
+
+def reclassifyComments(commentIds, database=Config.mySQLdb, classifierFileName="comment.classifier", batchSize=1000):
+    """ classify the comments with the given ids (eg, edited ones) whether or not they were classified before,
+    and update the comment prescoring of their posts. return the number of posts updated """
+    db = util.makeDbConnection(database)
+    classifyComments(db, loadCompiledClassifier(classifierFileName), sorted(set(commentIds)), batchSize)
+    postIds = commentPosts(db, commentIds)
+    if scoring.tableExists(db, scoring.commentPrescoringTable.name):
+        scoring.updateCommentPrescoring(db, postIds)
+    db.close()
+    return len(postIds)
+
+def classifyCommentRange(db, classifier, start, end, batchSize=1000, writeComments=True):
+    """ classify the comments with start <= id < end, writing the classes batchSize at a time unless writeComments is False.
+    return (the number of comments classified, the ids of their posts, the sum of the classes of the comments on each post) """
+    c = db.cursor()
+    c.execute("""SELECT id, post_id, text FROM comments WHERE id >= %s AND id < %s""", (start, end))
+    comments = c.fetchall()
+    if not comments:
+        c.close()
+        return (0, numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64))
+    classes = []
+    for batchStart in xrange(0, len(comments), batchSize):
+        commentClasses = classifyBatch(classifier, [(commentId, text) for (commentId, postId, text) in comments[batchStart:batchStart + batchSize]])
+        if writeComments:
+            writeClassifications(c, commentClasses)
+        classes.extend([commentClass for (commentId, commentClass) in commentClasses])
+    c.close()
+    postIds, postIndex = numpy.unique(numpy.array([postId for (commentId, postId, text) in comments], dtype=numpy.int64), return_inverse=True)
+    return (len(comments), postIds, numpy.bincount(postIndex, weights=classes).astype(numpy.int64))
+
+# the classifier and database connection of a worker process
+_worker = {}
+
+def _initWorker(classifier, database, batchSize, writeComments):
+    _worker["classifier"] = classifier
+    _worker["db"] = util.makeDbConnection(database)
+    _worker["batchSize"] = batchSize
+    _worker["writeComments"] = writeComments
+
+def _classifyRange(idRange):
+    (start, end) = idRange
+    return classifyCommentRange(_worker["db"], _worker["classifier"], start, end, _worker["batchSize"], _worker["writeComments"])
+
+def classifyCommentsParallel(database=Config.mySQLdb, classifierFileName="comment.classifier", nWorkers=None, 
+    rangeSize=20000, batchSize=1000, full=False, writeComments=True):
+    """ classify the comments with nWorkers processes (default: one per core), each with its own connection.
+    Only the comments above the stored watermark are classified, unless full is set or there is no watermark yet,
+    so that a daily run only classifies the new comments. The comment ids are divided into ranges of rangeSize, which 
+    are handed out in order. In an incremental run, the comment_prescoring rows (if the table exists) of the posts of 
+    each range's comments are updated, and then the watermark is moved to the end of the range, once it and every range 
+    before it have finished, so an interrupted run resumes after the last complete range without leaving stale rows 
+    behind. The writes are upserts, so ranges that were partially classified are simply classified again. 
+    A full run sums the classes of each post's comments as the ranges finish, and writes comment_prescoring from 
+    the sums, without joining comments with classified_comments. Its prescoring is only written at the end, so the
+    watermark is cleared when it starts and only set once comment_prescoring is written: an interrupted full run is
+    followed by another full run. With writeComments False, the per-comment classes are not written at all (which 
+    implies a full run), and the watermark stays cleared, so that the next run is full too.
+    return the number of comments classified
+    """
+    nWorkers = nWorkers or multiprocessing.cpu_count()
+    db = util.makeDbConnection(database)
+    createClassifiedCommentsTable(db)
+    c = db.cursor()
+    c.execute("""SELECT MIN(id), MAX(id), MAX(post_id) FROM comments""")
+    minId, maxId, maxPostId = c.fetchall()[0]
+    c.close()
+    watermark = getWatermark(db)
+    incremental = writeComments and not full and watermark is not None
+    if maxId is None or (incremental and watermark >= int(maxId)):
+        db.close()
+        return 0
+    start = watermark + 1 if incremental else int(minId)
+    if incremental:
+        logging.info("classifying the comments from %d" % start)
+    if not incremental:
+        clearWatermark(db)
+    # the sum of the comment classes of each post, and whether it has any comments
+    commentScores = numpy.zeros(int(maxPostId) + 1, dtype=numpy.int64)
+    commented = numpy.zeros(int(maxPostId) + 1, dtype=bool)
+    updatePrescoring = incremental and scoring.tableExists(db, scoring.commentPrescoringTable.name)
+
+    ranges = [(rangeStart, min(rangeStart + rangeSize, int(maxId) + 1)) for rangeStart in xrange(start, int(maxId) + 1, rangeSize)]
+    # compiled once, here, and handed to the workers, which would otherwise all compile and save it at the same time
+    classifier = loadCompiledClassifier(classifierFileName)
+    pool = multiprocessing.Pool(nWorkers, _initWorker, (classifier, database, batchSize, writeComments))
+    pending = collections.deque()
+    nClassified = 0
+    nRanges = 0
+    t = time.time()
+
+    def finishRange():
+        (job, (rangeStart, rangeEnd)) = pending.popleft()
+        (nRangeClassified, postIds, postScores) = job.get()
+        # the post ids of a range are unique
+        commentScores[postIds] += postScores
+        commented[postIds] = True
+        if updatePrescoring:
+            scoring.updateCommentPrescoring(db, postIds)
+        if incremental:
+            setWatermark(db, rangeEnd - 1)
+        return nRangeClassified
+
+    try:
+        for idRange in ranges:
+            if len(pending) >= nWorkers:
+                nClassified += finishRange()
+                nRanges += 1
+            pending.append((pool.apply_async(_classifyRange, (idRange,)), idRange))
+            if nRanges and nRanges % nWorkers == 0:
+                logging.info("%d of %d comment id ranges, %d comments classified (%0.0f/s)" % 
+                    (nRanges, len(ranges), nClassified, nClassified / max(time.time() - t, 1e-6)))
+        while pending:
+            nClassified += finishRange()
+            nRanges += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    logging.info("%d comments classified in %0.1fs" % (nClassified, time.time() - t))
+
+    if not incremental:
+        postIds = numpy.flatnonzero(commented)
+        # the sums can only be recalculated from classified_comments if the classes were written. The mark is set before
+        # sums-only prescoring is written and only removed after full prescoring is, so it is never missing when needed
+        if not writeComments:
+            scoring.setCommentSumsOnly(db, True)
+        scoring.writeCommentPrescoring(db, postIds, commentScores[postIds])
+        logging.info("wrote the comment prescoring of %d posts" % len(postIds))
+        if writeComments:
+            scoring.setCommentSumsOnly(db, False)
+            setWatermark(db, int(maxId))
+    elif updatePrescoring:
+        logging.info("updated the comment prescoring of %d posts" % commented.sum())
+    db.close()
+    return nClassified
+
+def loadClassifier(fileName="comment.classifier"):
+    """ load the trained classifier """
+    f = file(fileName, "rb")
     classifier = pickle.load(f) 
     f.close()
-    db = util.makeDbConnection()
-    classifyComments(db, classifier)
-    db.close()
+    return classifier
+
+# the log probability NLTK uses for feature values never seen with a label
+unseenLogProb = -1e300
+
+class CompiledClassifier(object):
+    """ a trained NLTK NaiveBayesClassifier compiled into dense log probability tables, so that a whole batch
+    of feature bit vectors (see commentFeatureBits) can be classified with a few matrix operations """
+    def __init__(self, labels, priors, logProbs):
+        # labels in increasing order
+        self.labels = labels
+        # log2 P(label)
+        self.priors = priors
+        # (label x feature x value) log2 P(feature=value | label), features in featureOrder, value 0 for False and 1 for True.
+        # features that the classifier has never seen are all 0, because classify() ignores them
+        self.logProbs = logProbs
+
+    @staticmethod
+    def fromClassifier(classifier):
+        labels = sorted(classifier.labels())
+        priors = numpy.array([classifier._label_probdist.logprob(label) for label in labels])
+        logProbs = numpy.zeros((len(labels), len(featureOrder), 2))
+        for (f, featureName) in enumerate(featureOrder):
+            if not any((label, featureName) in classifier._feature_probdist for label in labels):
+                continue
+            for (l, label) in enumerate(labels):
+                probDist = classifier._feature_probdist.get((label, featureName))
+                for (v, value) in enumerate([False, True]):
+                    logProbs[l, f, v] = probDist.logprob(value) if probDist is not None else unseenLogProb
+        return CompiledClassifier(numpy.array(labels), priors, logProbs)
+
+    def logProbabilities(self, features):
+        """ the (unnormalized) log2 probability of each label for a (comments x features) matrix of booleans """
+        features = numpy.asarray(features, dtype=numpy.double)
+        return self.priors + numpy.dot(1.0 - features, self.logProbs[:, :, 0].T) + numpy.dot(features, self.logProbs[:, :, 1].T)
+
+    def classifyMatrix(self, features):
+        """ the most probable label for each row of a (comments x features) matrix of booleans """
+        logProbs = self.logProbabilities(features)
+        # ties go to the largest label, like NLTK's DictionaryProbDist.max()
+        return self.labels[logProbs.shape[1] - 1 - numpy.argmax(logProbs[:, ::-1], axis=1)]
+
+    def classifyBits(self, bitVectors):
+        """ the most probable label for each of a list of commentFeatureBits bit vectors """
+        return self.classifyMatrix(featureMatrix(bitVectors))
+
+    def save(self, fileName):
+        """ save the tables to fileName, which may also be an open file """
+        numpy.savez(fileName, labels=self.labels, priors=self.priors, logProbs=self.logProbs, featureOrder=numpy.array(featureOrder))
+
+    @staticmethod
+    def load(fileName):
+        arrays = numpy.load(fileName)
+        if list(arrays["featureOrder"]) != featureOrder:
+            raise ValueError("%s was compiled for different features" % fileName)
+        return CompiledClassifier(arrays["labels"], arrays["priors"], arrays["logProbs"])
+
+def featureMatrix(bitVectors):
+    """ convert a list of commentFeatureBits bit vectors into a (comments x features) matrix of booleans """
+    bitVectors = numpy.asarray(bitVectors, dtype=numpy.int64).reshape(-1, 1)
+    return (bitVectors >> numpy.arange(len(featureOrder))) & 1 == 1
+
+def loadCompiledClassifier(fileName="comment.classifier"):
+    """ load the trained classifier compiled into a CompiledClassifier. It is compiled and saved 
+    to fileName.npz the first time """
+    if os.path.isfile(fileName + ".npz") and os.path.getmtime(fileName + ".npz") >= os.path.getmtime(fileName):
+        return CompiledClassifier.load(fileName + ".npz")
+    compiled = CompiledClassifier.fromClassifier(loadClassifier(fileName))
+    # written under another name and renamed into place, so that nothing ever loads a partly written file
+    temporaryFileName = "%s.npz.%d.tmp" % (fileName, os.getpid())
+    with open(temporaryFileName, "wb") as f:
+        compiled.save(f)
+    os.rename(temporaryFileName, fileName + ".npz")
+    return compiled
+
+def classifyBatch(classifier, comments):
+    """ classify a list of (comment id, text) with either an NLTK classifier or a CompiledClassifier.
+    return a list of (comment id, class) """
+    if isinstance(classifier, CompiledClassifier):
+        labels = classifier.classifyBits([commentFeatureBits(text) for (commentId, text) in comments])
+        return [(commentId, int(label)) for ((commentId, text), label) in zip(comments, labels)]
+    return [(commentId, classifier.classify(fastCommentFeatures(text))) for (commentId, text) in comments]
+
+def compiledClassifierMismatches(db, classifier, compiled):
+    """ classify the whole training set with the NLTK classifier and the compiled one;
+    return a list of (training id, NLTK class, compiled class) where they disagree """
+    trainingIds = commentClasses(db).keys()
+    texts = [comment.body for comment in iterateCommentsFromTrainingList(db, trainingIds)]
+    labels = [classifier.classify(commentFeatures(text)) for text in texts]
+    compiledLabels = compiled.classifyBits([commentFeatureBits(text) for text in texts])
+    return [(trainingId, label, int(compiledLabel)) 
+        for (trainingId, label, compiledLabel) in zip(trainingIds, labels, compiledLabels) if label != compiledLabel]
+
+def main():
+    """ classify the new comments, using the number of worker processes given as the first argument (default: one per core);
+    comment_classification.py full [nWorkers] reclassifies all of them,
+    comment_classification.py sums [nWorkers] reclassifies all of them, but only writes comment_prescoring. 
+    Because the class of each comment is not stored, comment_prescoring cannot be recalculated from classified_comments
+    afterwards: scoring.py refresh and update, and reclassifying comments by id, leave it alone (with a warning) until 
+    the next full run, and the next plain run is a full run,
+    comment_classification.py ids MANIFEST reclassifies the comments listed in a file, one id per line, and
+    comment_classification.py check compares the compiled classifier with the NLTK one on the training set """
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        db = util.makeDbConnection()
+        mismatches = compiledClassifierMismatches(db, loadClassifier(), loadCompiledClassifier())
+        db.close()
+        print "%d mismatches" % len(mismatches)
+        for mismatch in mismatches:
+            print "training id %d: NLTK class %d, compiled class %d" % mismatch
+        sys.exit(1 if mismatches else 0)
+    if len(sys.argv) > 2 and sys.argv[1] == "ids":
+        nPosts = reclassifyComments(scoring.readManifest(sys.argv[2]))
+        print >>sys.stderr, "Updated the comment prescoring of %d posts" % nPosts
+        return
+    full = len(sys.argv) > 1 and sys.argv[1] in ("full", "sums")
+    arguments = sys.argv[2:] if full else sys.argv[1:]
+    nWorkers = int(arguments[0]) if arguments else None
+    classifyCommentsParallel(nWorkers=nWorkers, full=full, writeComments=sys.argv[1] != "sums" if full else True)
 
 if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
     main()
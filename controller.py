@@ -11,39 +11,235 @@ import flask
 import urllib
 import random
 import json
+import functools
+import hmac
 import topic_classification
 import util
 import scoring
+import pipeline
+import generations
+import user_index
+import metrics
 import logging
 from config import Config
 
-corpus = Config.corpusName
 resultCutoff = 0.5         # use most of the posts unless it's deemed very irrelevant
 percentileCutoff=75
+# the most experts to show for a query
+maxExperts = getattr(Config, "maxExperts", 50)
 database = Config.mySQLdb
-topicModel = topic_classification.TopicModeling(corpus)
+# the live generation of the corpora set in config.py (or just corpusName); queries are routed to them by tag or by name,
+# and a new generation can be swapped in without a restart (see generations.py)
+generationManager = generations.fromConfig()
+metrics.collectors.append(generationManager.metricLines)
+if getattr(Config, "indexDirectory", None) and getattr(Config, "generationWatchInterval", None):
+    generationManager.watch(Config.generationWatchInterval)
+connectionPool = util.ConnectionPool(
+    database, 
+    maxSize=getattr(Config, "poolSize", 5), 
+    maxOverflow=getattr(Config, "poolOverflow", 10),
+    timeout=getattr(Config, "poolTimeout", 30.0))
+if getattr(Config, "answerFeatureDirectory", None):
+    featureStore = scoring.AnswerFeatureStore(Config.answerFeatureDirectory)
+else:
+    featureStore = None
+# the topic model is passed with each query, so that the pipeline does not hold on to old generations
+queryPipeline = pipeline.QueryPipeline(
+    None, 
+    connectionPool, 
+    nThreads=getattr(Config, "pipelineThreads", 8), 
+    resultCutoff=resultCutoff, 
+    cutoffPercentile=percentileCutoff,
+    featureStore=featureStore,
+    maxExperts=maxExperts)
 
 app = flask.Flask(__name__)
 
+# requests carrying this header get their per-stage timings back in the same header
+traceHeader = "X-Expert-Trace"
+
+def poolMetrics():
+    """ connection pool gauges and counters for /metrics """
+    stats = connectionPool.stats()
+    return [
+        "# TYPE expert_db_pool_connections gauge",
+        'expert_db_pool_connections{state="open"} %d' % stats["open"],
+        'expert_db_pool_connections{state="idle"} %d' % stats["idle"],
+        "# TYPE expert_db_pool_checkouts_total counter",
+        "expert_db_pool_checkouts_total %d" % stats["checkouts"],
+        "# TYPE expert_db_pool_checkout_seconds_max gauge",
+        "expert_db_pool_checkout_seconds_max %f" % stats["maxCheckoutTime"],
+        "# TYPE expert_db_pool_checkout_seconds_sum counter",
+        "expert_db_pool_checkout_seconds_sum %f" % (stats["meanCheckoutTime"] * stats["checkouts"]),
+        "# TYPE expert_db_pool_timeouts_total counter",
+        "expert_db_pool_timeouts_total %d" % stats["checkoutTimeouts"]
+    ]
+metrics.collectors.append(poolMetrics)
+
+@app.before_request
+def beginRequest():
+    metrics.requests.inc(flask.request.endpoint or "unknown")
+    if traceHeader in flask.request.headers:
+        metrics.startTrace()
+
+@app.after_request
+def endRequest(response):
+    trace = metrics.endTrace()
+    if trace is not None:
+        response.headers[traceHeader] = trace.header()
+    return response
+
+# the admin endpoints answer requests carrying this token in the X-Admin-Token header; without a token, only local requests
+adminToken = getattr(Config, "adminToken", None)
+localAddresses = frozenset(["127.0.0.1", "::1"])
+
+def adminOnly(view):
+    """ decorator for endpoints that change server state: requests without the admin token (or, if there is none,
+    from another host) get a 403 """
+    @functools.wraps(view)
+    def checked(*args, **kwargs):
+        if adminToken:
+            allowed = hmac.compare_digest(str(flask.request.headers.get("X-Admin-Token", "")), str(adminToken))
+        else:
+            allowed = flask.request.remote_addr in localAddresses
+        if not allowed:
+            logging.warning("refused %s from %s" % (flask.request.path, flask.request.remote_addr))
+            flask.abort(403)
+        return view(*args, **kwargs)
+    return checked
+
+def displayNames(userIds):
+    """ user id -> display name for a list of user ids """
+    if featureStore is not None:
+        return {userId : featureStore.displayName(userId) for userId in userIds}
+    with connectionPool.connection() as db:
+        return scoring.displayNamesById(db, userIds)
+
+def listParameter(name):
+    """ the values of a request parameter that may be repeated or separated by spaces or commas """
+    return [value for parameter in flask.request.args.getlist(name) for value in parameter.replace(",", " ").split()]
+
 @app.route("/", methods=["GET"])
 def root():
     query = flask.request.args.get("q", "")
-    logging.debug("query=%s" % query)
-    postResults  = []
-    userResults = []
-    if query:
-        logging.debug("connecting to the database...")
-        db = util.makeDbConnection(database)
-        logging.debug("querying the topic model...")
-        postResults = topicModel.queryResults(db, query, resultCutoff)
-	logging.debug("%d results returned..." % len(postResults))
-        if postResults is not None:
-            logging.debug("scoring users..." ) 
-            userResults = scoring.scoreUsers(db, query, postResults, topicModel, cutoffPercentile=percentileCutoff, resultCutoff=resultCutoff)
-	    logging.debug("star-scoring users...")
+    # mode=experts looks the experts up directly in the user index, without the matching posts
+    mode = flask.request.args.get("mode", "")
+    # restrict the search to posts with any (tagmode=any) or all (tagmode=all) of the tags,
+    # given as repeated tag parameters or separated by spaces or commas
+    tags = listParameter("tag")
+    tagMode = flask.request.args.get("tagmode", "any")
+    # the corpora to search, given like the tags; by default, the ones covering the tags, or else all of them
+    corpora = listParameter("corpus")
+    with generationManager.use() as generation:
+        registry = generation.registry
+        topicModel = registry.defaultModel()
+        # user expertise vectors in the same generation's LSI space, for the direct "top experts" mode
+        userIndex = generation.userIndex
+        model = registry.group(corpora, tags)
+        if model.tagIndex is None:
+            tags = []
+        logging.debug("query=%s mode=%s tags=%s (%s) corpora=%s generation=%s" % (query, mode, tags, tagMode, corpora, generation.name))
+        postResults  = []
+        userResults = []
+        # the user index doesn't know which posts made the experts, so tag-filtered searches go through the posts
+        if query and mode == "experts" and userIndex is not None and not tags and model is topicModel:
+            userResults = user_index.findExperts(userIndex, topicModel, query, displayNames, maxExperts)
+            userResults = [userResult.starScore(cutoffPercentile=percentileCutoff, nStars=5) for userResult in userResults]
+        elif query:
+            postResults, userResults = queryPipeline.run(query, tags, tagMode == "all", model)
+            logging.debug("star-scoring users...")
             userResults = [userResult.starScore(cutoffPercentile=percentileCutoff, nStars=5) for userResult in userResults]
-        db.close()
-    return flask.render_template("experts.html", query=query, users=userResults, posts=postResults)
+        tagFilter = any([m.tagIndex is not None for m in registry.models.values()])
+        corpusNames = registry.names()
+    with metrics.stage("render"):
+        return flask.render_template("experts.html", query=query, mode=mode, users=userResults, posts=postResults,
+            tags=" ".join(tags), tagMode=tagMode, tagFilter=tagFilter, corpus=" ".join(corpora), corpora=corpusNames)
+
+def userScoreJson(userScore):
+    """ convert a star-scored UserScore into a JSON-serializable dictionary """
+    return {
+        "userId" : int(userScore.userId),
+        "user" : userScore.user,
+        "score" : float(userScore.score),
+        "meanRelevance" : float(userScore.meanRelevance),
+        "percentileRank" : float(userScore.percentileRank),
+        "stars" : userScore.stars,
+        "nPosts" : userScore.nPosts,
+        "posts" : [
+            {
+                "questionId" : int(postId.questionId),
+                "answerId" : int(postId.answerId),
+                "title" : postId.title
+            } for postId in userScore.postIds]
+    }
+
+def queryResultJson(queryResult):
+    """ convert a QueryResult into a JSON-serializable dictionary """
+    return {
+        "id" : queryResult.id,
+        "title" : queryResult.post.title,
+        "similarity" : float(queryResult.similarity)
+    }
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    """ find experts for many queries in one request. 
+    POST {"queries" : [...]}; results are returned in the same order as the queries.
+    The queries go to the corpora listed in "corpora", or else to the ones covering any of the "tags", or else to all of them.
+    """
+    request = flask.request.json or {}
+    for name in ("queries", "corpora", "tags"):
+        value = request.get(name)
+        if value is not None and not (isinstance(value, list) and all([isinstance(item, basestring) for item in value])):
+            response = flask.jsonify(error="%s must be a list of strings" % name)
+            response.status_code = 400
+            return response
+    queries = request.get("queries", [])
+    logging.debug("batch of %d queries" % len(queries))
+    results = []
+    if queries:
+        with generationManager.use() as generation, connectionPool.connection() as db:
+            model = generation.registry.group(request.get("corpora"), request.get("tags"))
+            results = scoring.findExpertsBatch(db, model, queries, resultCutoff=resultCutoff, cutoffPercentile=percentileCutoff, nStars=5, featureStore=featureStore, topN=maxExperts)
+    return flask.jsonify(results=[
+        {
+            "query" : query,
+            "users" : [userScoreJson(userScore) for userScore in userScores],
+            "posts" : [queryResultJson(queryResult) for queryResult in queryResults]
+        } for (query, (queryResults, userScores)) in zip(queries, results)])
+
+@app.route("/metrics", methods=["GET"])
+def metricsPage():
+    """ stage latency histograms and request counters in the Prometheus text format """
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/pool", methods=["GET"])
+def pool():
+    """ report connection pool usage and checkout latency """
+    return flask.jsonify(**connectionPool.stats())
+
+@app.route("/admin/refresh-closed", methods=["POST"])
+@adminOnly
+def refreshClosed():
+    """ reload the closed/deleted post bitmaps of every corpus from the database """
+    with generationManager.use() as generation, connectionPool.connection() as db:
+        deadByCorpus = [model.refreshDeadDocuments(db) for model in generation.registry.models.values()]
+    return flask.jsonify(documents=sum([len(dead) for dead in deadByCorpus]), dead=sum([int(dead.sum()) for dead in deadByCorpus]))
+
+@app.route("/admin/reload", methods=["POST"])
+@adminOnly
+def reloadGeneration():
+    """ load a new index generation in the background and swap it in if it passes the smoke queries.
+    The generation may be given as a generation parameter; by default, it is the one named in indexDirectory/CURRENT """
+    started = generationManager.reload(flask.request.values.get("generation") or None)
+    response = flask.jsonify(started=started, **generationManager.status())
+    response.status_code = 202 if started else 409
+    return response
+
+@app.route("/admin/generation", methods=["GET"])
+def generationStatus():
+    """ report the live generation, any generation being loaded and old ones that are still draining """
+    return flask.jsonify(**generationManager.status())
 
 @app.route("/about", methods=["GET"])
 def about():
@@ -55,4 +251,4 @@ def me():
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.DEBUG)
-    app.run(host=Config.host, debug=Config.debug, port=Config.port)
+    app.run(host=Config.host, debug=Config.debug, port=Config.port, threaded=True)
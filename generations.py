@@ -0,0 +1,230 @@
+'''
+Hot swapping of index generations.
+
+Rebuilding the index writes a complete new set of corpus files (.index, .lsi, .dict, .c2p, .users.npz and the rest). To serve
+it without a restart, each build goes into its own generation directory under indexDirectory (set in config.py),
+eg, indexDirectory/20121001/CORPUSNAME.index, and the name of the live generation is written to the CURRENT file
+in indexDirectory. The controller then loads the named generation in a background thread, either when asked to
+(POST /admin/reload) or when a watcher thread sees CURRENT change, runs smoke queries against it, and only if they
+pass makes it the live generation. Requests that started on the old generation finish on it; its models are
+released when the last of them is done.
+
+Without indexDirectory, the corpus files are loaded from where corpusName (or corpora) points, and a reload
+loads them again from there.
+
+@author: efeins
+'''
+import os
+import time
+import gc
+import logging
+import threading
+from contextlib import contextmanager
+
+from config import Config
+import model_registry
+import user_index
+
+# the file in indexDirectory naming the live generation
+currentFileName = "CURRENT"
+# queries that every corpus of a new generation has to answer before it is swapped in
+defaultSmokeQueries = ["how to sort a list", "string formatting", "database connection"]
+
+class GenerationError(Exception):
+    """ a generation could not be loaded or failed validation """
+    pass
+
+class Generation(object):
+    """ one loaded set of topic models, with the user index of the default corpus (None if it has none)
+    and a count of the requests using it """
+    def __init__(self, name, registry, userIndex=None):
+        self.name = name
+        self.registry = registry
+        self.userIndex = userIndex
+        self.loadedAt = time.time()
+        self.inFlight = 0
+        self.retired = False
+
+def currentGenerationName(indexDirectory):
+    """ the name of the live generation, from the CURRENT file, or None if there is no index directory """
+    if not indexDirectory:
+        return None
+    with open(os.path.join(indexDirectory, currentFileName)) as f:
+        return f.read().strip()
+
+def loadGeneration(name, indexDirectory=None):
+    """ load the topic models of a generation: the corpora of config.py, from indexDirectory/name if there is an index
+    directory """
+    directory = os.path.join(indexDirectory, name) if indexDirectory else None
+    if directory is not None and not os.path.isdir(directory):
+        raise GenerationError("no generation directory %s" % directory)
+    registry = model_registry.ModelRegistry.fromConfig(directory)
+    # the user vectors are in the LSI space of the default corpus, so they belong to the generation
+    userIndexFileName = registry.defaultModel().corpusName + ".users.npz"
+    userIndex = user_index.UserIndex.load(userIndexFileName) if os.path.isfile(userIndexFileName) else None
+    return Generation(name, registry, userIndex)
+
+def userIndexMismatch(generation):
+    """ why the user index of a generation does not fit its default corpus's LSI space, or None if it does (or there is none) """
+    if generation.userIndex is None:
+        return None
+    numTopics = generation.registry.defaultModel().lsi.num_topics
+    if generation.userIndex.numTopics != numTopics:
+        return "the user index has %d topics, but the LSI of the default corpus has %d" % (generation.userIndex.numTopics, numTopics)
+    return None
+
+def validateGeneration(generation, smokeQueries=defaultSmokeQueries):
+    """ check that the parts of every corpus agree in size and that the smoke queries run; raise GenerationError if not """
+    nMatches = 0
+    for (name, model) in generation.registry.models.items():
+        nDocs = len(model.docToPost)
+        sizes = [("index", len(model.index))]
+        if model.metadata is not None:
+            sizes.append(("metadata", len(model.metadata)))
+        if model.dead is not None:
+            sizes.append(("closed/deleted bitmap", len(model.dead)))
+        if model.tagIndex is not None:
+            sizes.append(("tag index", model.tagIndex.nDocs))
+        if model.ldaDocuments is not None:
+            sizes.append(("LDA document topics", len(model.ldaDocuments)))
+        for (part, size) in sizes:
+            if size != nDocs:
+                raise GenerationError("corpus %s: the %s has %d documents, but the corpus has %d" % (name, part, size, nDocs))
+        try:
+            nMatches += sum([len(matches) for matches in model.similarityQueries(smokeQueries)])
+        except Exception, e:
+            raise GenerationError("corpus %s: smoke queries failed: %s" % (name, e))
+    if smokeQueries and not nMatches:
+        raise GenerationError("none of the smoke queries matched anything")
+    mismatch = userIndexMismatch(generation)
+    if mismatch:
+        raise GenerationError(mismatch)
+
+class GenerationManager(object):
+    """ the live generation, and the loading of new ones in the background """
+    def __init__(self, indexDirectory=None, smokeQueries=defaultSmokeQueries):
+        self.indexDirectory = indexDirectory
+        self.smokeQueries = smokeQueries
+        self._lock = threading.Lock()
+        self._loading = None        # the name of the generation being loaded
+        self.lastError = None
+        self.current = loadGeneration(currentGenerationName(indexDirectory) or "initial", indexDirectory)
+        mismatch = userIndexMismatch(self.current)
+        if mismatch:
+            # the server still starts, without the direct experts mode
+            logging.warning("%s: the user index is not used" % mismatch)
+            self.current.userIndex = None
+        self._currentMtime = self._pointerMtime()
+        self._retired = []          # old generations with requests still in flight
+
+    def _pointerMtime(self):
+        if not self.indexDirectory:
+            return None
+        try:
+            return os.path.getmtime(os.path.join(self.indexDirectory, currentFileName))
+        except OSError:
+            return None
+
+    @contextmanager
+    def use(self):
+        """ use the live generation for the duration of a with block (a request); it is not released before the block ends """
+        with self._lock:
+            generation = self.current
+            generation.inFlight += 1
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                generation.inFlight -= 1
+                drained = generation.retired and generation.inFlight == 0
+            if drained:
+                self._release(generation)
+
+    def _release(self, generation):
+        with self._lock:
+            if generation not in self._retired:
+                return
+            self._retired.remove(generation)
+        generation.registry = None
+        generation.userIndex = None
+        gc.collect()
+        logging.info("released generation %s" % generation.name)
+
+    def swap(self, generation):
+        """ make a (validated) generation the live one; the old one is released once its requests are done """
+        with self._lock:
+            old = self.current
+            self.current = generation
+            old.retired = True
+            self._retired.append(old)
+            drained = old.inFlight == 0
+        logging.info("generation %s is live (was %s)" % (generation.name, old.name))
+        if drained:
+            self._release(old)
+
+    def reload(self, name=None):
+        """ load, validate and swap in a generation (by default, the one named in CURRENT) in a background thread.
+        return False if a load is already in progress """
+        with self._lock:
+            if self._loading is not None:
+                return False
+            name = name or currentGenerationName(self.indexDirectory) or self.current.name
+            self._loading = name
+        thread = threading.Thread(target=self._load, args=(name,), name="generation-loader")
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _load(self, name):
+        t = time.time()
+        try:
+            logging.info("loading generation %s..." % name)
+            generation = loadGeneration(name, self.indexDirectory)
+            validateGeneration(generation, self.smokeQueries)
+            self.swap(generation)
+            self.lastError = None
+            logging.info("generation %s loaded and validated in %0.1fs" % (name, time.time() - t))
+        except Exception, e:
+            self.lastError = "%s: %s" % (name, e)
+            logging.exception("generation %s was not swapped in" % name)
+        finally:
+            with self._lock:
+                self._loading = None
+
+    def watch(self, interval=10.0):
+        """ start a thread that reloads whenever the CURRENT file changes, checking every interval seconds """
+        def poll():
+            while True:
+                time.sleep(interval)
+                mtime = self._pointerMtime()
+                # if a load is in progress, try again next time
+                if mtime is not None and mtime != self._currentMtime and self.reload():
+                    self._currentMtime = mtime
+        thread = threading.Thread(target=poll, name="generation-watcher")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def status(self):
+        """ the live generation, the one being loaded, the old ones still draining and the last load error """
+        with self._lock:
+            return {
+                "current" : self.current.name,
+                "loadedAt" : self.current.loadedAt,
+                "inFlight" : self.current.inFlight,
+                "loading" : self._loading,
+                "draining" : [{"generation" : generation.name, "inFlight" : generation.inFlight} for generation in self._retired],
+                "lastError" : self.lastError
+            }
+
+    def metricLines(self):
+        """ gauges of the requests in flight on each generation, for /metrics """
+        status = self.status()
+        lines = ["# TYPE expert_generation_requests_in_flight gauge",
+            'expert_generation_requests_in_flight{generation="%s",state="live"} %d' % (status["current"], status["inFlight"])]
+        for draining in status["draining"]:
+            lines.append('expert_generation_requests_in_flight{generation="%s",state="draining"} %d' % (draining["generation"], draining["inFlight"]))
+        return lines
+
+def fromConfig():
+    return GenerationManager(getattr(Config, "indexDirectory", None), getattr(Config, "smokeQueries", defaultSmokeQueries))
@@ -0,0 +1,137 @@
+'''
+Latency metrics for the query pipeline.
+
+Each stage of answering a query (tokenizing, LSI projection, the index scan, database lookups, scoring, rendering)
+is timed with stage() or the timed() decorator. The timings are collected in histograms that are rendered in the
+Prometheus text format by render(), and, if a trace has been started for the current request, recorded in the trace
+as well so that a single request can be broken down by stage.
+
+@author: efeins
+'''
+import threading
+import time
+import bisect
+import functools
+from contextlib import contextmanager
+
+# histogram bucket upper bounds, in seconds
+defaultBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram(object):
+    """ a Prometheus-style histogram with one set of buckets per label value """
+    def __init__(self, name, help, label, buckets=defaultBuckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = {}       # label value -> [count per bucket] + [count in +Inf]
+        self._sums = {}
+
+    def observe(self, labelValue, value):
+        with self._lock:
+            if labelValue not in self._counts:
+                self._counts[labelValue] = [0] * (len(self.buckets) + 1)
+                self._sums[labelValue] = 0.0
+            self._counts[labelValue][bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[labelValue] += value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            for labelValue in sorted(self._counts):
+                cumulative = 0
+                for (bound, count) in zip(self.buckets + ("+Inf",), self._counts[labelValue]):
+                    cumulative += count
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (self.name, self.label, labelValue, bound, cumulative))
+                lines.append('%s_sum{%s="%s"} %f' % (self.name, self.label, labelValue, self._sums[labelValue]))
+                lines.append('%s_count{%s="%s"} %d' % (self.name, self.label, labelValue, cumulative))
+        return lines
+
+class Counter(object):
+    """ a Prometheus-style counter with one value per label value """
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, labelValue, amount=1):
+        with self._lock:
+            self._values[labelValue] = self._values.get(labelValue, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self._lock:
+            for labelValue in sorted(self._values):
+                lines.append('%s{%s="%s"} %s' % (self.name, self.label, labelValue, self._values[labelValue]))
+        return lines
+
+class Trace(object):
+    """ the stage timings of one request, in the order the stages finished """
+    def __init__(self):
+        self.start = time.time()
+        self.stages = []
+
+    def add(self, stageName, seconds):
+        self.stages.append((stageName, seconds))
+
+    def header(self):
+        """ format the trace as stage=milliseconds pairs, suitable for an HTTP header """
+        return ", ".join(["%s=%0.1fms" % (stageName, seconds * 1000.0) for (stageName, seconds) in self.stages] +
+            ["total=%0.1fms" % ((time.time() - self.start) * 1000.0)])
+
+stageSeconds = Histogram("expert_stage_seconds", "Time spent in each stage of answering a query", "stage")
+requests = Counter("expert_requests_total", "Requests handled, by route", "route")
+# functions returning extra lines of metrics text, eg, gauges from the connection pool
+collectors = []
+_local = threading.local()
+
+def startTrace():
+    """ start recording a trace of the stages run by the current thread """
+    _local.trace = Trace()
+    return _local.trace
+
+def currentTrace():
+    return getattr(_local, "trace", None)
+
+def bindTrace(trace):
+    """ record the stages run by the current thread into trace (which may be None);
+    used to carry a request's trace into worker threads """
+    _local.trace = trace
+
+def endTrace():
+    trace = currentTrace()
+    _local.trace = None
+    return trace
+
+@contextmanager
+def stage(stageName):
+    """ time the body of a with block as stageName """
+    t = time.time()
+    try:
+        yield
+    finally:
+        dt = time.time() - t
+        stageSeconds.observe(stageName, dt)
+        trace = currentTrace()
+        if trace is not None:
+            trace.add(stageName, dt)
+
+def timed(stageName):
+    """ decorator to time every call of a function as stageName """
+    def decorator(function):
+        @functools.wraps(function)
+        def timedFunction(*args, **kwargs):
+            with stage(stageName):
+                return function(*args, **kwargs)
+        return timedFunction
+    return decorator
+
+def render():
+    """ return all of the metrics in the Prometheus text format """
+    lines = stageSeconds.render() + requests.render()
+    for collector in collectors:
+        lines += collector()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,147 @@
+'''
+Several topic models (corpora) served from one process.
+
+A single index over every post takes more memory than one machine has, so the posts can be partitioned into corpora,
+eg, one per technology area, each indexed separately by topic_classification.py. The registry loads all of them
+and routes each query to one or more corpora: the ones named in the request, or else the ones covering the query's 
+tags, or else all of them. Each corpus built this way grows its own dictionary, so every corpus has its own copy in 
+memory; only byte-identical dictionary files (eg, the same corpus files listed under two names) are loaded once.
+
+Similarities from different LSI spaces are not on the same scale, so when a query goes to several corpora, each
+corpus's similarities are divided by its best match for the query before the matches are merged. A post that is in
+more than one of the corpora keeps its best (normalized) similarity.
+
+The corpora are set in config.py as
+corpora = [("name", "corpus_name", ["tag", ...]), ...]
+If it is not set, the only corpus is corpusName, which is used for every query.
+
+@author: efeins
+'''
+import os
+import logging
+import hashlib
+import collections
+import numpy
+import gensim
+
+from config import Config
+import topic_classification
+
+def fileDigest(fileName, blockSize=1 << 20):
+    """ the SHA-1 digest of a file's contents """
+    digest = hashlib.sha1()
+    with open(fileName, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class CorpusGroup(topic_classification.PostQueries):
+    """ several topic models queried as one: similarity queries go to every model and the matches are merged
+    on a normalized similarity scale. The corpus id of each match is a (model number, corpus document id) pair. """
+    def __init__(self, models):
+        self.models = models
+
+    @property
+    def metadata(self):
+        """ the metadata stores of the models, or None unless every model has one """
+        if any([model.metadata is None for model in self.models]):
+            return None
+        return [model.metadata for model in self.models]
+
+    @property
+    def tagIndex(self):
+        """ the tag indexes of the models, or None if none of them has one """
+        tagIndexes = [model.tagIndex for model in self.models]
+        return tagIndexes if any([tagIndex is not None for tagIndex in tagIndexes]) else None
+
+    def similarityQueries(self, queries, cutoff=0, tags=None, matchAll=False):
+        """ perform similarity queries against every model, with the similarities of each model divided by its
+        best match for the query. Tags only filter the models that have a tag index.
+        return a list of similarityQuery results, one per query """
+        merged = [{} for query in queries]
+        for (modelNumber, model) in enumerate(self.models):
+            modelTags = tags if model.tagIndex is not None else None
+            for (matches, bestMatches) in zip(model.similarityQueries(queries, cutoff, modelTags, matchAll), merged):
+                if not matches or matches[0][1] <= 0:
+                    continue
+                # most similar first
+                scale = 1.0 / matches[0][1]
+                for (postId, similarity, corpusDoc) in matches:
+                    similarity *= scale
+                    if postId not in bestMatches or similarity > bestMatches[postId][0]:
+                        bestMatches[postId] = (similarity, (modelNumber, corpusDoc))
+        return [sorted([(postId, similarity, corpusDoc) for (postId, (similarity, corpusDoc)) in bestMatches.iteritems()],
+            key=lambda match: (-match[1], match[0])) for bestMatches in merged]
+
+    def resultsFromMetadata(self, matchingPosts):
+        """ convert merged matches into QueryResults from the metadata stores of their models """
+        return [topic_classification.QueryResult(None, similarity, post=self.models[modelNumber].metadata.summary(corpusDoc))
+            for (postId, similarity, (modelNumber, corpusDoc)) in matchingPosts]
+
+    def answerRelevance(self, query, answerIds):
+        """ the similarity of each answer to the query, from the answer vectors of the model that has the answer.
+        Answers without a vector get 1.0 """
+        answerIds = numpy.asarray(answerIds, dtype=numpy.int64)
+        relevance = numpy.ones(len(answerIds))
+        for model in self.models:
+            if model.answerVectors is None:
+                continue
+            rows, known = model.answerVectors.lookup(answerIds)
+            if known.any():
+                relevance[known] = model.answerRelevance(query, answerIds[known])
+        return relevance
+
+class ModelRegistry(object):
+    """ the topic models of several named corpora """
+    def __init__(self, corpora):
+        """ corpora is a list of (name, corpus file name, list of tags covered by the corpus) """
+        self.models = collections.OrderedDict()
+        self.tags = {}
+        # dictionary file digest -> loaded dictionary
+        dictionaries = {}
+        for (name, corpusName, tags) in corpora:
+            digest = fileDigest(corpusName + ".dict")
+            if digest not in dictionaries:
+                dictionaries[digest] = gensim.corpora.Dictionary.load(corpusName + ".dict")
+            else:
+                logging.info("%s shares its dictionary with another corpus" % name)
+            logging.info("loading corpus %s (%s)..." % (name, corpusName))
+            self.models[name] = topic_classification.TopicModeling(corpusName, dictionaries[digest])
+            self.tags[name] = frozenset(tags)
+        if not self.models:
+            raise ValueError("no corpora to load")
+
+    @staticmethod
+    def fromConfig(directory=None):
+        """ the corpora of config.py; with a directory, their files are loaded from it instead (see generations.py) """
+        corpora = getattr(Config, "corpora", None) or [("default", Config.corpusName, [])]
+        if directory is not None:
+            corpora = [(name, os.path.join(directory, os.path.basename(corpusName)), tags) for (name, corpusName, tags) in corpora]
+        return ModelRegistry(corpora)
+
+    def __len__(self):
+        return len(self.models)
+
+    def names(self):
+        return self.models.keys()
+
+    def defaultModel(self):
+        """ the first corpus, which is used for anything that is not routed (eg, the user index) """
+        return self.models.values()[0]
+
+    def route(self, names=None, tags=None):
+        """ the names of the corpora for a query: the known ones of names, if any, or else the ones covering any of
+        the tags, or else all of them """
+        names = [name for name in (names or []) if name in self.models]
+        if names:
+            return names
+        tags = frozenset(tags or [])
+        names = [name for name in self.models if self.tags[name] & tags]
+        return names or self.names()
+
+    def group(self, names=None, tags=None):
+        """ the model to query for a route: a single TopicModeling, or a CorpusGroup of several """
+        routed = self.route(names, tags)
+        if len(routed) == 1:
+            return self.models[routed[0]]
+        return CorpusGroup([self.models[name] for name in routed])
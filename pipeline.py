@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''
+Concurrent query pipeline for the web controller.
+
+Answering a query is a chain of stages: the (CPU-bound) index scan, fetching the matching posts and their answers,
+and then looking up the answer prescores, comment sentiment and the display names of the answerers. Once the
+question ids are known, the post and answer fetches are independent of each other, and once the answer ids are known,
+the three lookups are independent too. The pipeline runs the independent stages on a thread pool, each with its
+own connection borrowed from a util.ConnectionPool, so that the database round trips overlap each other and
+the CPU work of concurrent requests.
+
+@author: efeins
+'''
+import logging
+from multiprocessing.pool import ThreadPool
+import functools
+import numpy
+
+import scoring
+import metrics
+
+class QueryPipeline(object):
+    """ run expert queries with the independent database lookups in parallel """
+    def __init__(self, topicModel, connectionPool, nThreads=8, resultCutoff=0.5, cutoffPercentile=75, featureStore=None, maxExperts=None):
+        self.topicModel = topicModel
+        self.connectionPool = connectionPool
+        # an optional scoring.AnswerFeatureStore, which replaces the answer and scoring lookups
+        self.featureStore = featureStore
+        self.resultCutoff = resultCutoff
+        self.cutoffPercentile = cutoffPercentile
+        # only the best maxExperts users are returned (all of them if it is None)
+        self.maxExperts = maxExperts
+        self.threads = ThreadPool(nThreads)
+
+    def submit(self, function, *args):
+        """ run function(db, *args) on the thread pool with a pooled connection; return an AsyncResult """
+        trace = metrics.currentTrace()
+        def withConnection():
+            metrics.bindTrace(trace)
+            try:
+                with self.connectionPool.connection() as db:
+                    return function(db, *args)
+            finally:
+                metrics.bindTrace(None)
+        return self.threads.apply_async(withConnection)
+
+    def run(self, query, tags=None, matchAll=False, topicModel=None):
+        """ return (query results, user scores) for a query, optionally restricted to posts with any (or all) of tags.
+        topicModel (eg, a model_registry.CorpusGroup) replaces the pipeline's own topic model for this query """
+        topicModel = topicModel or self.topicModel
+        logging.debug("querying the topic model...")
+        matchingPosts = topicModel.similarityQuery(query, self.resultCutoff, tags, matchAll)
+        if not matchingPosts:
+            return ([], [])
+        answerRelevance = functools.partial(topicModel.answerRelevance, query)
+        if topicModel.metadata is not None and self.featureStore is not None:
+            # everything is in memory
+            queryResults = topicModel.resultsFromMetadata(matchingPosts)
+            return (queryResults, scoring.scoreUsersFromStore(self.featureStore, queryResults, self.cutoffPercentile, answerRelevance, self.maxExperts))
+        elif topicModel.metadata is not None:
+            # closed questions were already removed by the index
+            queryResults = topicModel.resultsFromMetadata(matchingPosts)
+            answersJob = self.submit(scoring.answersByQuestion, [queryResult.id for queryResult in queryResults])
+        else:
+            # answers are fetched for closed questions too, so that both fetches can start immediately;
+            # the closed ones are dropped along with their questions. The feature store has the answers already
+            questionIds = [match[0] for match in matchingPosts]
+            if self.featureStore is None:
+                answersJob = self.submit(scoring.answersByQuestion, questionIds)
+            postsJob = self.submit(topicModel.fetchPosts, questionIds)
+            queryResults = topicModel.resultsFromPosts(None, matchingPosts, postsJob.get())
+        logging.debug("%d results returned..." % len(queryResults))
+        if self.featureStore is not None:
+            return (queryResults, scoring.scoreUsersFromStore(self.featureStore, queryResults, self.cutoffPercentile, answerRelevance, self.maxExperts))
+        ids, userIds, relevance, postIds = scoring.answerCandidates(queryResults, answersJob.get(), answerRelevance)
+
+        logging.debug("looking up prescores, sentiment and display names for %d answers..." % len(ids))
+        prescoresJob = self.submit(scoring.answerPrescoreRows, ids)
+        sentimentJob = self.submit(scoring.scoreCommentSentiment, ids)
+        namesJob = self.submit(scoring.displayNamesById, frozenset(userIds))
+        ages, scores, favorites, views, accepted = scoring.prescoreArrays(prescoresJob.get(), ids)
+        commentSentimentDict = sentimentJob.get()
+        commentSentiment = numpy.array([commentSentimentDict.get(ident, 0) for ident in ids])
+
+        logging.debug("scoring users...")
+        userScores = scoring.rankUsers(userIds, relevance, postIds, scores, favorites, views, accepted, commentSentiment,
+            namesJob.get(), self.cutoffPercentile, self.maxExperts)
+        return (queryResults, userScores)
+
+    def close(self):
+        self.threads.close()
+        self.threads.join()
@@ -1,51 +1,58 @@
 #!/usr/bin/env python
 """ implement scoring for posts """
 from pylab import *
-from scipy.stats import percentileofscore
 import logging
+import functools
+import collections
+import heapq
+import os
+import sys
+import numpy
 
+from config import Config
 import topic_classification
 import util
+import metrics
 
 acceptedBonus = 0.5     # bonus score to give to an accepted answer
 sentimentFactor = 0.7   # how much to weigh the value of comment sentiment relative to a real score
 
-def createPrescoringTables(db):
-    c = db.cursor()
-    # question prescoring
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS question_prescoring ( 
-        id          int, 
+# the prescoring tables: (name, key column, column definitions, SELECT of the rows, the key column in the SELECT).
+# the SELECT's {condition} is filled in with a condition on the selected key: a range of ids or a list of them
+PrescoringTable = collections.namedtuple("PrescoringTable", ["name", "key", "columns", "select", "selectKey"])
+prescoringTables = [
+    PrescoringTable("question_prescoring", "id", 
+    """
+        id          int NOT NULL PRIMARY KEY, 
         age         int, 
         score       int, 
         favorites   int, 
         views       int 
-    ) 
+    """, 
+    """
     SELECT 
         id, 
-        TIMESTAMPDIFF(DAY, creation_date, '2012-08-05 12:00:00') AS age, 
+        TIMESTAMPDIFF(DAY, creation_date, %(referenceDate)s) AS age, 
         score, 
         favorite_count AS favorites, 
         view_count AS views 
     FROM posts 
     WHERE 
-        type_id=1 
-    """)
-    c.fetchall()
-
-    # answer prescoring
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS answer_prescoring ( 
-        id          int, 
+        type_id=1 AND {condition}
+    """, "id"),
+    PrescoringTable("answer_prescoring", "id", 
+    """
+        id          int NOT NULL PRIMARY KEY, 
         age         int, 
         score       int, 
         favorites   int, 
         views       int, 
         accepted    bool
-    ) 
+    """, 
+    """
     SELECT 
         a.id AS id, 
-        TIMESTAMPDIFF(DAY, a.creation_date, '2012-08-05 12:00:00') AS age, 
+        TIMESTAMPDIFF(DAY, a.creation_date, %(referenceDate)s) AS age, 
         a.score AS score, 
         q.favorite_count AS favorites, 
         q.view_count AS views, 
@@ -56,16 +63,14 @@ def createPrescoringTables(db):
         posts as a 
         ON q.id=a.parent_id  
     WHERE 
-        a.type_id=2;
-    """)
-    c.fetchall()
-
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS comment_prescoring (
-      answer_id int,
-      comment_score int,
-      INDEX (answer_id)
-    )
+        a.type_id=2 AND {condition}
+    """, "a.id"),
+    PrescoringTable("comment_prescoring", "answer_id", 
+    """
+        answer_id       int NOT NULL PRIMARY KEY,
+        comment_score   int
+    """, 
+    """
     SELECT 
       c.post_id AS answer_id,
       SUM(cc.classification) AS comment_score
@@ -73,15 +78,241 @@ def createPrescoringTables(db):
       comments AS c INNER JOIN 
       classified_comments AS cc
       ON cc.comment_id=c.id
+    WHERE {condition}
     GROUP BY c.post_id
-    """)
-    c.fetchall()
+    """, "c.post_id")
+]
+# the table that depends on the comment classifications, see comment_classification.py
+commentPrescoringTable = prescoringTables[2]
+# the row of comment_classification.py's classification_watermark table that is present when comment_prescoring was 
+# written by a sums-only run, which does not store the class of each comment in classified_comments
+sumsOnlyRow = 2
+
+# post ages are measured in days before this date, which should be the date of the dump
+referenceDate = getattr(Config, "referenceDate", "2012-08-05 12:00:00")
+
+def tableExists(db, tableName):
+    c = db.cursor()
+    c.execute("""SHOW TABLES LIKE %s""", (tableName,))
+    exists = bool(c.fetchall())
     c.close()
+    return exists
 
-def getAnswerPrescores(db, postIdList):
-    """ return a tuple of age, score, favorites, views divided by age and accepted.
-    if an answer is accepted and has a score of 0, add 1
-    """
+def commentSumsOnly(db):
+    """ whether comment_prescoring was written by a sums-only classification run (comment_classification.py sums),
+    in which case classified_comments does not hold the classes it was summed from """
+    if not tableExists(db, "classification_watermark"):
+        return False
+    c = db.cursor()
+    c.execute("""SELECT id FROM classification_watermark WHERE id=%s""", (sumsOnlyRow,))
+    sumsOnly = bool(c.fetchall())
+    c.close()
+    return sumsOnly
+
+def setCommentSumsOnly(db, sumsOnly):
+    """ record whether comment_prescoring was written by a sums-only classification run """
+    c = db.cursor()
+    if sumsOnly:
+        c.execute("""INSERT IGNORE INTO classification_watermark (id, comment_id) VALUES (%s, NULL)""", (sumsOnlyRow,))
+    else:
+        c.execute("""DELETE FROM classification_watermark WHERE id=%s""", (sumsOnlyRow,))
+    c.close()
+
+def recalculableTables(db, tables):
+    """ the tables that can be recalculated from the database: all of them, except comment_prescoring after a 
+    sums-only classification run, which would be recalculated from an empty or stale classified_comments """
+    if commentPrescoringTable in tables and commentSumsOnly(db):
+        logging.warning("%s was written by a sums-only classification run and is left alone: "
+            "run comment_classification.py full to recalculate it" % commentPrescoringTable.name)
+        return [prescoringTable for prescoringTable in tables if prescoringTable is not commentPrescoringTable]
+    return tables
+
+def refreshPrescoringTables(db, tables=prescoringTables, referenceDate=referenceDate, chunkSize=100000):
+    """ rebuild prescoring tables without blocking queries on the live ones: each table is filled in 
+    chunks of post id ranges into a shadow table, then all of the shadow tables are swapped in with 
+    one (atomic) RENAME TABLE """
+    tables = recalculableTables(db, tables)
+    if not tables:
+        return
+    c = db.cursor()
+    c.execute("""SELECT MIN(id), MAX(id) FROM posts""")
+    minId, maxId = c.fetchall()[0]
+    minId, maxId = int(minId or 0), int(maxId or 0)
+    for prescoringTable in tables:
+        shadow = prescoringTable.name + "_shadow"
+        c.execute("""DROP TABLE IF EXISTS %s""" % shadow)
+        c.execute("""CREATE TABLE %s (%s)""" % (shadow, prescoringTable.columns))
+        for start in xrange(minId, maxId + 1, chunkSize):
+            logging.debug("%s: posts %d-%d" % (prescoringTable.name, start, start + chunkSize))
+            c.execute("""INSERT INTO %s %s""" % (shadow, 
+                prescoringTable.select.format(condition="%s >= %%(start)s AND %s < %%(end)s" % (prescoringTable.selectKey, prescoringTable.selectKey))),
+                {"referenceDate" : referenceDate, "start" : start, "end" : start + chunkSize})
+            db.commit()
+    c.close()
+    swapInShadowTables(db, [prescoringTable.name for prescoringTable in tables])
+
+def swapInShadowTables(db, tableNames):
+    """ replace each of the tables with its _shadow table in one (atomic) RENAME TABLE, and drop the old ones """
+    c = db.cursor()
+    renames = []
+    drops = []
+    for tableName in tableNames:
+        if tableExists(db, tableName):
+            renames.append("%s TO %s_old" % (tableName, tableName))
+            drops.append(tableName + "_old")
+        renames.append("%s_shadow TO %s" % (tableName, tableName))
+    if drops:
+        c.execute("""DROP TABLE IF EXISTS %s""" % ", ".join(drops))
+    c.execute("""RENAME TABLE %s""" % ", ".join(renames))
+    if drops:
+        c.execute("""DROP TABLE %s""" % ", ".join(drops))
+    c.close()
+
+def writeCommentPrescoring(db, postIds, commentScores, chunkSize=10000):
+    """ replace comment_prescoring with precomputed per-post sums of the comment classes, 
+    instead of joining comments with classified_comments """
+    shadow = commentPrescoringTable.name + "_shadow"
+    c = db.cursor()
+    c.execute("""DROP TABLE IF EXISTS %s""" % shadow)
+    c.execute("""CREATE TABLE %s (%s)""" % (shadow, commentPrescoringTable.columns))
+    for start in xrange(0, len(postIds), chunkSize):
+        c.executemany("""INSERT INTO %s (answer_id, comment_score) VALUES (%%s, %%s)""" % shadow,
+            [(int(postId), int(commentScore)) for (postId, commentScore) in 
+                zip(postIds[start:start + chunkSize], commentScores[start:start + chunkSize])])
+        db.commit()
+    c.close()
+    swapInShadowTables(db, [commentPrescoringTable.name])
+
+def hasPrimaryKey(db, tableName):
+    c = db.cursor()
+    c.execute("""SHOW KEYS FROM %s WHERE Key_name='PRIMARY'""" % tableName)
+    hasKey = bool(c.fetchall())
+    c.close()
+    return hasKey
+
+def createPrescoringTables(db, referenceDate=referenceDate, tables=prescoringTables):
+    """ create the prescoring tables that do not exist yet, and rebuild the ones made without a primary key 
+    (before the key was added), which the in-place updates need """
+    missing = [prescoringTable for prescoringTable in tables 
+        if not tableExists(db, prescoringTable.name) or not hasPrimaryKey(db, prescoringTable.name)]
+    if missing:
+        logging.info("building %s" % ", ".join([prescoringTable.name for prescoringTable in missing]))
+    refreshPrescoringTables(db, missing, referenceDate=referenceDate)
+
+def updatePrescoringRows(db, postIds, referenceDate=referenceDate, chunkSize=1000):
+    """ recalculate the prescoring rows of the given (changed) posts in place. 
+    The answers to changed questions are updated too, because they take their favorites and views from the question.
+    Posts that no longer exist are removed. """
+    createPrescoringTables(db, referenceDate)
+    tables = recalculableTables(db, prescoringTables)
+    c = db.cursor()
+    postIds = sorted(set(int(postId) for postId in postIds))
+    for start in xrange(0, len(postIds), chunkSize):
+        questionIds = postIds[start:start + chunkSize]
+        idList = ",".join([str(postId) for postId in questionIds])
+        c.execute("""SELECT id FROM posts WHERE type_id=2 AND parent_id IN (%s)""" % idList)
+        answerIds = sorted(set(questionIds) | set(int(answerId) for (answerId,) in c.fetchall()))
+        answerIdList = ",".join([str(answerId) for answerId in answerIds])
+        for (prescoringTable, ids) in zip(prescoringTables, [idList, answerIdList, answerIdList]):
+            if prescoringTable in tables:
+                replacePrescoringRows(c, prescoringTable, ids, referenceDate)
+        logging.debug("updated prescoring for %d of %d changed posts" % (min(start + chunkSize, len(postIds)), len(postIds)))
+    c.close()
+
+def columnNames(prescoringTable):
+    """ the names of the columns of a prescoring table, in order """
+    return [column.split()[0] for column in prescoringTable.columns.split(",") if column.strip()]
+
+def replacePrescoringRows(c, prescoringTable, idList, referenceDate=referenceDate):
+    """ recalculate the rows of one prescoring table for a comma separated list of ids.
+    The connection is in autocommit mode, so the rows are overwritten in place and only the ids that the SELECT no longer 
+    returns are deleted afterwards: a concurrent query sees either the old row or the new one, never a missing one """
+    select = prescoringTable.select.format(condition="%s IN (%s)" % (prescoringTable.selectKey, idList))
+    # selected from a derived table, so the column names in the UPDATE cannot be confused with those of posts
+    c.execute("""INSERT INTO %s SELECT * FROM (%s) AS fresh ON DUPLICATE KEY UPDATE %s""" % (prescoringTable.name, select, 
+        ", ".join(["%s.%s=fresh.%s" % (prescoringTable.name, column, column) 
+            for column in columnNames(prescoringTable) if column != prescoringTable.key])),
+        {"referenceDate" : referenceDate})
+    c.execute("""DELETE FROM %s WHERE %s IN (%s) AND %s NOT IN (SELECT %s FROM (%s) AS fresh)""" % (prescoringTable.name, 
+        prescoringTable.key, idList, prescoringTable.key, prescoringTable.key, select),
+        {"referenceDate" : referenceDate})
+
+def updateCommentPrescoring(db, postIds, chunkSize=1000):
+    """ recalculate the comment_prescoring rows of the posts whose comments were (re)classified.
+    Unlike updatePrescoringRows, the question and answer rows are left alone. """
+    createPrescoringTables(db, tables=[commentPrescoringTable])
+    if not recalculableTables(db, [commentPrescoringTable]):
+        return
+    c = db.cursor()
+    postIds = sorted(set(int(postId) for postId in postIds))
+    for start in xrange(0, len(postIds), chunkSize):
+        replacePrescoringRows(c, commentPrescoringTable, ",".join([str(postId) for postId in postIds[start:start + chunkSize]]))
+    c.close()
+
+def readManifest(fileName):
+    """ read a changed-id manifest: one (post or comment) id per line; blank lines and lines starting with # are ignored """
+    with open(fileName) as f:
+        return [int(line) for line in (line.strip() for line in f) if line and not line.startswith("#")]
+
+class PostDetails:
+    """ an answer that contributes to a user's score """
+    def __init__(self, questionId=0, answerId=0, title="", questionRelevance=0, answerRelevance=0):
+        self.questionId = questionId
+        self.answerId = answerId
+        self.title = title
+        self.questionRelevance = questionRelevance
+        self.answerRelevance = answerRelevance
+
+class AnswerDetails(object):
+    """ the PostDetails of a list of candidate answers, made only when they are looked up """
+    def __init__(self, queryResults, answerIds, questionIndex, answerRelevances):
+        self.queryResults = queryResults
+        self.answerIds = numpy.asarray(answerIds)
+        # index into queryResults of the question of each answer
+        self.questionIndex = numpy.asarray(questionIndex, dtype=numpy.int64)
+        self.answerRelevances = numpy.asarray(answerRelevances)
+
+    def __len__(self):
+        return len(self.answerIds)
+
+    def __getitem__(self, i):
+        queryResult = self.queryResults[self.questionIndex[i]]
+        return PostDetails(
+            questionId=queryResult.post.id, 
+            answerId=int(self.answerIds[i]), 
+            title=queryResult.post.title,
+            questionRelevance=queryResult.similarity, 
+            answerRelevance=self.answerRelevances[i]
+        )
+
+    def __iter__(self):
+        return (self[i] for i in xrange(len(self)))
+
+    def take(self, positions):
+        """ the AnswerDetails of the answers at positions """
+        return AnswerDetails(self.queryResults, self.answerIds[positions], self.questionIndex[positions], self.answerRelevances[positions])
+
+class UserScore:
+    """ the score of one user for a query """
+    def __init__(self, userId, user, score, meanRelevance, postIds):
+        self.userId = userId
+        self.user = user
+        self.score = score
+        self.meanRelevance = meanRelevance
+        self.postIds = postIds
+        self.nPosts = len(self.postIds)
+    def __repr__(self):
+        return repr((self.user, self.userId, self.score, self.meanRelevance))
+    def starScore(self, cutoffPercentile=75, nStars=5):
+        """ convert the score to a number of stars, based on percentileRank (which must be added separately)"""
+        self.stars = int(min([nStars, (1+(self.percentileRank - cutoffPercentile - 1.0)//((100.0-cutoffPercentile)/nStars))]))
+        return self
+
+@metrics.timed("prescores")
+def answerPrescoreRows(db, postIdList):
+    """ return a dictionary of answer id -> (age, score, favorites, views, accepted) from the prescoring table """
+    if not postIdList:
+        return {}
     c = db.cursor()
     c.execute("""
     SELECT 
@@ -92,16 +323,32 @@ def getAnswerPrescores(db, postIdList):
         id IN (%s)
     """ % ",".join([str(postId) for postId in postIdList])
     )
-    results = c.fetchall()
-    age = double(array([result[1] for result in results]))
-    accepted = array([result[5] if result[5] is not None else 0 for result in results])
-    score = double(array([result[2] + accepted[n] for (n, result) in enumerate(results)]))
-    favorites = double(array([(result[3] if result[3] is not None else 0) for result in results]))
-    views = double(array([(result[4] if result[4] is not None else 0) for result in results]))
+    rows = {int(result[0]) : result[1:] for result in c.fetchall()}
     c.close()
+    return rows
+
+def prescoreArrays(prescoreRows, postIdList):
+    """ return a tuple of age, score, favorites, views and accepted arrays in the order of postIdList.
+    if an answer is accepted and has a score of 0, add 1
+    """
+    results = [prescoreRows.get(postId, (0, 0, 0, 0, 0)) for postId in postIdList]
+    age = double(array([result[0] for result in results]))
+    accepted = array([result[4] if result[4] is not None else 0 for result in results])
+    score = double(array([(result[1] if result[1] is not None else 0) + accepted[n] for (n, result) in enumerate(results)]))
+    favorites = double(array([(result[2] if result[2] is not None else 0) for result in results]))
+    views = double(array([(result[3] if result[3] is not None else 0) for result in results]))
     return (age, score, favorites, views, accepted)
 
+def getAnswerPrescores(db, postIdList):
+    """ return a tuple of age, score, favorites, views divided by age and accepted.
+    if an answer is accepted and has a score of 0, add 1
+    """
+    return prescoreArrays(answerPrescoreRows(db, postIdList), postIdList)
+
+@metrics.timed("sentiment")
 def scoreCommentSentiment(db, answerIds):
+    if not answerIds:
+        return {}
     c = db.cursor()
     answerIdStr = ",".join([str(answerId) for answerId in answerIds])
     n = c.execute("""SELECT answer_id, comment_score FROM comment_prescoring WHERE answer_id IN (%s)""" % (answerIdStr))
@@ -110,57 +357,129 @@ def scoreCommentSentiment(db, answerIds):
     c.close()
     return sentiment
 
-def scoreUsers(db, query, queryResults, topicModel, cutoffPercentile=75, resultCutoff=0.5):
-    """ return the value-weighted score of users in a set of posts
-    the posts must be a list including .id, .post, .similarity (relevance)
+@metrics.timed("display_names")
+def displayNamesById(db, userIds):
+    """ return a dictionary of user id -> display name """
+    if not userIds:
+        return {}
+    c = db.cursor()
+    c.execute("""SELECT id, display_name FROM users WHERE id IN (%s)""" % ",".join([str(userId) for userId in userIds]))
+    displayNames = {int(userId) : displayName for (userId, displayName) in c.fetchall()}
+    c.close()
+    return displayNames
+
+@metrics.timed("answer_fetch")
+def answersByQuestion(db, questionIds):
+    """ return a dictionary of question id -> list of answers """
+    answers = {}
+    if questionIds:
+        for answer in util.iterateAnswers(db, questionIds, columns=util.answerColumns):
+            answers.setdefault(answer.parent_id, []).append(answer)
+    return answers
+
+def answerCandidates(queryResults, answers, answerRelevance=None):
+    """ find the answers to the query results that can be credited to a user. 
+    answers is a dictionary of question id -> list of answers.
+    answerRelevance, if given, is a function from a list of answer ids to the relevance of each answer to the query
+    (eg, TopicModeling.answerRelevance for the query); otherwise every answer is fully relevant.
+    return parallel sequences of answer ids, user ids, relevance and PostDetails (an AnswerDetails)
     """
-    class PostDetails:
-        def __init__(self, questionId=0, answerId=0, title="", questionRelevance=0, answerRelevance=0):
-            self.questionId = questionId
-            self.answerId = answerId
-            self.title = title
-            self.questionRelevance = questionRelevance
-            self.answerRelevance = answerRelevance
-
-    class UserScore:
-        def __init__(self, userId, user, score, meanRelevance, postIds):
-            self.userId = userId
-            self.user = user
-            self.score = score
-            self.meanRelevance = meanRelevance
-            self.postIds = postIds
-            self.nPosts = len(self.postIds)
-            print repr(self)
-        def __repr__(self):
-            return repr((self.user, self.userId, self.score, self.meanRelevance))
-        def starScore(self, cutoffPercentile=75, nStars=5):
-            """ convert the score to a number of stars, based on percentileRank (which must be added separately)"""
-            self.stars = int(min([nStars, (1+(self.percentileRank - cutoffPercentile - 1.0)//((100.0-cutoffPercentile)/nStars))]))
-            return self
     ids = []
-    relevance = []
     userIds = []
-    postIds = []
-    commentSentiment = []
-    querySim = topic_classification.TopicModeling.QuerySimilarity(topicModel, query) 
-    id2qr = { queryResult.post.id : queryResult for queryResult in queryResults }
-    for answer in util.iterateAnswers(db, id2qr):
-	useUserId = answer.owner_user_id if answer.owner_user_id is not None else answer.last_editor_user_id
-        if useUserId:
-	    questionQr = id2qr[answer.parent_id]
-            ids.append(answer.id)
-            userIds.append(useUserId)
-            answerRelevance = 1.0 #querySim.similarity(answer.body)
-            relevance.append(questionQr.similarity*answerRelevance)
-            postIds.append(
-                PostDetails(
-                    questionId=answer.parent_id, 
-                    answerId=answer.id, 
-                    title=questionQr.post.title,
-                    questionRelevance=questionQr.similarity, 
-                    answerRelevance=answerRelevance
-                )
-            )
+    questionIndex = []
+    for (q, questionQr) in enumerate(queryResults):
+        for answer in answers.get(questionQr.post.id, []):
+            useUserId = answer.owner_user_id if answer.owner_user_id is not None else answer.last_editor_user_id
+            if useUserId:
+                ids.append(answer.id)
+                userIds.append(useUserId)
+                questionIndex.append(q)
+    answerRelevances = answerRelevance(ids) if answerRelevance is not None and ids else [1.0] * len(ids)
+    relevance = [queryResults[q].similarity * answerRel for (q, answerRel) in zip(questionIndex, answerRelevances)]
+    postIds = AnswerDetails(queryResults, ids, questionIndex, answerRelevances)
+    return (ids, userIds, relevance, postIds)
+
+def strictPercentiles(values):
+    """ the strict percentile rank of every element of values within values: 
+    the same as [percentileofscore(values, v, 'strict') for v in values], in O(n log n) """
+    n = len(values)
+    if n == 0:
+        return array([], double)
+    left = searchsorted(sort(values), values, 'left')
+    return left / float(n) * 100
+
+def rankPercentiles(values):
+    """ the (default, 'rank') percentile rank of every element of values within values: 
+    the same as [percentileofscore(values, v) for v in values], in O(n log n) """
+    n = len(values)
+    if n == 0:
+        return array([], double)
+    ordered = sort(values)
+    left = searchsorted(ordered, values, 'left')
+    right = searchsorted(ordered, values, 'right')
+    # the mean rank of the ties, counting from 1
+    return ((left + 1 + right) / 2.0 / n) * 100.0
+
+def answerQuality(scores, favorites, views, accepted, commentSentiment):
+    """ the query-independent part of the score of each answer, from its percentiles within the set of answers """
+    scores = scores + commentSentiment * sentimentFactor
+    pctScores = strictPercentiles(scores)/100.0
+    pctFavorites = strictPercentiles(favorites)/100.0
+    pctViews = strictPercentiles(views)/100.0
+    return (1.0+pctScores) * (1.0+pctFavorites) * (1.0 + pctViews) * (1.0 + acceptedBonus * array(accepted))
+
+@metrics.timed("percentiles")
+def rankUsers(userIds, relevance, postIds, scores, favorites, views, accepted, commentSentiment, displayNames, cutoffPercentile=75, topN=None):
+    """ combine per-answer features into a list of UserScores, best first, 
+    keeping only the users at or above cutoffPercentile, and only the best topN of them if topN is given.
+    postIds is any sequence of PostDetails; only the ones belonging to the returned users are looked up.
+    displayNames is a dictionary of user id -> display name, or a function from a user id to its display name
+    """
+    if not len(userIds):
+        return []
+
+    # calculate the scores of the posts for this query using a scoring heuristic
+    relevance = array(relevance, dtype=double)
+    postScore = relevance * answerQuality(scores, favorites, views, accepted, commentSentiment)
+
+    # aggregate by user: each user's posts are postOrder[postStarts[n]:postStarts[n]+nPosts[n]], in their original order
+    users, userIndex = unique(array(userIds, dtype=int64), return_inverse=True)
+    nPosts = bincount(userIndex, minlength=len(users))
+    postOrder = argsort(userIndex, kind="mergesort")
+    postStarts = cumsum(nPosts) - nPosts
+    # summing each user's slice adds the same values in the same (pairwise) order as a masked .sum() would,
+    # so the totals do not depend on how the users are grouped
+    userTotals = array([userScores.sum() for userScores in split(postScore[postOrder], postStarts[1:])], dtype=double)
+    meanRelevance = array([userRelevance.mean() for userRelevance in split(relevance[postOrder], postStarts[1:])], dtype=double)
+    percentileRanks = rankPercentiles(userTotals)
+
+    logging.debug("sorting users by score...")
+    eligible = nonzero(percentileRanks >= cutoffPercentile)[0]
+    if topN is not None:
+        # a bounded heap, in the same (stable) order as the full sort
+        best = heapq.nlargest(topN, eligible, key=userTotals.__getitem__)
+    else:
+        best = eligible[argsort(-userTotals[eligible], kind="mergesort")]
+
+    if isinstance(postIds, AnswerDetails):
+        userPosts = postIds.take
+    else:
+        userPosts = lambda positions: [postIds[i] for i in positions]
+    displayName = displayNames if callable(displayNames) else displayNames.get
+    userScores = []
+    for n in best:
+        userScore = UserScore(int(users[n]), displayName(int(users[n])), userTotals[n], meanRelevance[n],
+            userPosts(postOrder[postStarts[n]:postStarts[n] + nPosts[n]]))
+        userScore.percentileRank = percentileRanks[n]
+        userScores.append(userScore)
+    return userScores
+
+def scoreUsers(db, query, queryResults, topicModel, cutoffPercentile=75, resultCutoff=0.5, topN=None):
+    """ return the value-weighted score of users in a set of posts
+    the posts must be a list including .id, .post, .similarity (relevance)
+    """
+    answers = answersByQuestion(db, [queryResult.post.id for queryResult in queryResults])
+    ids, userIds, relevance, postIds = answerCandidates(queryResults, answers, functools.partial(topicModel.answerRelevance, query))
     logging.debug("iterating answers complete, getting prescores")
     ages, scores, favorites, views, accepted = getAnswerPrescores(db, ids)
     logging.debug("got prescores...getting sentiment")
@@ -168,37 +487,231 @@ def scoreUsers(db, query, queryResults, topicModel, cutoffPercentile=75, resultC
     #commentSentiment = getCommentSentiments(db, ids)
     commentSentiment = array([commentSentimentDict.get(ident, 0) for ident in ids])
     logging.debug("got sentiment...calculating scores...")
-    scores += commentSentiment * sentimentFactor
-    
-    # calculate the scores of the posts for this query using a scoring heuristic
-    postIds = array(postIds)
-    relevance = array(relevance)
-    accepted = array(accepted)
-    pctScores = array([percentileofscore(scores, s, 'strict') for s in scores], double)/100.0
-    pctFavorites = array([percentileofscore(favorites, f, 'strict') for f in favorites], double)/100.0
-    pctViews = array([percentileofscore(views, v, 'strict') for v in views], double)/100.0
-    postScore = relevance * (1.0+pctScores) * (1.0+pctFavorites) * (1.0 + pctViews) * (1.0 + acceptedBonus * accepted)
-    userIdSet = frozenset(userIds)
-    userIds = array(userIds)
-    displayNames = {userId : displayName for (userId, displayName) in zip(userIdSet, util.usersById(db, userIdSet))}
-    userScores = [
-        UserScore(
-            user,
-            displayNames[user], 
-            postScore[userIds==user].sum(), 
-            relevance[userIds==user].mean(),
-            postIds[userIds==user]
-        ) for user in userIdSet]
-    allUserScores = array([userScore.score for userScore in userScores], dtype=double)
-    for userScore in userScores:
-        userScore.percentileRank = percentileofscore(allUserScores, userScore.score)
-    logging.debug("sorting users by score...")
-    return sorted(filter(lambda us: us.percentileRank >= cutoffPercentile, userScores), key=lambda u: -u.score)
+    displayNames = displayNamesById(db, frozenset(userIds))
+    return rankUsers(userIds, relevance, postIds, scores, favorites, views, accepted, commentSentiment, displayNames, cutoffPercentile, topN)
+
+def scoreUsersBatch(db, queries, queryResultsList, topicModel, cutoffPercentile=75, topN=None):
+    """ score users for many queries at once. queryResultsList holds one list of query results per query;
+    the queries themselves are only used for the relevance of each answer to its query.
+    Answers, prescores, comment sentiment and display names are looked up once for the whole batch.
+    return one list of UserScores per query
+    """
+    answers = answersByQuestion(db, list(set(queryResult.post.id for queryResults in queryResultsList for queryResult in queryResults)))
+    candidates = [answerCandidates(queryResults, answers, functools.partial(topicModel.answerRelevance, query)) 
+        for (query, queryResults) in zip(queries, queryResultsList)]
+    allIds = list(set(answerId for (ids, userIds, relevance, postIds) in candidates for answerId in ids))
+    logging.debug("batch of %d queries has %d answers, getting prescores" % (len(queries), len(allIds)))
+    prescoreRows = answerPrescoreRows(db, allIds)
+    commentSentimentDict = scoreCommentSentiment(db, allIds)
+    displayNames = displayNamesById(db, frozenset(userId for candidate in candidates for userId in candidate[1]))
+    userScoresList = []
+    for (ids, userIds, relevance, postIds) in candidates:
+        ages, scores, favorites, views, accepted = prescoreArrays(prescoreRows, ids)
+        commentSentiment = array([commentSentimentDict.get(ident, 0) for ident in ids])
+        userScoresList.append(rankUsers(userIds, relevance, postIds, scores, favorites, views, accepted, commentSentiment, displayNames, cutoffPercentile, topN))
+    return userScoresList
+
+def findExpertsBatch(db, topicModel, queries, resultCutoff=0.5, cutoffPercentile=75, nStars=5, featureStore=None, topN=None):
+    """ find experts for a list of queries. If an AnswerFeatureStore is given, users are scored from it.
+    return a list of (query results, star-scored user scores), one per query 
+    """
+    queryResultsList = topicModel.queryResultsBatch(db, queries, resultCutoff)
+    if featureStore is not None:
+        userScoresList = [scoreUsersFromStore(featureStore, queryResults, cutoffPercentile, functools.partial(topicModel.answerRelevance, query), topN) 
+            for (query, queryResults) in zip(queries, queryResultsList)]
+    else:
+        userScoresList = scoreUsersBatch(db, queries, queryResultsList, topicModel, cutoffPercentile=cutoffPercentile, topN=topN)
+    return [
+        (queryResults, [userScore.starScore(cutoffPercentile=cutoffPercentile, nStars=nStars) for userScore in userScores])
+        for (queryResults, userScores) in zip(queryResultsList, userScoresList)]
+
+class AnswerFeatureStore(object):
+    """ the per-answer scoring features, exported from the prescoring tables into numpy arrays indexed by answer id,
+    with a CSR adjacency from question id to answer ids and the user display names, so that users can be scored
+    without the database. The arrays are memory mapped from a directory written by exportAnswerFeatures.
+    """
+    # per-answer arrays, indexed by answer id. owned is set for the answers credited to a user (owner), which may be 
+    # negative (the Community user)
+    answerArrays = ["age", "score", "favorites", "views", "accepted", "sentiment", "owner", "owned"]
+    # question -> answers: the answers to question q are answers[indptr[q]:indptr[q+1]]
+    adjacencyArrays = ["indptr", "answers"]
+    # user display names: the UTF-8 name of user u is names[nameOffsets[u]:nameOffsets[u+1]]; the names of the
+    # users with negative ids are kept separately, the name of negativeUserIds[n] being
+    # negativeNames[negativeNameOffsets[n]:negativeNameOffsets[n+1]]
+    nameArrays = ["nameOffsets", "names", "negativeUserIds", "negativeNameOffsets", "negativeNames"]
+
+    def __init__(self, directory, mmapMode="r"):
+        self.directory = directory
+        for name in self.answerArrays + self.adjacencyArrays + self.nameArrays:
+            fileName = os.path.join(directory, name + ".npy")
+            if not os.path.isfile(fileName) and name in self.upgrades:
+                # exported before the array existed
+                setattr(self, name, self.upgrades[name](self))
+                continue
+            setattr(self, name, numpy.load(fileName, mmap_mode=mmapMode))
+
+    # how to make the arrays that older exports do not have. 0 was the only "no owner" value, and answerCandidates does
+    # not credit user 0 either; the names of negative user ids were not exported
+    upgrades = {
+        "owned" : lambda store: numpy.asarray(store.owner) != 0,
+        "negativeUserIds" : lambda store: numpy.zeros(0, dtype=numpy.int64),
+        "negativeNameOffsets" : lambda store: numpy.zeros(1, dtype=numpy.int64),
+        "negativeNames" : lambda store: numpy.zeros(0, dtype=numpy.uint8)
+    }
+
+    def displayName(self, userId):
+        if 0 <= userId < len(self.nameOffsets) - 1:
+            return self.names[self.nameOffsets[userId]:self.nameOffsets[userId + 1]].tostring().decode("utf-8")
+        for n in numpy.flatnonzero(self.negativeUserIds == userId):
+            return self.negativeNames[self.negativeNameOffsets[n]:self.negativeNameOffsets[n + 1]].tostring().decode("utf-8")
+        return None
+
+    def answersTo(self, questionIds):
+        """ return (answer ids, index into questionIds of each answer's question) for a list of question ids """
+        questionIds = numpy.asarray(questionIds, dtype=numpy.int64)
+        known = (questionIds >= 0) & (questionIds < len(self.indptr) - 1)
+        starts = numpy.where(known, self.indptr[numpy.where(known, questionIds, 0)], 0)
+        ends = numpy.where(known, self.indptr[numpy.where(known, questionIds + 1, 0)], 0)
+        counts = ends - starts
+        total = counts.sum()
+        # positions starts[i], starts[i]+1, ..., ends[i]-1 for each question, in order
+        positions = numpy.repeat(starts - (numpy.cumsum(counts) - counts), counts) + numpy.arange(total)
+        return (numpy.asarray(self.answers[positions], dtype=numpy.int64), numpy.repeat(numpy.arange(len(questionIds)), counts))
+
+def exportArray(directory, name, dtype, shape):
+    """ create a memory mapped .npy array for the feature store """
+    return numpy.lib.format.open_memmap(os.path.join(directory, name + ".npy"), mode="w+", dtype=dtype, shape=shape)
+
+def exportAnswerFeatures(db, directory, selectRate=100000):
+    """ export answer_prescoring, comment_prescoring, qtoa, the answer owners and user names into an AnswerFeatureStore in directory.
+    The prescoring tables must already exist. """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    c = db.cursor()
+    c.execute("""SELECT MAX(id) FROM posts WHERE type_id=2""")
+    maxAnswerId = int(c.fetchall()[0][0] or 0)
+    c.execute("""SELECT MAX(question) FROM qtoa""")
+    maxQuestionId = int(c.fetchall()[0][0] or 0)
+    c.execute("""SELECT MAX(id) FROM users""")
+    maxUserId = int(c.fetchall()[0][0] or 0)
+
+    owned = exportArray(directory, "owned", numpy.bool_, (maxAnswerId + 1,))
+    columns = {name : exportArray(directory, name, dtype, (maxAnswerId + 1,)) for (name, dtype) in 
+        [("age", numpy.int32), ("score", numpy.int32), ("favorites", numpy.int32), ("views", numpy.int32), 
+         ("accepted", numpy.int8), ("sentiment", numpy.int32), ("owner", numpy.int32)]}
+    for start in xrange(0, maxAnswerId + 1, selectRate):
+        end = start + selectRate
+        logging.debug("exporting answers %d-%d..." % (start, end))
+        c.execute("""
+        SELECT id, age, score, favorites, views, accepted 
+        FROM answer_prescoring 
+        WHERE id >= %d AND id < %d""" % (start, end))
+        for (answerId, age, score, favorites, views, accepted) in c.fetchall():
+            columns["age"][answerId] = age or 0
+            columns["score"][answerId] = score or 0
+            columns["favorites"][answerId] = favorites or 0
+            columns["views"][answerId] = views or 0
+            columns["accepted"][answerId] = accepted or 0
+        c.execute("""
+        SELECT answer_id, comment_score 
+        FROM comment_prescoring 
+        WHERE answer_id >= %d AND answer_id < %d""" % (start, end))
+        for (answerId, commentScore) in c.fetchall():
+            columns["sentiment"][answerId] = commentScore or 0
+        # the user an answer is credited to, as in answerCandidates
+        c.execute("""
+        SELECT id, IFNULL(owner_user_id, last_editor_user_id) 
+        FROM posts 
+        WHERE type_id=2 AND id >= %d AND id < %d""" % (start, end))
+        for (answerId, userId) in c.fetchall():
+            columns["owner"][answerId] = userId or 0
+            owned[answerId] = bool(userId)
+
+    logging.debug("exporting question->answer adjacency...")
+    c.execute("""SELECT COUNT(*) FROM qtoa""")
+    nLinks = int(c.fetchall()[0][0])
+    counts = numpy.zeros(maxQuestionId + 1, dtype=numpy.int64)
+    answers = exportArray(directory, "answers", numpy.int32, (nLinks,))
+    n = 0
+    for start in xrange(0, maxQuestionId + 1, selectRate):
+        c.execute("""
+        SELECT question, answer 
+        FROM qtoa 
+        WHERE question >= %d AND question < %d 
+        ORDER BY question, answer""" % (start, start + selectRate))
+        for (question, answer) in c.fetchall():
+            counts[question] += 1
+            answers[n] = answer
+            n += 1
+    indptr = exportArray(directory, "indptr", numpy.int64, (maxQuestionId + 2,))
+    indptr[0] = 0
+    indptr[1:] = numpy.cumsum(counts)
+
+    logging.debug("exporting user display names...")
+    nameLengths = numpy.zeros(maxUserId + 1, dtype=numpy.int64)
+    names = []
+    for start in xrange(0, maxUserId + 1, selectRate):
+        c.execute("""SELECT id, display_name FROM users WHERE id >= %d AND id < %d ORDER BY id""" % (start, start + selectRate))
+        for (userId, displayName) in c.fetchall():
+            encoded = (displayName or u"").encode("utf-8")
+            nameLengths[userId] = len(encoded)
+            names.append(encoded)
+    # eg, the Community user, -1, which is credited with answers like any other user
+    c.execute("""SELECT id, display_name FROM users WHERE id < 0 ORDER BY id""")
+    negativeUsers = [(int(userId), (displayName or u"").encode("utf-8")) for (userId, displayName) in c.fetchall()]
+    c.close()
+    numpy.save(os.path.join(directory, "negativeUserIds.npy"), numpy.array([userId for (userId, name) in negativeUsers], dtype=numpy.int64))
+    numpy.save(os.path.join(directory, "negativeNameOffsets.npy"), 
+        numpy.cumsum([0] + [len(name) for (userId, name) in negativeUsers]).astype(numpy.int64))
+    numpy.save(os.path.join(directory, "negativeNames.npy"), numpy.fromstring("".join([name for (userId, name) in negativeUsers]), dtype=numpy.uint8))
+    nameOffsets = exportArray(directory, "nameOffsets", numpy.int64, (maxUserId + 2,))
+    nameOffsets[0] = 0
+    nameOffsets[1:] = numpy.cumsum(nameLengths)
+    numpy.save(os.path.join(directory, "names.npy"), numpy.fromstring("".join(names), dtype=numpy.uint8))
+    for array_ in [owned, indptr, answers, nameOffsets] + columns.values():
+        array_.flush()
+
+@metrics.timed("answer_fetch")
+def answerCandidatesFromStore(store, queryResults, answerRelevance=None):
+    """ like answerCandidates, but with the answers and their users taken from an AnswerFeatureStore. 
+    return (answer ids, user ids, relevance, AnswerDetails) """
+    answerIds, questionIndex = store.answersTo([queryResult.post.id for queryResult in queryResults])
+    answerIds, questionIndex = answerIds[answerIds < len(store.owner)], questionIndex[answerIds < len(store.owner)]
+    userIds = numpy.asarray(store.owner[answerIds], dtype=numpy.int64)
+    credited = numpy.asarray(store.owned[answerIds], dtype=bool)
+    answerIds, questionIndex, userIds = answerIds[credited], questionIndex[credited], userIds[credited]
+    similarity = numpy.array([queryResult.similarity for queryResult in queryResults], dtype=double)
+    answerRelevances = answerRelevance(answerIds) if answerRelevance is not None and len(answerIds) else numpy.ones(len(answerIds))
+    relevance = similarity[questionIndex] * answerRelevances
+    postIds = AnswerDetails(queryResults, answerIds, questionIndex, answerRelevances)
+    return (answerIds, userIds, relevance, postIds)
+
+def scoreUsersFromStore(store, queryResults, cutoffPercentile=75, answerRelevance=None, topN=None):
+    """ scoreUsers without the database: all of the features come from an AnswerFeatureStore """
+    ids, userIds, relevance, postIds = answerCandidatesFromStore(store, queryResults, answerRelevance)
+    accepted = numpy.asarray(store.accepted[ids], dtype=numpy.int64)
+    # as in prescoreArrays, an accepted answer gets 1 added to its score
+    scores = double(store.score[ids]) + accepted
+    favorites = double(store.favorites[ids])
+    views = double(store.views[ids])
+    commentSentiment = numpy.asarray(store.sentiment[ids], dtype=numpy.int64)
+    return rankUsers(userIds, relevance, postIds, scores, favorites, views, accepted, commentSentiment, store.displayName, cutoffPercentile, topN)
 
 def main():
-    """ create precalculated scoring table """
+    """ create precalculated scoring tables that do not exist yet (or rebuild ones without a primary key);
+    scoring.py refresh [REFERENCE_DATE] rebuilds all of them through shadow tables;
+    scoring.py update MANIFEST recalculates the rows of the post ids listed in MANIFEST.
+    Both leave comment_prescoring alone if it was written by comment_classification.py sums;
+    scoring.py export DIRECTORY exports the answer feature store from existing tables """
     db = util.makeDbConnection()
-    createPrescoringTables(db)
+    if len(sys.argv) > 2 and sys.argv[1] == "export":
+        exportAnswerFeatures(db, sys.argv[2])
+    elif len(sys.argv) > 1 and sys.argv[1] == "refresh":
+        refreshPrescoringTables(db, referenceDate=sys.argv[2] if len(sys.argv) > 2 else referenceDate)
+    elif len(sys.argv) > 2 and sys.argv[1] == "update":
+        updatePrescoringRows(db, readManifest(sys.argv[2]))
+    else:
+        createPrescoringTables(db)
     db.close()
 
 if __name__ == "__main__":
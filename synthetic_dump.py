@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+'''
+Generate a synthetic Stack Overflow dump
+
+The real dump is 7GB, which makes it impractical for measuring performance changes. This writes users.xml,
+posts.xml and comments.xml in the same format as the dump (so they can be imported by sov2mysql.py) at any size.
+Tags and body words are drawn from Zipfian distributions, like the real data, where a few tags and words account for
+most of the posts. A queries.txt file of sample queries drawn from the same distributions is also written,
+for benchmark.py.
+
+Call it by
+synthetic_dump.py directory nQuestions [seed]
+
+Created on Oct 19, 2026
+
+@author: efeins
+'''
+import sys
+import os
+import random
+import bisect
+import datetime
+from xml.sax.saxutils import quoteattr, escape
+
+# the most popular tags in the real dump, most popular first. Less popular tags are numbered.
+popularTags = ["c#", "java", "php", "javascript", "jquery", "android", "iphone", "c++", "asp.net", "python", ".net",
+    "html", "mysql", "objective-c", "sql", "ios", "css", "ruby-on-rails", "c", "sql-server", "ruby", "ajax", "xml",
+    "regex", "wpf", "linux", "database", "django", "windows", "arrays", "json", "xcode", "vb.net", "eclipse", "string",
+    "multithreading", "html5", "facebook", "spring", "silverlight", "wordpress", "asp.net-mvc", "performance", "perl",
+    "winforms", "oracle", "git", "algorithm", "linq", "bash"]
+
+commentTemplates = [
+    "Thanks, that works!", "thank you so much, this is exactly what i needed", "+1 very clear explanation",
+    "This doesn't work for me.", "Sorry, but this is wrong.", "Could you clarify what you mean by %s?",
+    "Did you try %s?", "@user it also depends on %s", "thanks but I already tried %s", "Great answer!",
+    "I disagree, %s is better", "Why not use %s?", "fixed it, the problem was %s", "-1 incorrect",
+    "this is almost right, but %s is missing", "nice, that did the trick"]
+
+epoch = datetime.datetime(2008, 7, 31)
+dumpDate = datetime.datetime(2012, 8, 5, 12, 0, 0)
+
+class Zipf(object):
+    """ sample from a list of items with a Zipfian distribution: item k has weight 1/k^exponent """
+    def __init__(self, items, exponent=1.0, rng=random):
+        self.items = items
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for k in xrange(1, len(items) + 1):
+            total += 1.0 / (k ** exponent)
+            self.cumulative.append(total)
+        self.total = total
+
+    def sample(self):
+        return self.items[bisect.bisect_left(self.cumulative, self.rng.random() * self.total)]
+
+    def samples(self, n):
+        return [self.sample() for i in xrange(n)]
+
+def makeVocabulary(nWords, rng):
+    """ make up nWords pronounceable, distinct words """
+    consonants = "bcdfghjklmnprstvwz"
+    vowels = "aeiou"
+    words = set()
+    while len(words) < nWords:
+        words.add("".join([rng.choice(consonants) + rng.choice(vowels) for i in xrange(rng.randint(2, 4))]))
+    return sorted(words, key=lambda w: rng.random())
+
+def dumpTime(t):
+    """ format a time the way the dump does """
+    return t.strftime("%Y-%m-%dT%H:%M:%S.") + "%03d" % (t.microsecond // 1000)
+
+def randomTime(rng, after=epoch, before=dumpDate):
+    return after + datetime.timedelta(seconds=rng.randint(0, int((before - after).total_seconds())))
+
+def row(attributes):
+    """ format a dump row element from a list of (name, value) pairs; None values are omitted """
+    return "  <row " + " ".join(["%s=%s" % (name, quoteattr(unicode(value))) for (name, value) in attributes if value is not None]) + " />\n"
+
+def makeBody(rng, words, nWords, codeWords=None):
+    """ make an HTML post body of paragraphs, optionally with a code block """
+    paragraphs = []
+    while nWords > 0:
+        n = min(nWords, rng.randint(10, 40))
+        paragraphs.append("<p>" + escape(" ".join(words.samples(n))) + ".</p>")
+        nWords -= n
+    if codeWords:
+        paragraphs.insert(rng.randint(0, len(paragraphs)),
+            "<pre><code>" + escape("%s = %s(%s);" % tuple(codeWords.samples(3))) + "</code></pre>")
+    return "\n".join(paragraphs)
+
+class SyntheticDump(object):
+    """ generate a dump with nQuestions questions and proportional numbers of users, answers and comments """
+    def __init__(self, nQuestions, seed=0, nTags=1000, nWords=20000, answersPerQuestion=2.0, commentsPerPost=1.5,
+        usersPerQuestion=0.5, closedFraction=0.03, tagExponent=1.1, wordExponent=1.0):
+        self.rng = random.Random(seed)
+        self.nQuestions = nQuestions
+        self.nUsers = max(10, int(nQuestions * usersPerQuestion))
+        self.answersPerQuestion = answersPerQuestion
+        self.commentsPerPost = commentsPerPost
+        self.closedFraction = closedFraction
+        self.tagNames = (popularTags + ["tag-%d" % n for n in xrange(nTags)])[:max(nTags, 1)]
+        self.tags = Zipf(self.tagNames, tagExponent, self.rng)
+        self.vocabulary = makeVocabulary(nWords, self.rng)
+        self.words = Zipf(self.vocabulary, wordExponent, self.rng)
+        self.codeWords = Zipf(self.vocabulary[:200], wordExponent, self.rng)
+        # a few users write most of the answers, too
+        self.users = Zipf(range(1, self.nUsers + 1), 1.0, self.rng)
+        self.nPosts = 0
+        self.nComments = 0
+
+    def nFrom(self, mean):
+        """ a small count with the given mean (geometric) """
+        n = 0
+        while self.rng.random() < mean / (mean + 1.0):
+            n += 1
+        return n
+
+    def writeUsers(self, f):
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<users>\n')
+        for userId in xrange(1, self.nUsers + 1):
+            created = randomTime(self.rng)
+            f.write(row([
+                ("Id", userId),
+                ("Reputation", self.rng.randint(1, 1000) * (self.nUsers // userId)),
+                ("CreationDate", dumpTime(created)),
+                ("DisplayName", "user%d" % userId),
+                ("LastAccessDate", dumpTime(randomTime(self.rng, created))),
+                ("Location", None),
+                ("Age", self.rng.randint(16, 70) if self.rng.random() < 0.3 else None),
+                ("Views", self.rng.randint(0, 1000)),
+                ("UpVotes", self.rng.randint(0, 500)),
+                ("DownVotes", self.rng.randint(0, 50))
+            ]).encode("utf-8"))
+        f.write("</users>\n")
+
+    def writePostsAndComments(self, postFile, commentFile):
+        postFile.write('<?xml version="1.0" encoding="utf-8"?>\n<posts>\n')
+        commentFile.write('<?xml version="1.0" encoding="utf-8"?>\n<comments>\n')
+        postId = 0
+        commentId = 0
+        for n in xrange(self.nQuestions):
+            postId += 1
+            questionId = postId
+            created = randomTime(self.rng)
+            tags = []
+            for i in xrange(self.rng.randint(1, 5)):
+                tag = self.tags.sample()
+                if tag not in tags:
+                    tags.append(tag)
+            nAnswers = self.nFrom(self.answersPerQuestion)
+            answerIds = range(questionId + 1, questionId + nAnswers + 1)
+            accepted = self.rng.choice(answerIds) if answerIds and self.rng.random() < 0.6 else None
+            closed = randomTime(self.rng, created) if self.rng.random() < self.closedFraction else None
+            viewCount = int(self.rng.paretovariate(1.2) * 50)
+            posts = [[
+                ("Id", questionId),
+                ("PostTypeId", 1),
+                ("AcceptedAnswerId", accepted),
+                ("CreationDate", dumpTime(created)),
+                ("Score", int(self.rng.gauss(1, 3))),
+                ("ViewCount", viewCount),
+                ("Body", makeBody(self.rng, self.words, self.rng.randint(20, 200), self.codeWords if self.rng.random() < 0.5 else None)),
+                ("OwnerUserId", self.users.sample() if self.rng.random() < 0.98 else None),
+                ("LastActivityDate", dumpTime(randomTime(self.rng, created))),
+                ("ClosedDate", dumpTime(closed) if closed else None),
+                ("Title", " ".join(self.words.samples(self.rng.randint(3, 10))).capitalize() + "?"),
+                ("Tags", "".join(["<%s>" % tag for tag in tags])),
+                ("AnswerCount", nAnswers),
+                ("CommentCount", 0),
+                ("FavoriteCount", self.nFrom(0.5))
+            ]]
+            for answerId in answerIds:
+                answerCreated = randomTime(self.rng, created)
+                posts.append([
+                    ("Id", answerId),
+                    ("PostTypeId", 2),
+                    ("ParentId", questionId),
+                    ("CreationDate", dumpTime(answerCreated)),
+                    ("Score", int(self.rng.gauss(2, 4)) + (3 if answerId == accepted else 0)),
+                    ("Body", makeBody(self.rng, self.words, self.rng.randint(10, 150), self.codeWords if self.rng.random() < 0.6 else None)),
+                    ("OwnerUserId", self.users.sample() if self.rng.random() < 0.98 else None),
+                    ("LastEditorUserId", self.users.sample() if self.rng.random() < 0.1 else None),
+                    ("LastActivityDate", dumpTime(randomTime(self.rng, answerCreated))),
+                    ("CommentCount", 0)
+                ])
+            for post in posts:
+                nComments = self.nFrom(self.commentsPerPost)
+                for i in xrange(nComments):
+                    commentId += 1
+                    template = self.rng.choice(commentTemplates)
+                    text = template % self.words.sample() if "%s" in template else template
+                    commentFile.write(row([
+                        ("Id", commentId),
+                        ("PostId", post[0][1]),
+                        ("Score", self.nFrom(0.3)),
+                        ("Text", text),
+                        ("CreationDate", dumpTime(randomTime(self.rng, created))),
+                        ("UserId", self.users.sample())
+                    ]).encode("utf-8"))
+                post = [(name, nComments if name == "CommentCount" else value) for (name, value) in post]
+                postFile.write(row(post).encode("utf-8"))
+            postId += nAnswers
+        self.nPosts = postId
+        self.nComments = commentId
+        postFile.write("</posts>\n")
+        commentFile.write("</comments>\n")
+
+    def queries(self, nQueries):
+        """ sample queries: a popular tag and a few body words """
+        return [" ".join([self.tags.sample()] + self.words.samples(self.rng.randint(1, 4))) for n in xrange(nQueries)]
+
+    def write(self, directory, nQueries=100):
+        """ write the dump files and queries.txt into directory """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "users.xml"), "wb") as f:
+            self.writeUsers(f)
+        with open(os.path.join(directory, "posts.xml"), "wb") as postFile:
+            with open(os.path.join(directory, "comments.xml"), "wb") as commentFile:
+                self.writePostsAndComments(postFile, commentFile)
+        with open(os.path.join(directory, "queries.txt"), "wb") as f:
+            f.write("\n".join(self.queries(nQueries)) + "\n")
+
+def main():
+    if len(sys.argv) < 3:
+        print >>sys.stderr, "Usage: %s directory nQuestions [seed]" % sys.argv[0]
+        sys.exit(1)
+    directory = sys.argv[1]
+    nQuestions = int(sys.argv[2])
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    dump = SyntheticDump(nQuestions, seed)
+    dump.write(directory)
+    print >>sys.stderr, "Wrote %d users, %d posts and %d comments to %s" % (dump.nUsers, dump.nPosts, dump.nComments, directory)
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@ only the top tags are included, but note that the top ten tags are 50% of the po
 import sys
 import os
 import copy
+import itertools
 import logging
 import gensim
 import nltk
@@ -24,11 +25,14 @@ import re
 import pprint
 import MySQLdb 
 import time
+import threading
 import cPickle as pickle
+import numpy
 from BeautifulSoup import BeautifulSoup
 
 from config import Config
 import util
+import metrics
 
 # tokenizers....
 linkstops = [u"http", u"com", u"org", u"www", u":", u"://", u"/", u"."]
@@ -162,13 +166,13 @@ def getWholePost(db, postId):
     title = None
     wholePost = None
     for question in util.iterateQuestions(db, postList=[postId]):
-        answers = "\n\n".join([answer.body for answer in util.iterateAnswers(db, postId)])
+        answers = "\n\n".join([answer.body for answer in util.iterateAnswers(db, [postId])])
         title = question.title
         wholePost = "\n\n".join([question.title, question.body, answers, question.tags])
     return (title, wholePost)
 
-def makeStackOverflowCorpus(fileName, topic=None, usePostList=False, useTags=[]):
-    db=util.makeDbConnection(Config.myDb)
+def makeStackOverflowCorpus(fileName, topic=None, usePostList=False, useTags=[], database=Config.mySQLdb):
+    db=util.makeDbConnection(database)
     if usePostList:
         print "Using post list"
         if not useTags:
@@ -222,14 +226,37 @@ def makeLDA(fileName, nTopics, fromTfidf=False):
     lda.save(fileName + ".lda")
     return lda
 
-def ldaTopics(fileName, query):
-    """ given a query document, find lda topics """
-    lda = gensim.models.LdaModel.load(fileName + ".lda")
-    dictionary = gensim.corpora.Dictionary.load(fileName + ".dict")
-    queryBow = dictionary.doc2bow(tokenizeText(query, useStemmer=True))
-    topics = lda[queryBow]
+def ldaTopics(topicModel, query):
+    """ given a query document, find lda topics with the (cached) LDA model of a TopicModeling """
+    queryBow = topicModel.dictionary.doc2bow(tokenizeText(query, useStemmer=True))
+    topics = topicModel.lda[queryBow]
     return topics
 
+def topicDistributions(lda, bows):
+    """ infer the LDA topic distributions of a list of bag-of-words documents together (one variational inference
+    pass over the batch). return a (documents x topics) float32 array whose rows sum to 1 """
+    if not bows:
+        return numpy.zeros((0, lda.num_topics), dtype=numpy.float32)
+    gamma = lda.inference(bows)[0]
+    return (gamma / gamma.sum(axis=1)[:, numpy.newaxis]).astype(numpy.float32)
+
+def makeLdaDocuments(fileName, chunkSize=2000):
+    """ precompute the topic distributions of the corpus documents, chunkSize documents at a time. They are saved
+    as their square roots, so that the Bhattacharyya coefficient with a query is a dot product """
+    corpus = gensim.corpora.MmCorpus(fileName + ".mm")
+    lda = gensim.models.LdaModel.load(fileName + ".lda")
+    rootTopics = numpy.empty((len(corpus), lda.num_topics), dtype=numpy.float32)
+    documents = iter(corpus)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(documents, chunkSize))
+        if not chunk:
+            break
+        rootTopics[start:start + len(chunk)] = numpy.sqrt(topicDistributions(lda, chunk))
+        start += len(chunk)
+    numpy.save(fileName + ".ldadocs.npy", rootTopics)
+    return rootTopics
+
 def makeSimilarityIndex(fileName, fromTfIdf=False):
     corpus = gensim.corpora.MmCorpus(fileName + ".mm")
     if fromTfIdf:
@@ -243,6 +270,93 @@ def makeSimilarityIndex(fileName, fromTfIdf=False):
     index.save(fileName + ".index")
     return index
 
+class QuantizedIndex(object):
+    """ the unit LSI vectors of the corpus documents at reduced precision, as a replacement for the gensim similarity 
+    index: float16, or int8 with one scale per document vector (its largest absolute component / 127). 
+    The similarities are cosine similarities, like those of the gensim index, up to the rounding of the vectors. 
+    """
+    precisions = ("float16", "int8")
+
+    def __init__(self, vectors, scales=None):
+        self.vectors = vectors          # (documents x topics) float16 or int8
+        self.scales = scales            # float32 per document for int8, otherwise None
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def numTopics(self):
+        return self.vectors.shape[1]
+
+    @property
+    def precision(self):
+        return "int8" if self.scales is not None else "float16"
+
+    @staticmethod
+    def quantize(vectors, precision="float16"):
+        """ quantize a (documents x topics) array of vectors, normalizing them first. 
+        return (quantized vectors, scales or None) """
+        vectors = numpy.asarray(vectors, dtype=numpy.float32)
+        vectors = vectors / numpy.maximum(numpy.sqrt((vectors ** 2).sum(axis=1)), 1e-12)[:, numpy.newaxis]
+        if precision == "float16":
+            return (vectors.astype(numpy.float16), None)
+        elif precision == "int8":
+            scales = numpy.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            return (numpy.round(vectors / scales[:, numpy.newaxis]).astype(numpy.int8), scales.astype(numpy.float32))
+        raise ValueError("unknown precision %s (use one of %s)" % (precision, ", ".join(QuantizedIndex.precisions)))
+
+    @staticmethod
+    def fromCorpus(lsiCorpus, numTopics, precision="float16", chunkSize=10000):
+        """ build the index from a corpus of LSI document vectors (eg, lsi[tfidf[corpus]]), chunkSize documents at a time """
+        chunks = []
+        scaleChunks = []
+        documents = iter(lsiCorpus)
+        while True:
+            chunk = list(itertools.islice(documents, chunkSize))
+            if not chunk:
+                break
+            vectors, scales = QuantizedIndex.quantize(gensim.matutils.corpus2dense(chunk, numTopics, len(chunk)).T, precision)
+            chunks.append(vectors)
+            scaleChunks.append(scales)
+        dtype = numpy.float16 if precision == "float16" else numpy.int8
+        vectors = numpy.concatenate(chunks) if chunks else numpy.zeros((0, numTopics), dtype=dtype)
+        scales = None if precision == "float16" else (numpy.concatenate(scaleChunks) if scaleChunks else numpy.zeros(0, dtype=numpy.float32))
+        return QuantizedIndex(vectors, scales)
+
+    def similarities(self, queryLsis, chunkSize=65536):
+        """ the similarity of every document to each LSI query vector as a (queries x documents) float32 array.
+        The documents are converted back to float32 chunkSize at a time, so only one chunk is ever held at full precision """
+        queries = gensim.matutils.corpus2dense(queryLsis, self.numTopics, len(queryLsis)).T.astype(numpy.float32)
+        queries /= numpy.maximum(numpy.sqrt((queries ** 2).sum(axis=1)), 1e-12)[:, numpy.newaxis]
+        result = numpy.empty((len(queries), len(self)), dtype=numpy.float32)
+        for start in xrange(0, len(self), chunkSize):
+            chunk = numpy.dot(self.vectors[start:start + chunkSize].astype(numpy.float32), queries.T).T
+            if self.scales is not None:
+                chunk *= self.scales[start:start + chunkSize]
+            result[:, start:start + chunkSize] = chunk
+        return result
+
+    def save(self, fileName):
+        if self.scales is None:
+            numpy.savez(fileName, vectors=self.vectors)
+        else:
+            numpy.savez(fileName, vectors=self.vectors, scales=self.scales)
+
+    @staticmethod
+    def load(fileName):
+        arrays = numpy.load(fileName)
+        return QuantizedIndex(arrays["vectors"], arrays["scales"] if "scales" in arrays.files else None)
+
+def makeQuantizedIndex(fileName, precision="float16"):
+    """ make the reduced precision index of a corpus, from TF-IDF like the similarity index """
+    corpus = gensim.corpora.MmCorpus(fileName + ".mm")
+    tfidf = gensim.models.TfidfModel.load(fileName + ".tfidf")
+    lsi = gensim.models.LsiModel.load(fileName + ".lsi")
+    index = QuantizedIndex.fromCorpus(lsi[tfidf[corpus]], lsi.num_topics, precision)
+    index.save(fileName + ".qindex.npz")
+    return index
+
 def displayMatches(db, matches, start=0, maxresults=5):
     for match in matches[start:(start+maxresults)]:
         print >>sys.stderr, "Working on match:", match
@@ -261,33 +375,562 @@ class QueryResult:
             self.post = util.Post.fromPostId(db, self.id)
             self.similarity = match[1]
 
-class TopicModeling(object):
-    """ class to keep references to all the parts of the topic model (aka index) in memory"""
-    def __init__(self, corpusName):
+# the parts of a question needed to display a query result
+PostSummary = util.postRecordType(util.summaryColumns)
+
+class PostMetadata(object):
+    """ compact, array-backed metadata for the questions in a corpus, indexed by corpus document id.
+    Titles are kept as one UTF-8 buffer with an array of offsets into it.
+    """
+    def __init__(self, postIds, titleOffsets, titles, closed, ownerUserIds, answerCounts):
+        self.postIds = postIds
+        self.titleOffsets = titleOffsets
+        self.titles = titles
+        self.closed = closed
+        self.ownerUserIds = ownerUserIds    # -1 if there is no owner
+        self.answerCounts = answerCounts
+
+    def __len__(self):
+        return len(self.postIds)
+
+    def title(self, corpusDoc):
+        return self.titles[self.titleOffsets[corpusDoc]:self.titleOffsets[corpusDoc + 1]].tostring().decode("utf-8")
+
+    def summary(self, corpusDoc):
+        ownerUserId = int(self.ownerUserIds[corpusDoc])
+        return PostSummary(
+            int(self.postIds[corpusDoc]), 
+            self.title(corpusDoc), 
+            ownerUserId if ownerUserId >= 0 else None, 
+            int(self.answerCounts[corpusDoc]))
+
+    @staticmethod
+    def fromDatabase(db, docToPost, selectRate=5000):
+        """ load the metadata of the posts in docToPost (an array of post ids by corpus document id).
+        Posts that are no longer in the database are marked closed. """
+        rows = {}
+        c = db.cursor()
+        for start in xrange(0, len(docToPost), selectRate):
+            c.execute("""
+            SELECT id, title, closed_date IS NOT NULL, owner_user_id, answer_count 
+            FROM posts 
+            WHERE id IN (%s)""" % ",".join([str(postId) for postId in docToPost[start:(start + selectRate)]]))
+            for row in c.fetchall():
+                rows[int(row[0])] = row[1:]
+        c.close()
+        nDocs = len(docToPost)
+        titleOffsets = numpy.zeros(nDocs + 1, dtype=numpy.int64)
+        closed = numpy.zeros(nDocs, dtype=numpy.bool_)
+        ownerUserIds = numpy.zeros(nDocs, dtype=numpy.int32)
+        answerCounts = numpy.zeros(nDocs, dtype=numpy.int32)
+        titles = []
+        for (corpusDoc, postId) in enumerate(docToPost):
+            title, isClosed, ownerUserId, answerCount = rows.get(int(postId), (None, True, None, 0))
+            encodedTitle = (title or u"").encode("utf-8")
+            titles.append(encodedTitle)
+            titleOffsets[corpusDoc + 1] = titleOffsets[corpusDoc] + len(encodedTitle)
+            closed[corpusDoc] = bool(isClosed)
+            ownerUserIds[corpusDoc] = ownerUserId if ownerUserId is not None else -1
+            answerCounts[corpusDoc] = answerCount or 0
+        return PostMetadata(
+            numpy.asarray(docToPost, dtype=numpy.int32), titleOffsets, numpy.fromstring("".join(titles), dtype=numpy.uint8),
+            closed, ownerUserIds, answerCounts)
+
+    def save(self, fileName):
+        numpy.savez(fileName, postIds=self.postIds, titleOffsets=self.titleOffsets, titles=self.titles,
+            closed=self.closed, ownerUserIds=self.ownerUserIds, answerCounts=self.answerCounts)
+
+    @staticmethod
+    def load(fileName):
+        arrays = numpy.load(fileName)
+        return PostMetadata(arrays["postIds"], arrays["titleOffsets"], arrays["titles"], 
+            arrays["closed"], arrays["ownerUserIds"], arrays["answerCounts"])
+
+def deadDocuments(db, docToPost, selectRate=5000):
+    """ return a boolean array by corpus document id, set for closed posts and posts no longer in the database """
+    dead = numpy.ones(len(docToPost), dtype=numpy.bool_)
+    postToDoc = {int(postId) : corpusDoc for (corpusDoc, postId) in enumerate(docToPost)}
+    c = db.cursor()
+    for start in xrange(0, len(docToPost), selectRate):
+        c.execute("""SELECT id FROM posts WHERE id IN (%s) AND closed_date IS NULL""" % 
+            ",".join([str(postId) for postId in docToPost[start:(start + selectRate)]]))
+        for row in c.fetchall():
+            dead[postToDoc[int(row[0])]] = False
+    c.close()
+    return dead
+
+def makeDeadDocuments(fileName, database=Config.mySQLdb):
+    """ make (or remake) the closed/deleted document bitmap for a corpus. The index does not need to be rebuilt. """
+    corpusToPost = StackOverflowCorpus.loadCorpusToPost(fileName + ".c2p")
+    db = util.makeDbConnection(database)
+    try:
+        dead = deadDocuments(db, [corpusToPost[corpusDoc] for corpusDoc in xrange(len(corpusToPost))])
+    finally:
+        db.close()
+    numpy.save(fileName + ".dead.npy", dead)
+    return dead
+
+def makePostMetadata(fileName, database=Config.mySQLdb):
+    """ make the post metadata store for a corpus """
+    corpusToPost = StackOverflowCorpus.loadCorpusToPost(fileName + ".c2p")
+    db = util.makeDbConnection(database)
+    try:
+        metadata = PostMetadata.fromDatabase(db, [corpusToPost[corpusDoc] for corpusDoc in xrange(len(corpusToPost))])
+    finally:
+        db.close()
+    metadata.save(fileName + ".meta.npz")
+    return metadata
+
+class AnswerVectors(object):
+    """ the unit LSI vectors of the answers to the corpus questions, computed at index time, so that the relevance
+    of every candidate answer to a query is a single matrix-vector product """
+    def __init__(self, answerIds, vectors):
+        # sorted answer ids and the (answers x topics) float32 vector of each
+        self.answerIds = answerIds
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.answerIds)
+
+    def lookup(self, answerIds):
+        """ return (the row of each answer, whether it has a vector) """
+        answerIds = numpy.asarray(answerIds, dtype=numpy.int64)
+        if not len(self.answerIds):
+            return (numpy.zeros(len(answerIds), dtype=numpy.int64), numpy.zeros(len(answerIds), dtype=numpy.bool_))
+        rows = numpy.minimum(numpy.searchsorted(self.answerIds, answerIds), len(self.answerIds) - 1)
+        return (rows, self.answerIds[rows] == answerIds)
+
+    def relevance(self, queryVector, answerIds):
+        """ the cosine similarity of each answer to a dense unit query vector. Answers without a vector get 1.0 """
+        relevance = numpy.ones(len(answerIds))
+        if not len(self.answerIds) or not len(answerIds):
+            return relevance
+        rows, known = self.lookup(answerIds)
+        relevance[known] = numpy.dot(self.vectors[rows[known]], numpy.asarray(queryVector, dtype=numpy.float32))
+        return relevance
+
+    @staticmethod
+    def fromDatabase(db, docToPost, dictionary, tfidf, lsi, selectRate=1000):
+        """ tokenize and project the answers to the questions in docToPost. 
+        Answers without any words in the dictionary are left out. """
+        answerIds = []
+        chunks = []
+        for start in xrange(0, len(docToPost), selectRate):
+            chunkIds = []
+            chunkLsis = []
+            for answer in util.iterateAnswers(db, docToPost[start:start + selectRate], columns=("id", "body")):
+                answerBow = dictionary.doc2bow(tokenizePost("", answer.body, [], ""))
+                if answerBow:
+                    chunkIds.append(answer.id)
+                    chunkLsis.append(lsi[tfidf[answerBow]])
+            if chunkIds:
+                vectors = gensim.matutils.corpus2dense(chunkLsis, lsi.num_topics, len(chunkLsis)).T.astype(numpy.float32)
+                vectors /= numpy.maximum(numpy.sqrt((vectors ** 2).sum(axis=1)), 1e-12)[:, numpy.newaxis]
+                answerIds += chunkIds
+                chunks.append(vectors)
+            logging.debug("%d answers to %d documents" % (len(answerIds), min(start + selectRate, len(docToPost))))
+        answerIds = numpy.array(answerIds, dtype=numpy.int64)
+        vectors = numpy.concatenate(chunks) if chunks else numpy.zeros((0, lsi.num_topics), dtype=numpy.float32)
+        order = numpy.argsort(answerIds, kind="mergesort")
+        return AnswerVectors(answerIds[order], vectors[order])
+
+    def save(self, fileName):
+        numpy.savez(fileName, answerIds=self.answerIds, vectors=self.vectors)
+
+    @staticmethod
+    def load(fileName):
+        arrays = numpy.load(fileName)
+        return AnswerVectors(arrays["answerIds"], arrays["vectors"])
+
+def makeAnswerVectors(fileName, database=Config.mySQLdb):
+    """ compute and save the answer vectors of corpus fileName """
+    corpusToPost = StackOverflowCorpus.loadCorpusToPost(fileName + ".c2p")
+    docToPost = [corpusToPost[corpusDoc] for corpusDoc in xrange(len(corpusToPost))]
+    dictionary = gensim.corpora.Dictionary.load(fileName + ".dict")
+    tfidf = gensim.models.TfidfModel.load(fileName + ".tfidf")
+    lsi = gensim.models.LsiModel.load(fileName + ".lsi")
+    db = util.makeDbConnection(database)
+    answerVectors = AnswerVectors.fromDatabase(db, docToPost, dictionary, tfidf, lsi)
+    db.close()
+    answerVectors.save(fileName + ".answers.npz")
+    return answerVectors
+
+class TagIndex(object):
+    """ posting lists from tag to corpus document ids, for filtering queries by tag.
+    The posting lists are sorted document ids, delta encoded: each list is stored as the gaps between its ids 
+    (the first gap is from 0) in uint16, stored end to end with an array of offsets. Gaps that do not fit in a uint16
+    are stored as gapEscape, and their real values in order in an int64 exceptions array with its own offsets per tag.
+    Tags on more than 1/32 of the documents, where a bitmap is smaller than the list, are (also) kept as packed bitmaps.
+    Tag names are kept as one UTF-8 buffer with offsets, like the titles in PostMetadata, and are sorted.
+    """
+    gapEscape = 0xffff
+
+    def __init__(self, nDocs, nameOffsets, names, offsets, gaps, exceptionOffsets, exceptions, bitmapTags, bitmaps):
+        self.nDocs = nDocs
+        self.nameOffsets = nameOffsets
+        self.names = names
+        self.offsets = offsets
+        self.gaps = gaps
+        self.exceptionOffsets = exceptionOffsets
+        self.exceptions = exceptions
+        self.bitmapTags = bitmapTags    # the tag numbers with bitmaps, one row of bitmaps each
+        self.bitmaps = bitmaps
+        self.tagNumbers = {self.tag(tagNumber) : tagNumber for tagNumber in xrange(len(self))}
+        self.bitmapRows = {int(tagNumber) : row for (row, tagNumber) in enumerate(bitmapTags)}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def tag(self, tagNumber):
+        return self.names[self.nameOffsets[tagNumber]:self.nameOffsets[tagNumber + 1]].tostring().decode("utf-8")
+
+    @staticmethod
+    def encodePostings(docs, offsets):
+        """ delta encode posting lists of sorted document ids stored end to end, with offsets by tag number.
+        return (gaps, exception offsets, exceptions) """
+        docs = numpy.asarray(docs, dtype=numpy.int64)
+        gaps = numpy.empty(len(docs), dtype=numpy.int64)
+        gaps[1:] = docs[1:] - docs[:-1]
+        # each list starts from 0
+        starts = offsets[:-1][offsets[:-1] < offsets[1:]]
+        gaps[starts] = docs[starts]
+        escaped = gaps >= TagIndex.gapEscape
+        exceptionOffsets = numpy.zeros(len(docs) + 1, dtype=numpy.int64)
+        exceptionOffsets[1:] = numpy.cumsum(escaped)
+        exceptions = gaps[escaped]
+        gaps[escaped] = TagIndex.gapEscape
+        return (gaps.astype(numpy.uint16), exceptionOffsets[offsets], exceptions)
+
+    def postingCount(self, tag):
+        """ the number of documents with a tag """
+        tagNumber = self.tagNumbers.get(tag)
+        return 0 if tagNumber is None else int(self.offsets[tagNumber + 1] - self.offsets[tagNumber])
+
+    def postings(self, tag):
+        """ the sorted document ids with a tag (none for unknown tags) """
+        tagNumber = self.tagNumbers.get(tag)
+        if tagNumber is None:
+            return numpy.zeros(0, dtype=numpy.int64)
+        gaps = self.gaps[self.offsets[tagNumber]:self.offsets[tagNumber + 1]].astype(numpy.int64)
+        gaps[gaps == self.gapEscape] = self.exceptions[self.exceptionOffsets[tagNumber]:self.exceptionOffsets[tagNumber + 1]]
+        return numpy.cumsum(gaps)
+
+    def hasBitmap(self, tag):
+        return self.tagNumbers.get(tag) in self.bitmapRows
+
+    def tagMask(self, tag):
+        """ a boolean array by document id, set for the documents with a tag """
+        row = self.bitmapRows.get(self.tagNumbers.get(tag))
+        if row is not None:
+            return numpy.unpackbits(self.bitmaps[row])[:self.nDocs].astype(numpy.bool_)
+        mask = numpy.zeros(self.nDocs, dtype=numpy.bool_)
+        mask[self.postings(tag)] = True
+        return mask
+
+    def mask(self, tags, matchAll=False):
+        """ a boolean array by document id, set for the documents with any (or, with matchAll, all) of the tags """
+        tags = list(tags)
+        if matchAll and tags and not any([self.hasBitmap(tag) for tag in tags]):
+            # intersect the shortest posting list with the others
+            tags.sort(key=self.postingCount)
+            docs = self.postings(tags[0])
+            for tag in tags[1:]:
+                docs = docs[numpy.in1d(docs, self.postings(tag), assume_unique=True)]
+            mask = numpy.zeros(self.nDocs, dtype=numpy.bool_)
+            mask[docs] = True
+            return mask
+        mask = numpy.ones(self.nDocs, dtype=numpy.bool_) if matchAll else numpy.zeros(self.nDocs, dtype=numpy.bool_)
+        for tag in tags:
+            if matchAll:
+                mask &= self.tagMask(tag)
+            else:
+                mask |= self.tagMask(tag)
+        return mask
+
+    @staticmethod
+    def fromDatabase(db, docToPost, selectRate=5000):
+        """ build the posting lists of the questions in docToPost (an array of post ids by corpus document id) 
+        from the tags table. The answer_tags table only copies the tags of each question to its answers, 
+        so it adds nothing for question documents. """
+        postToDoc = {int(postId) : corpusDoc for (corpusDoc, postId) in enumerate(docToPost)}
+        tagNumbers = {}
+        tagColumn = []
+        docColumn = []
+        c = db.cursor()
+        for start in xrange(0, len(docToPost), selectRate):
+            c.execute("""SELECT post_id, tag FROM tags WHERE post_id IN (%s)""" % 
+                ",".join([str(postId) for postId in docToPost[start:(start + selectRate)]]))
+            for (postId, tag) in c.fetchall():
+                tagColumn.append(tagNumbers.setdefault(tag, len(tagNumbers)))
+                docColumn.append(postToDoc[int(postId)])
+        c.close()
+        # renumber the tags in name order
+        tags = sorted(tagNumbers)
+        renumber = numpy.zeros(len(tags), dtype=numpy.int32)
+        for (tagNumber, tag) in enumerate(tags):
+            renumber[tagNumbers[tag]] = tagNumber
+        tagColumn = renumber[numpy.array(tagColumn, dtype=numpy.int32)]
+        docColumn = numpy.array(docColumn, dtype=numpy.int32)
+        order = numpy.lexsort((docColumn, tagColumn))
+        tagColumn, docColumn = tagColumn[order], docColumn[order]
+        # a tag listed twice for a post counts once
+        keep = numpy.ones(len(order), dtype=numpy.bool_)
+        keep[1:] = (tagColumn[1:] != tagColumn[:-1]) | (docColumn[1:] != docColumn[:-1])
+        tagColumn, docColumn = tagColumn[keep], docColumn[keep]
+        offsets = numpy.zeros(len(tags) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(numpy.bincount(tagColumn, minlength=len(tags))) if len(tags) else []
+        encodedNames = [tag.encode("utf-8") for tag in tags]
+        nameOffsets = numpy.zeros(len(tags) + 1, dtype=numpy.int64)
+        nameOffsets[1:] = numpy.cumsum([len(name) for name in encodedNames]) if tags else []
+        nDocs = len(docToPost)
+        bitmapTags = numpy.array([tagNumber for tagNumber in xrange(len(tags)) 
+            if (offsets[tagNumber + 1] - offsets[tagNumber]) * 32 > nDocs], dtype=numpy.int32)
+        bitmaps = numpy.zeros((len(bitmapTags), (nDocs + 7) // 8), dtype=numpy.uint8)
+        for (row, tagNumber) in enumerate(bitmapTags):
+            mask = numpy.zeros(nDocs, dtype=numpy.bool_)
+            mask[docColumn[offsets[tagNumber]:offsets[tagNumber + 1]]] = True
+            bitmaps[row] = numpy.packbits(mask)
+        gaps, exceptionOffsets, exceptions = TagIndex.encodePostings(docColumn, offsets)
+        return TagIndex(nDocs, nameOffsets, numpy.fromstring("".join(encodedNames), dtype=numpy.uint8), 
+            offsets, gaps, exceptionOffsets, exceptions, bitmapTags, bitmaps)
+
+    def save(self, fileName):
+        numpy.savez(fileName, nDocs=numpy.array(self.nDocs), nameOffsets=self.nameOffsets, names=self.names, 
+            offsets=self.offsets, gaps=self.gaps, exceptionOffsets=self.exceptionOffsets, exceptions=self.exceptions, 
+            bitmapTags=self.bitmapTags, bitmaps=self.bitmaps)
+
+    @staticmethod
+    def load(fileName):
+        arrays = numpy.load(fileName)
+        if "docs" in arrays.files:
+            # written before the posting lists were delta encoded
+            gaps, exceptionOffsets, exceptions = TagIndex.encodePostings(arrays["docs"], arrays["offsets"])
+        else:
+            gaps, exceptionOffsets, exceptions = arrays["gaps"], arrays["exceptionOffsets"], arrays["exceptions"]
+        return TagIndex(int(arrays["nDocs"]), arrays["nameOffsets"], arrays["names"], arrays["offsets"], 
+            gaps, exceptionOffsets, exceptions, arrays["bitmapTags"], arrays["bitmaps"])
+
+def makeTagIndex(fileName, database=Config.mySQLdb):
+    """ make the tag posting lists for a corpus """
+    corpusToPost = StackOverflowCorpus.loadCorpusToPost(fileName + ".c2p")
+    db = util.makeDbConnection(database)
+    try:
+        tagIndex = TagIndex.fromDatabase(db, [corpusToPost[corpusDoc] for corpusDoc in xrange(len(corpusToPost))])
+    finally:
+        db.close()
+    tagIndex.save(fileName + ".tags.npz")
+    return tagIndex
+
+class PostQueries(object):
+    """ turning similarity query matches into QueryResults. Subclasses provide similarityQueries, metadata 
+    (None if posts must be fetched from the database) and resultsFromMetadata """
+    def similarityQuery(self, query, cutoff=0, tags=None, matchAll=False):
+        """ perform a similarity query. return matching post ids, similarity score, and corpus id """
+        return self.similarityQueries([query], cutoff, tags, matchAll)[0]
+
+    def queryResults(self, db, query, cutoff=0.5):
+        """ return query results as a list of QueryResult instances
+        """
+        matchingPosts = self.similarityQuery(query, cutoff);
+        if self.metadata is not None:
+            return self.resultsFromMetadata(matchingPosts)
+        # link id->similarity
+        postMatches = {match[0] : match[1] for match in matchingPosts}
+        if not postMatches:
+            return []
+        # get the actual posts, but remove the closed ones
+        with metrics.stage("post_fetch"):
+            posts = util.Post.fromPostIds(db, postMatches, removeClosed=True) or []
+        logging.debug("returning %d open posts" % len(posts))
+        return [QueryResult(db, postMatches[post.id], post=post) for post in posts]
+
+    def queryResultsBatch(self, db, queries, cutoff=0.5):
+        """ return query results for a list of queries as a list of lists of QueryResult instances.
+        The open posts for the whole batch are fetched with one query.
+        """
+        matchesByQuery = self.similarityQueries(queries, cutoff)
+        if self.metadata is not None:
+            return [self.resultsFromMetadata(matchingPosts) for matchingPosts in matchesByQuery]
+        postIds = list(set(match[0] for matchingPosts in matchesByQuery for match in matchingPosts))
+        posts = self.fetchPosts(db, postIds)
+        logging.debug("returning open posts for %d queries" % len(queries))
+        return [self.resultsFromPosts(db, matchingPosts, posts) for matchingPosts in matchesByQuery]
+
+    @metrics.timed("post_fetch")
+    def fetchPosts(self, db, postIds):
+        """ fetch the open posts with the given ids, in no particular order """
+        return util.Post.fromPostIds(db, postIds, removeClosed=True, ordered=False, columns=util.summaryColumns) if postIds else None
+
+    def resultsFromPosts(self, db, matchingPosts, posts):
+        """ combine similarityQuery matches with the fetched posts into QueryResults in similarity order.
+        matches without a post (eg, closed posts) are dropped """
+        openPosts = {post.id : post for post in (posts or [])}
+        return [QueryResult(db, similarity, post=openPosts[postId]) for (postId, similarity, corpusDoc) in matchingPosts if postId in openPosts]
+
+class TopicModeling(PostQueries):
+    """ class to keep references to all the parts of the topic model (aka index) in memory.
+    A dictionary that was already loaded (eg, the same one, shared by several corpora) may be passed in. """
+    # the most similarities (queries x documents) held in memory by one index scan
+    maxScanSize = 1 << 25
+
+    def __init__(self, corpusName, dictionary=None):
         self.corpusName = corpusName
-        self.index = gensim.similarities.Similarity.load(corpusName + ".index")
+        # the reduced precision index replaces the gensim one if it was built
+        if os.path.isfile(corpusName + ".qindex.npz"):
+            self.index = QuantizedIndex.load(corpusName + ".qindex.npz")
+        else:
+            self.index = gensim.similarities.Similarity.load(corpusName + ".index")
         self.lsi = gensim.models.LsiModel.load(corpusName + ".lsi")
         self.corpus = gensim.corpora.MmCorpus(corpusName + ".mm")
-        self.dictionary = gensim.corpora.Dictionary.load(corpusName + ".dict")
+        self.dictionary = dictionary if dictionary is not None else gensim.corpora.Dictionary.load(corpusName + ".dict")
         self.corpusToPost = StackOverflowCorpus.loadCorpusToPost(corpusName + ".c2p")
+        self.docToPost = numpy.array([self.corpusToPost[corpusDoc] for corpusDoc in xrange(len(self.corpusToPost))])
+        if os.path.isfile(corpusName + ".meta.npz"):
+            self.metadata = PostMetadata.load(corpusName + ".meta.npz")
+        else:
+            logging.warning("no post metadata store for %s: posts will be fetched from the database" % corpusName)
+            self.metadata = None
+        # documents that are never returned: closed or deleted posts
+        if os.path.isfile(corpusName + ".dead.npy"):
+            self.dead = numpy.load(corpusName + ".dead.npy")
+        elif self.metadata is not None:
+            self.dead = self.metadata.closed.copy()
+        else:
+            self.dead = None
         self.tfidf = gensim.models.TfidfModel.load(corpusName + ".tfidf")
         self.corpusTfidf = self.tfidf[self.corpus]
+        if os.path.isfile(corpusName + ".answers.npz"):
+            self.answerVectors = AnswerVectors.load(corpusName + ".answers.npz")
+        else:
+            self.answerVectors = None
+        if os.path.isfile(corpusName + ".tags.npz"):
+            self.tagIndex = TagIndex.load(corpusName + ".tags.npz")
+        else:
+            self.tagIndex = None
+        # "lsi" queries the similarity index, "lda" the precomputed LDA topic distributions of the documents
+        self.similarityModel = getattr(Config, "similarityModel", "lsi")
+        self._lda = None
+        self._ldaLock = threading.Lock()
+        if os.path.isfile(corpusName + ".ldadocs.npy"):
+            self.ldaDocuments = numpy.load(corpusName + ".ldadocs.npy", mmap_mode="r")
+        else:
+            self.ldaDocuments = None
+        if self.similarityModel == "lda":
+            if self.ldaDocuments is None:
+                raise ValueError("no LDA document topics for %s: set ldaPostsPerTopic and run topic_classification.py to make %s.ldadocs.npy" % (corpusName, corpusName))
+            # load it now rather than in the first query
+            self.lda
     
-    def similarityQuery(self, query, cutoff=0):
-        """ perform a similarity query. return matching post ids, similarity score, and corpus id """
-        logging.debug("tokenizing query...")
-        queryBow = self.dictionary.doc2bow(tokenizeText(query, useStemmer=True))
-        logging.debug("converting query to LSI space...")
-        queryLsi = self.lsi[queryBow]
-        logging.debug("querying the index...")
-        results = self.index[queryLsi]
-        logging.debug("filtering %d results..." % len(results))
-        matchingPosts = [(self.corpusToPost[corpusDoc], similarity, corpusDoc ) for corpusDoc, similarity in enumerate(results) if similarity >= cutoff] 
-        logging.debug("sorting %d results..." % len(matchingPosts))
-        matchingPosts.sort(key=lambda match: -match[1])
-        logging.debug("sorting complete...")
-        return matchingPosts
+    @property
+    def lda(self):
+        """ the LDA model of the corpus, loaded on first use """
+        with self._ldaLock:
+            if self._lda is None:
+                self._lda = gensim.models.LdaModel.load(self.corpusName + ".lda")
+            return self._lda
     
+    def projectQueries(self, queries, useTfidf=False):
+        """ tokenize a list of queries and convert them to LSI space together """
+        logging.debug("tokenizing %d queries..." % len(queries))
+        with metrics.stage("tokenize"):
+            queryBows = [self.dictionary.doc2bow(tokenizeText(query, useStemmer=True)) for query in queries]
+        logging.debug("converting queries to LSI space...")
+        with metrics.stage("lsi_projection"):
+            if useTfidf:
+                queryBows = [self.tfidf[queryBow] for queryBow in queryBows]
+            return [queryLsi for queryLsi in self.lsi[queryBows]]
+
+    def answerRelevance(self, query, answerIds):
+        """ the similarity of each answer to the query, from the precomputed answer vectors.
+        Answers without a vector (or all of them, if there are no answer vectors) get 1.0 """
+        if self.answerVectors is None:
+            return numpy.ones(len(answerIds))
+        # the answer vectors were projected from TF-IDF, so the query is too
+        (queryLsi,) = self.projectQueries([query], useTfidf=True)
+        with metrics.stage("answer_relevance"):
+            queryVector = gensim.matutils.unitvec(gensim.matutils.sparse2full(queryLsi, self.lsi.num_topics))
+            return self.answerVectors.relevance(queryVector, answerIds)
+
+    @metrics.timed("index_scan")
+    def scanIndex(self, queryLsis):
+        """ return the similarity of every document to each LSI query vector as a (queries x documents) array """
+        logging.debug("querying the index with %d queries..." % len(queryLsis))
+        if isinstance(self.index, QuantizedIndex):
+            return self.index.similarities(queryLsis)
+        return numpy.atleast_2d(numpy.asarray(self.index[queryLsis]))
+
+    def ldaQueryTopics(self, queries):
+        """ tokenize a list of queries and infer their LDA topic distributions together. 
+        return a (queries x topics) array """
+        with metrics.stage("tokenize"):
+            queryBows = [self.dictionary.doc2bow(tokenizeText(query, useStemmer=True)) for query in queries]
+        with metrics.stage("lda_inference"):
+            return topicDistributions(self.lda, queryBows)
+
+    @metrics.timed("index_scan")
+    def scanLdaDocuments(self, queryTopics):
+        """ return the Bhattacharyya coefficient of each query topic distribution with every document's as a 
+        (queries x documents) array: 1 for the same distribution, 0 for ones without a topic in common.
+        (The Hellinger distance is sqrt(1 - coefficient)) """
+        if self.ldaDocuments is None:
+            raise ValueError("no LDA document topics for %s: run topic_classification.py to make %s.ldadocs.npy" % (self.corpusName, self.corpusName))
+        logging.debug("comparing %d queries to the document topics..." % len(queryTopics))
+        return numpy.dot(numpy.sqrt(queryTopics), self.ldaDocuments.T)
+
+    @metrics.timed("tag_filter")
+    def tagMask(self, tags, matchAll=False):
+        """ a boolean array by corpus document id of the documents with any (or all) of the tags, 
+        or None if tags is empty """
+        if not tags:
+            return None
+        if self.tagIndex is None:
+            raise ValueError("no tag index for %s: run topic_classification.py to make %s.tags.npz" % (self.corpusName, self.corpusName))
+        return self.tagIndex.mask(tags, matchAll)
+
+    @metrics.timed("filter_sort")
+    def selectMatches(self, similarities, cutoff=0, mask=None):
+        """ select the documents with a similarity of at least cutoff from one row of scanIndex, most similar first.
+        If mask (a boolean array by corpus document id) is given, only the documents set in it are selected.
+        return matching post ids, similarity score, and corpus id """
+        logging.debug("filtering %d results..." % len(similarities))
+        selected = similarities >= cutoff
+        dead = self.dead
+        if dead is not None:
+            selected &= ~dead
+        if mask is not None:
+            selected &= mask
+        matchingDocs = numpy.flatnonzero(selected)
+        logging.debug("sorting %d results..." % len(matchingDocs))
+        matchingDocs = matchingDocs[numpy.argsort(-similarities[matchingDocs], kind="mergesort")]
+        return [(int(self.docToPost[corpusDoc]), float(similarities[corpusDoc]), int(corpusDoc)) for corpusDoc in matchingDocs]
+
+    def refreshDeadDocuments(self, db):
+        """ reload the closed/deleted document bitmap from the database and save it, without rebuilding the index """
+        dead = deadDocuments(db, self.docToPost)
+        numpy.save(self.corpusName + ".dead.npy", dead)
+        self.dead = dead
+        logging.info("%d of %d documents are closed or deleted" % (dead.sum(), len(dead)))
+        return dead
+
+    def similarityQueries(self, queries, cutoff=0, tags=None, matchAll=False):
+        """ perform similarity queries for a list of queries with a single index scan. 
+        If tags are given, only posts with any (or, with matchAll, all) of them match.
+        return a list of similarityQuery results, one per query """
+        if not queries:
+            return []
+        mask = self.tagMask(tags, matchAll)
+        # a scan holds a (queries x documents) array, so large batches are scanned a chunk of queries at a time
+        chunkSize = max(1, self.maxScanSize // max(1, len(self.docToPost)))
+        matches = []
+        for start in xrange(0, len(queries), chunkSize):
+            chunk = queries[start:start + chunkSize]
+            if self.similarityModel == "lda":
+                similarities = self.scanLdaDocuments(self.ldaQueryTopics(chunk))
+            else:
+                similarities = self.scanIndex(self.projectQueries(chunk))
+            matches.extend([self.selectMatches(row, cutoff, mask) for row in similarities])
+        return matches
+
     class QuerySimilarity:
         """ allow comparisons of the same query to multiple other documents """
         def __init__(self, topicModel, query):
@@ -319,31 +962,22 @@ class TopicModeling(object):
             print >>sys.stderr, "WARNING: Document did not bow:", document
             return 0.5
 
-    def queryResults(self, db, query, cutoff=0.5):
-        """ return query results as a list of QueryResult instances
-        """
-        matchingPosts = self.similarityQuery(query, cutoff);
-        # link id->similarity
-        postMatches = {match[0] : match[1] for match in matchingPosts}
-        # get the actual posts, but remove the closed ones
-        posts = util.Post.fromPostIds(db, postMatches, removeClosed=True)
-        logging.debug("returning %d open posts" % len(posts))
-        return [QueryResult(db, postMatches[post.id], post=post) for post in posts]
+    @metrics.timed("post_fetch")
+    def resultsFromMetadata(self, matchingPosts):
+        """ convert similarityQuery matches into QueryResults from the metadata store, without the database.
+        closed posts have already been removed by selectMatches """
+        return [QueryResult(None, similarity, post=self.metadata.summary(corpusDoc)) 
+            for (postId, similarity, corpusDoc) in matchingPosts]
 
-def main():
-    """ generate a dictionary, corpus and index from the Stack Overflow dump """
-    corpusName = Config.corpusName
+def buildIndex(corpusName, useTags=[], database=Config.mySQLdb, postsPerTopic=Config.postsPerTopic):
+    """ generate a dictionary, corpus and index for corpusName. Any parts that already exist are skipped. """
     print >>sys.stderr, "Generating corpus..."
     if os.path.isfile(corpusName + ".mm"):
         corpus = gensim.corpora.MmCorpus(corpusName + ".mm")
         nPosts = len(corpus)
         print >>sys.stderr, "Corpus exists with %d posts. skipping." % nPosts
     else:
-        if len(sys.argv) > 1:
-            useTags = sys.argv[1:]
-        else:
-            useTags = []
-        nPosts = makeStackOverflowCorpus(corpusName, None, usePostList=True, useTags=useTags)
+        nPosts = makeStackOverflowCorpus(corpusName, None, usePostList=True, useTags=useTags, database=database)
     print >>sys.stderr, "Making TFIDF representation..."
     if os.path.isfile(corpusName + ".tfidf"):
         print >>sys.stderr, "exists, skipping."
@@ -353,14 +987,59 @@ def main():
     if os.path.isfile(corpusName + ".lsi"):
         print >>sys.stderr, "exists, skipping."
     else:
-        makeLSI(corpusName, nPosts//Config.postsPerTopic, True)
+        makeLSI(corpusName, max(1, nPosts//postsPerTopic), True)
     print >>sys.stderr, "Making similarity index..."
     if os.path.isfile(corpusName + ".index"):
         print >>sys.stderr, "exists, skipping."
     else:
         makeSimilarityIndex(corpusName, True)
-    #print >>sys.stderr, "Making LDA topic model..."
-    #makeLDA(corpusName, nPosts//100, True)
+    quantizedPrecision = getattr(Config, "quantizedPrecision", None)
+    if quantizedPrecision:
+        print >>sys.stderr, "Making %s similarity index..." % quantizedPrecision
+        if os.path.isfile(corpusName + ".qindex.npz"):
+            print >>sys.stderr, "exists, skipping."
+        else:
+            makeQuantizedIndex(corpusName, quantizedPrecision)
+    print >>sys.stderr, "Making post metadata store..."
+    if os.path.isfile(corpusName + ".meta.npz"):
+        print >>sys.stderr, "exists, skipping."
+    else:
+        makePostMetadata(corpusName, database)
+    print >>sys.stderr, "Making closed/deleted document bitmap..."
+    if os.path.isfile(corpusName + ".dead.npy"):
+        print >>sys.stderr, "exists, skipping."
+    else:
+        makeDeadDocuments(corpusName, database)
+    print >>sys.stderr, "Making answer vectors..."
+    if os.path.isfile(corpusName + ".answers.npz"):
+        print >>sys.stderr, "exists, skipping."
+    else:
+        makeAnswerVectors(corpusName, database)
+    print >>sys.stderr, "Making tag index..."
+    if os.path.isfile(corpusName + ".tags.npz"):
+        print >>sys.stderr, "exists, skipping."
+    else:
+        makeTagIndex(corpusName, database)
+    ldaPostsPerTopic = getattr(Config, "ldaPostsPerTopic", None)
+    if ldaPostsPerTopic:
+        print >>sys.stderr, "Making LDA topic model..."
+        if os.path.isfile(corpusName + ".lda"):
+            print >>sys.stderr, "exists, skipping."
+        else:
+            makeLDA(corpusName, max(1, nPosts//ldaPostsPerTopic))
+        print >>sys.stderr, "Making LDA document topics..."
+        if os.path.isfile(corpusName + ".ldadocs.npy"):
+            print >>sys.stderr, "exists, skipping."
+        else:
+            makeLdaDocuments(corpusName)
+
+def main():
+    """ generate a dictionary, corpus and index from the Stack Overflow dump """
+    if len(sys.argv) > 1:
+        useTags = sys.argv[1:]
+    else:
+        useTags = []
+    buildIndex(Config.corpusName, useTags)
 
 if __name__ == "__main__":
     print >>sys.stderr , "Using corpus name: %s" % Config.corpusName
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+'''
+Direct expert retrieval from precomputed user expertise vectors.
+
+scoreUsers finds experts indirectly: the query retrieves the similar questions, they are expanded to their answers,
+and the answers are aggregated by user, so the work grows with the number of matching posts. Instead, each user can
+be given a vector in the LSI space: the sum of the (unit) LSI vectors of the questions that they answered, each weighted
+by the quality of their answer, using the same answer weighting as scoreUsers. The dot product of a user's vector with
+the normalized query vector is then the sum of the user's answer scores, with the similarity of each question
+to the query as its relevance, so that the top experts come from a single matrix-vector product over the users.
+
+The vectors are saved to corpusName.users.npz.
+
+Call it by
+user_index.py [featureDirectory]
+(the default feature directory is answerFeatureDirectory in config.py; it is written by scoring.py export)
+
+Created on Oct 19, 2026
+
+@author: efeins
+'''
+import sys
+import os
+import logging
+import itertools
+import numpy
+import scipy.sparse
+import gensim
+
+from config import Config
+import topic_classification
+import scoring
+import metrics
+
+class UserIndex(object):
+    """ user expertise vectors in the LSI space, one row per user """
+    def __init__(self, userIds, vectors, answerWeights, nAnswers):
+        self.userIds = userIds
+        # the quality-weighted sum of the unit LSI vectors of the questions each user answered
+        self.vectors = vectors
+        # the total answer quality of each user, to turn scores into a mean relevance
+        self.answerWeights = answerWeights
+        self.nAnswers = nAnswers
+
+    def __len__(self):
+        return len(self.userIds)
+
+    @property
+    def numTopics(self):
+        return self.vectors.shape[1]
+
+    def save(self, fileName):
+        numpy.savez(fileName, userIds=self.userIds, vectors=self.vectors, answerWeights=self.answerWeights, nAnswers=self.nAnswers)
+
+    @staticmethod
+    def load(fileName):
+        arrays = numpy.load(fileName)
+        return UserIndex(arrays["userIds"], arrays["vectors"], arrays["answerWeights"], arrays["nAnswers"])
+
+    @staticmethod
+    def fromFeatureStore(topicModelName, store, dead=None, chunkSize=10000):
+        """ build the user vectors for the corpus topicModelName from the answers in an AnswerFeatureStore.
+        Documents marked in the optional dead bitmap (closed or deleted questions) are not counted.
+        """
+        corpus = gensim.corpora.MmCorpus(topicModelName + ".mm")
+        tfidf = gensim.models.TfidfModel.load(topicModelName + ".tfidf")
+        lsi = gensim.models.LsiModel.load(topicModelName + ".lsi")
+        corpusToPost = topic_classification.StackOverflowCorpus.loadCorpusToPost(topicModelName + ".c2p")
+        docToPost = numpy.array([corpusToPost[corpusDoc] for corpusDoc in xrange(len(corpusToPost))])
+
+        logging.debug("finding the answers to %d documents..." % len(docToPost))
+        answerIds, docIndex = store.answersTo(docToPost)
+        keep = answerIds < len(store.owner)
+        answerIds, docIndex = answerIds[keep], docIndex[keep]
+        userIds = numpy.asarray(store.owner[answerIds], dtype=numpy.int64)
+        keep = numpy.asarray(store.owned[answerIds], dtype=bool)
+        if dead is not None:
+            keep &= ~numpy.asarray(dead, dtype=bool)[docIndex]
+        answerIds, docIndex, userIds = answerIds[keep], docIndex[keep], userIds[keep]
+
+        # the answer weights of scoreUsers, with the percentiles taken over all of the answers in the corpus
+        accepted = numpy.asarray(store.accepted[answerIds], dtype=numpy.int64)
+        weights = scoring.answerQuality(numpy.double(store.score[answerIds]) + accepted,
+            numpy.double(store.favorites[answerIds]), numpy.double(store.views[answerIds]), accepted,
+            numpy.asarray(store.sentiment[answerIds], dtype=numpy.int64))
+        users, userIndex = numpy.unique(userIds, return_inverse=True)
+        logging.debug("building vectors for %d users from %d answers..." % (len(users), len(answerIds)))
+        userDocWeights = scipy.sparse.csc_matrix((weights, (userIndex, docIndex)), shape=(len(users), len(docToPost)))
+
+        vectors = numpy.zeros((len(users), lsi.num_topics), dtype=numpy.double)
+        documents = iter(lsi[tfidf[corpus]])
+        for start in xrange(0, len(docToPost), chunkSize):
+            chunk = list(itertools.islice(documents, chunkSize))
+            # documents x topics, normalized like the similarity index
+            docVectors = gensim.matutils.corpus2dense(chunk, lsi.num_topics, len(chunk)).T
+            norms = numpy.sqrt((docVectors ** 2).sum(axis=1))
+            docVectors /= numpy.maximum(norms, 1e-12)[:, numpy.newaxis]
+            vectors += userDocWeights[:, start:start + len(chunk)] * docVectors
+            logging.debug("%d documents" % (start + len(chunk)))
+        return UserIndex(users, vectors.astype(numpy.float32),
+            numpy.bincount(userIndex, weights=weights, minlength=len(users)),
+            numpy.bincount(userIndex, minlength=len(users)))
+
+    @metrics.timed("user_scan")
+    def topUsers(self, queryLsi, n=20):
+        """ return (row indices, scores, percentile ranks) of the n best users for a query LSI vector, best first """
+        queryVector = gensim.matutils.sparse2full(queryLsi, self.numTopics)
+        queryNorm = numpy.sqrt(numpy.dot(queryVector, queryVector))
+        if not len(self) or queryNorm == 0:
+            return (numpy.array([], dtype=int), numpy.array([]), numpy.array([]))
+        scores = numpy.dot(self.vectors, queryVector / queryNorm)
+        top = numpy.argsort(-scores, kind="mergesort")[:n]
+        return (top, scores[top], scoring.rankPercentiles(scores)[top])
+
+def findExperts(userIndex, topicModel, query, displayNames, n=20):
+    """ return the n best UserScores for a query from a UserIndex.
+    displayNames is a function from a list of user ids to a dictionary of user id -> display name.
+    The users come without their relevant answers.
+    """
+    (queryLsi,) = topicModel.projectQueries([query])
+    top, scores, percentileRanks = userIndex.topUsers(queryLsi, n)
+    userIds = [int(userId) for userId in userIndex.userIds[top]]
+    names = displayNames(userIds)
+    userScores = []
+    for (i, userId) in enumerate(userIds):
+        row = top[i]
+        userScore = scoring.UserScore(userId, names.get(userId), scores[i],
+            scores[i] / userIndex.answerWeights[row] if userIndex.answerWeights[row] else 0.0, [])
+        userScore.nPosts = int(userIndex.nAnswers[row])
+        userScore.percentileRank = percentileRanks[i]
+        userScores.append(userScore)
+    return userScores
+
+def makeUserIndex(corpusName, featureDirectory):
+    """ build and save corpusName.users.npz """
+    store = scoring.AnswerFeatureStore(featureDirectory)
+    dead = numpy.load(corpusName + ".dead.npy") if os.path.isfile(corpusName + ".dead.npy") else None
+    userIndex = UserIndex.fromFeatureStore(corpusName, store, dead)
+    userIndex.save(corpusName + ".users.npz")
+    return userIndex
+
+def main():
+    featureDirectory = sys.argv[1] if len(sys.argv) > 1 else getattr(Config, "answerFeatureDirectory", None)
+    if not featureDirectory:
+        print >>sys.stderr, "Usage: %s featureDirectory (or set answerFeatureDirectory in config.py)" % sys.argv[0]
+        sys.exit(1)
+    userIndex = makeUserIndex(Config.corpusName, featureDirectory)
+    print >>sys.stderr, "Wrote vectors for %d users to %s.users.npz" % (len(userIndex), Config.corpusName)
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.DEBUG)
+    main()
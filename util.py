@@ -7,7 +7,12 @@ Created on Aug 14, 2012
 import sys
 import logging
 import MySQLdb
+import MySQLdb.cursors
 import re
+import time
+import threading
+import collections
+from contextlib import contextmanager
 from BeautifulSoup import BeautifulSoup
 from config import Config
 from nltk.tokenize import WordPunctTokenizer
@@ -83,17 +88,104 @@ class Post:
         return Post(p) if n > 0 else None
 
     @staticmethod
-    def fromPostIds(db, postIds, removeClosed=True):
+    def fromPostIds(db, postIds, removeClosed=True, ordered=True, columns=None):
+        """ return the posts with the given ids, in the order of postIds if ordered is set.
+        If columns is given, return lightweight records of only those columns """
         c=db.cursor()
         idString = ",".join([str(postId) for postId in postIds])
-        n = c.execute(("""SELECT * FROM posts WHERE id IN (%s) """ % idString) + 
+        n = c.execute(("""SELECT %s FROM posts WHERE id IN (%s) """ % (selectColumns(columns), idString)) + 
           ("AND closed_date IS NULL" if removeClosed else "") +  
-          (""" ORDER BY FIELD(id, %s)""" % idString))
+          ((""" ORDER BY FIELD(id, %s)""" % idString) if ordered else ""))
         if n > 0:
-            posts = [Post(p) for p in c.fetchall()]
+            posts = list(postRecords(c, columns))
         c.close()
         return posts if n > 0 else None
 
+# the columns of the posts table, in SELECT * order
+postColumns = ("id", "type_id", "parent_id", "accepted_answer_id", "creation_date", "score", "view_count", "body",
+    "owner_user_id", "last_editor_user_id", "last_editor_display_name", "last_activity_date", "last_edit_date",
+    "community_owned_date", "closed_date", "title", "tags", "answer_count", "comment_count", "favorite_count")
+# the columns needed to credit an answer to a user
+answerColumns = ("id", "parent_id", "owner_user_id", "last_editor_user_id")
+# the columns needed to display a question as a query result
+summaryColumns = ("id", "title", "owner_user_id", "answer_count")
+
+_postRecordTypes = {}
+
+def postRecordType(columns):
+    """ return a lightweight (namedtuple) record type for rows selecting the given columns of posts. 
+    Unlike Post, the values are not converted: NULLs are None """
+    columns = tuple(columns)
+    if columns not in _postRecordTypes:
+        _postRecordTypes[columns] = collections.namedtuple("PostRecord", columns)
+    return _postRecordTypes[columns]
+
+def recordMaker(columns):
+    """ return a function turning a row of the given columns of posts into a record, or into a Post if columns is None """
+    return Post if columns is None else postRecordType(columns)._make
+
+def postRecords(cursor, columns):
+    """ yield the rows of an executed cursor as records of the given columns, or as Posts if columns is None """
+    makeRecord = recordMaker(columns)
+    for post in cursor.fetchall():
+        yield makeRecord(post)
+
+def idColumn(columns):
+    """ the position of id in the SELECT list for columns of posts """
+    return 0 if columns is None else list(columns).index("id")
+
+def selectColumns(columns, tableAlias=None):
+    """ the SELECT list for columns of posts (all of them if columns is None) """
+    prefix = (tableAlias + ".") if tableAlias else ""
+    return ", ".join([prefix + column for column in (columns or ["*"])])
+
+def streamRows(cursor, fetchSize=1000):
+    """ yield the rows of an executed cursor, fetchSize at a time. With a server side cursor (MySQLdb.cursors.SSCursor),
+    only those rows are held in memory at once """
+    while True:
+        rows = cursor.fetchmany(fetchSize)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+def makeCursor(db, stream=False):
+    return db.cursor(MySQLdb.cursors.SSCursor) if stream else db.cursor()
+
+def keysetRows(db, sql, pageSize=5000, stream=False, keyIndex=0):
+    """ yield the rows of sql, a query for the rows with ids above {lastId}, ORDER BY id, a page of (at most) pageSize 
+    rows at a time. Each page starts after the id (column keyIndex) of the last row of the previous one, so, unlike 
+    with OFFSET, every page is a range scan of the primary key, and only a short page means that there are no more rows.
+    With stream, the pages are read through a server side cursor, so memory use does not grow with the page size, but 
+    the connection cannot run other queries until the iteration finishes (or the generator is closed).
+    """
+    c = makeCursor(db, stream)
+    lastId = -1
+    try:
+        while True:
+            c.execute(sql.format(lastId=lastId) + " LIMIT %d" % pageSize)
+            nRows = 0
+            for row in streamRows(c):
+                nRows += 1
+                lastId = int(row[keyIndex])
+                yield row
+            if nRows < pageSize:
+                return
+    finally:
+        c.close()
+
+def idListRows(db, sql, ids, chunkSize=5000, stream=False):
+    """ yield the rows of sql, a query with an {ids} placeholder for a comma separated list of ids, for chunkSize of 
+    the ids at a time. Every chunk is queried, however many rows the previous ones returned. stream is as for keysetRows """
+    c = makeCursor(db, stream)
+    try:
+        for start in xrange(0, len(ids), chunkSize):
+            c.execute(sql.format(ids=",".join([str(ident) for ident in ids[start:start + chunkSize]])))
+            for row in streamRows(c):
+                yield row
+    finally:
+        c.close()
+
 def makeDbConnection(database=Config.mySQLdb):
     """ make a database connection with defaults """
     db= MySQLdb.connect(
@@ -106,6 +198,136 @@ def makeDbConnection(database=Config.mySQLdb):
     db.autocommit(True)
     return db
 
+class PoolTimeout(Exception):
+    """ raised when no connection becomes available within the checkout timeout """
+    pass
+
+class ConnectionPool(object):
+    """ a thread-safe pool of database connections.
+    Up to maxSize connections are kept open between checkouts; up to maxOverflow more may be opened
+    under load and are closed when they are returned. Idle connections are pinged before being handed out
+    if they have not been used for more than healthCheckInterval seconds.
+    """
+    def __init__(self, database=Config.mySQLdb, maxSize=5, maxOverflow=10, timeout=30.0, healthCheckInterval=30.0):
+        self.database = database
+        self.maxSize = maxSize
+        self.maxOverflow = maxOverflow
+        self.timeout = timeout
+        self.healthCheckInterval = healthCheckInterval
+        self._idle = []             # (connection, time last returned)
+        self._nOpen = 0
+        self._lock = threading.Condition()
+        # checkout metrics
+        self.checkouts = 0
+        self.connectionsOpened = 0
+        self.healthCheckFailures = 0
+        self.checkoutTimeouts = 0
+        self.totalCheckoutTime = 0.0
+        self.maxCheckoutTime = 0.0
+
+    def _healthy(self, db, lastUsed):
+        if time.time() - lastUsed < self.healthCheckInterval:
+            return True
+        try:
+            db.ping()
+            return True
+        except MySQLdb.Error:
+            self.healthCheckFailures += 1
+            return False
+
+    def checkout(self):
+        """ borrow a connection. It must be returned with checkin() """
+        t = time.time()
+        deadline = t + self.timeout
+        with self._lock:
+            while True:
+                while self._idle:
+                    db, lastUsed = self._idle.pop()
+                    if self._healthy(db, lastUsed):
+                        self._recordCheckout(t)
+                        return db
+                    self._discard(db)
+                if self._nOpen < self.maxSize + self.maxOverflow:
+                    self._nOpen += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.checkoutTimeouts += 1
+                    raise PoolTimeout("no database connection available after %0.1fs" % self.timeout)
+                self._lock.wait(remaining)
+        # connect outside of the lock
+        try:
+            db = makeDbConnection(self.database)
+        except:
+            with self._lock:
+                self._nOpen -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self.connectionsOpened += 1
+            self._recordCheckout(t)
+        return db
+
+    def checkin(self, db):
+        """ return a borrowed connection to the pool """
+        with self._lock:
+            if len(self._idle) < self.maxSize:
+                self._idle.append((db, time.time()))
+            else:
+                self._discard(db)
+            self._lock.notify()
+
+    def invalidate(self, db):
+        """ close a borrowed connection that may be broken instead of returning it to the pool """
+        with self._lock:
+            self._discard(db)
+            self._lock.notify()
+
+    def _discard(self, db):
+        self._nOpen -= 1
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+
+    def _recordCheckout(self, t):
+        dt = time.time() - t
+        self.checkouts += 1
+        self.totalCheckoutTime += dt
+        self.maxCheckoutTime = max(self.maxCheckoutTime, dt)
+
+    @contextmanager
+    def connection(self):
+        """ borrow a connection for the duration of a with block.
+        If the block raises, the connection is closed rather than reused """
+        db = self.checkout()
+        try:
+            yield db
+        except:
+            self.invalidate(db)
+            raise
+        self.checkin(db)
+
+    def stats(self):
+        """ return a dictionary of pool size and checkout latency metrics """
+        with self._lock:
+            return {
+                "open" : self._nOpen,
+                "idle" : len(self._idle),
+                "checkouts" : self.checkouts,
+                "connectionsOpened" : self.connectionsOpened,
+                "healthCheckFailures" : self.healthCheckFailures,
+                "checkoutTimeouts" : self.checkoutTimeouts,
+                "meanCheckoutTime" : self.totalCheckoutTime / self.checkouts if self.checkouts else 0.0,
+                "maxCheckoutTime" : self.maxCheckoutTime
+            }
+
+    def close(self):
+        """ close all idle connections """
+        with self._lock:
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+
 def significantKeywords(db, minPosts, nLimit=0):
     """ Given a database connection, find the list of significant
     tags (eg, minimum number of posts using the tag)
@@ -141,14 +363,14 @@ def topTags(db, topN=1000):
 
 def tagPosts(db, tags):
     """ return unique post ids for posts by tag """
+    if not tags:
+        return []
     c=db.cursor()
     print >>sys.stderr, "Finding tagged posts from", tags
-    idents = []
-    for tag in tags:
-        c.execute("""SELECT post_id FROM tags WHERE tag='%s'""" % tag)
-        idents += [int(ident[0]) for ident in c.fetchall()]
+    c.execute("""SELECT DISTINCT post_id FROM tags WHERE tag IN (%s)""" % ",".join(["%s"] * len(tags)), tuple(tags))
+    idents = [int(ident[0]) for ident in c.fetchall()]
     c.close()
-    return list(set(idents))
+    return idents
 
 def extractCode(postSoup):
     """ extract and clean up the code from a soup-ed post string,
@@ -186,49 +408,38 @@ def extractLinks(postSoup):
 if __name__ == '__main__':
     pass
 
-def iterateQuestions(db, onTopic=None, postList=None, selectRate=5000):
-    """ iterate through the given questions from the database, either by tag or by a list of posts. Select 
-    selectRate at a time to avoid one-by-one database acccess
+def iterateQuestions(db, onTopic=None, postList=None, selectRate=5000, columns=None, stream=False):
+    """ iterate through the given questions from the database, either by tag or by a list of posts, in order of id. Select 
+    selectRate at a time to avoid one-by-one database acccess. 
+    If columns is given, yield lightweight records of only those columns (which must include id).
+    With stream, the rows are read through a server side cursor (see keysetRows), so the connection can't be used 
+    for anything else until the iteration finishes.
     """
-    c=db.cursor()
-    
-    nResults = selectRate
-    resultCtr = 0
-    lastId = -100
-    while nResults == selectRate:
-        if postList:
-            thisPostList = ",".join([str(postid) for postid in postList[resultCtr:(resultCtr + selectRate)]])
-            sql = """
-            SELECT * 
-            FROM posts
-            WHERE id IN (%s) 
-            """ % thisPostList
-        elif onTopic:
-            sql = """
-            SELECT p.* 
+    makeRecord = recordMaker(columns)
+    if postList:
+        rows = idListRows(db, """SELECT %s FROM posts WHERE id IN ({ids}) ORDER BY id""" % selectColumns(columns), 
+            sorted(set(postList)), selectRate, stream)
+    elif onTopic:
+        rows = keysetRows(db, """
+            SELECT %s 
             FROM tags AS t 
                 INNER JOIN posts AS p 
                 ON t.tag='%s' AND p.id=t.post_id
-            WHERE p.id > %d AND t.post_id > %d
-            LIMIT %d""" % (onTopic, lastId, lastId, selectRate)
-        else:
-            sql = """SELECT * FROM posts WHERE type_id=1 AND id > %d LIMIT %d""" % (lastId, selectRate)
-        nResults = c.execute(sql)
-        for post in c.fetchall():
-            lastId = int(post[0])
-            yield Post(post)
-        resultCtr += nResults
-    c.close()
+            WHERE t.post_id > {lastId}
+            ORDER BY t.post_id""" % (selectColumns(columns, "p"), onTopic), selectRate, stream, idColumn(columns))
+    else:
+        rows = keysetRows(db, """SELECT %s FROM posts WHERE type_id=1 AND id > {lastId} ORDER BY id""" % selectColumns(columns), 
+            selectRate, stream, idColumn(columns))
+    for post in rows:
+        yield makeRecord(post)
 
-def iterateAnswers(db, postIds):
-    """ return the answers for a given post """
-    c=db.cursor()
-    strPostId = ",".join([str(postId) for postId in postIds])
-    #logging.debug("Loading answers...")
-    c.execute("""SELECT * FROM posts WHERE type_id=2 AND parent_id IN (%s) ORDER BY FIELD(parent_id, %s)""" % (strPostId, strPostId))
-    for answer in c.fetchall():
-        yield Post(answer)
-    c.close()
+def iterateAnswers(db, postIds, columns=None, selectRate=5000, stream=False):
+    """ return the answers for the given posts, in the order of postIds, selecting the answers to selectRate posts at a time. 
+    If columns is given, yield lightweight records of only those columns. stream is as for iterateQuestions """
+    makeRecord = recordMaker(columns)
+    for answer in idListRows(db, """SELECT %s FROM posts WHERE type_id=2 AND parent_id IN ({ids}) ORDER BY FIELD(parent_id, {ids})""" % 
+        selectColumns(columns), list(postIds), selectRate, stream):
+        yield makeRecord(answer)
 
 class Comment:
     """ represent a database comment as a class """
@@ -248,29 +459,15 @@ def iterateComments(db, post_id):
         yield Comment(answer)
     c.close()
 
-def iterateAllComments(db, commentList=None, selectRate=5000):
-    c=db.cursor()
-    
-    nResults = selectRate
-    resultCtr = 0
-    lastId = -100
-    while nResults == selectRate:
-        if commentList:
-            thisCommentList = ",".join([str(commentid) for commentid in commentList[resultCtr:(resultCtr + selectRate)]])
-            sql = """
-            SELECT * 
-            FROM comments
-            WHERE id IN (%s)
-            ORDER BY FIELD(id, %s) 
-            """ % (thisCommentList, thisCommentList)
-        else:
-            sql = """SELECT * FROM comments WHERE id > %d LIMIT %d""" % (lastId, selectRate)
-        nResults = c.execute(sql)
-        for comment in c.fetchall():
-            lastId = int(comment[0])
-            yield Comment(comment)
-        resultCtr += nResults
-    c.close()
+def iterateAllComments(db, commentList=None, selectRate=5000, stream=False):
+    """ iterate through all of the comments in order of id, or through the ones in commentList in its order,
+    selectRate at a time. stream is as for iterateQuestions """
+    if commentList:
+        rows = idListRows(db, """SELECT * FROM comments WHERE id IN ({ids}) ORDER BY FIELD(id, {ids})""", list(commentList), selectRate, stream)
+    else:
+        rows = keysetRows(db, """SELECT * FROM comments WHERE id > {lastId} ORDER BY id""", selectRate, stream)
+    for comment in rows:
+        yield Comment(comment)
 
 def usersById(db, userIds):
     """ get user display names by id """